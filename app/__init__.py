@@ -2,6 +2,13 @@ from flask import Flask
 from flask_caching import Cache
 from flask_executor import Executor
 from .db import SqliteCache
+from .cache_layers import MemoryTier, WriteBehind, cached_keys
+from .ocr import BatchedPageOcr, OcrPipeline
+from .ocr_pool import OcrProcessPool
+from .scheduler import FairScheduler
+from .jobs import JobStore
+from .phash import PerceptualIndex
+from .refresh import StaleRefresher
 import config
 import threading
 import os
@@ -10,7 +17,15 @@ import logging
 
 OCR_CACHE = "OCR_CACHE"
 OCR_EXECUTOR = "OCR_EXECUTOR"
+OCR_PROCESS_POOL = "OCR_PROCESS_POOL"
+OCR_PIPELINE = "OCR_PIPELINE"
+OCR_SCHEDULER = "OCR_SCHEDULER"
+OCR_JOBS = "OCR_JOBS"
+OCR_PHASH = "OCR_PHASH"
+OCR_REFRESH = "OCR_REFRESH"
+OCR_BACKGROUND = "OCR_BACKGROUND"
 _og_lock = threading.Lock()
+_background_lock = threading.Lock()
 
 
 @functools.cache
@@ -37,6 +52,20 @@ def manga_page_ocr(*args, **kwargs):
     return og.mpocr(*args, **kwargs)
 
 
+def batched_page_ocr(line_batch_size, detect_max_side=None):
+    manga_page_ocr()
+    return BatchedPageOcr(overlay_generator().mpocr, line_batch_size, detect_max_side)
+
+
+def ocr_image(image, line_batch_size=16, detect_max_side=None):
+    # manga_page_ocr for a page in memory, encoded or decoded, without
+    # going through a file. See BatchedPageOcr.decode
+    result, = batched_page_ocr(line_batch_size, detect_max_side)([image])
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
 def create_app(config_env=None):
     app = Flask(__name__)
 
@@ -74,20 +103,121 @@ def create_app(config_env=None):
         key.removeprefix("OCR_"): app.config[key]
         for key in app.config.keys() if key.startswith("OCR_CACHE_")}
     ocr_env_config["CACHE_USE_JSON"] = True
-    app.extensions[OCR_CACHE] = Cache(app, config=ocr_env_config)
+    ocr_cache = Cache(app, config=ocr_env_config)
+    if app.config.get("OCR_MULTIPROCESS") and (
+            app.config.get("OCR_WRITE_BEHIND_INTERVAL") or app.config.get("OCR_MEMORY_TIER_MAX_BYTES")):
+        app.logger.info("Not using the in-process cache layers, OCR_MULTIPROCESS is set")
+        app.config.update(OCR_WRITE_BEHIND_INTERVAL=0, OCR_MEMORY_TIER_MAX_BYTES=0)
+    if app.config.get("OCR_WRITE_BEHIND_INTERVAL"):
+        ocr_cache = WriteBehind(
+            ocr_cache, app.config["OCR_WRITE_BEHIND_INTERVAL"],
+            app.config.get("OCR_WRITE_BEHIND_BATCH"), app.logger)
+    if app.config.get("OCR_MEMORY_TIER_MAX_BYTES"):
+        ocr_cache = MemoryTier(
+            ocr_cache, app.config["OCR_MEMORY_TIER_MAX_BYTES"], app.logger)
+    app.extensions[OCR_CACHE] = ocr_cache
+    if app.config.get("OCR_REMOTE_WORKERS"):
+        # pages are OCR'd by `mokuro-online worker` nodes
+        pass
+    elif app.config.get("OCR_PROCESS_WORKERS"):
+        app.extensions[OCR_PROCESS_POOL] = OcrProcessPool(
+            app.config["OCR_PROCESS_WORKERS"],
+            app.config.get("OCR_PROCESS_TORCH_THREADS"),
+            app.config.get("OCR_BATCH_LINES"), app.logger,
+            app.config.get("OCR_DETECT_MAX_SIDE"))
+        # executor threads only wait on the processes, one for each of them
+        app.config["OCR_EXECUTOR_MAX_WORKERS"] = max(
+            app.config["OCR_EXECUTOR_MAX_WORKERS"], app.config["OCR_PROCESS_WORKERS"])
+    elif app.config.get("OCR_PIPELINE"):
+        app.extensions[OCR_PIPELINE] = OcrPipeline(
+            functools.partial(
+                batched_page_ocr, app.config.get("OCR_BATCH_LINES"), app.config.get("OCR_DETECT_MAX_SIDE")),
+            ocr_cache.set, app.config.get("OCR_PIPELINE_WORKERS"),
+            app.config.get("OCR_PIPELINE_QUEUE_SIZE", 8), app.config.get("OCR_BATCH_PAGES", 1),
+            app.config.get("OCR_BATCH_MAX_WAIT", 0), app.logger)
+        # executor threads wait on the pipeline, enough of them to fill it
+        app.config["OCR_EXECUTOR_MAX_WORKERS"] = max(
+            app.config["OCR_EXECUTOR_MAX_WORKERS"], 2 * app.config.get("OCR_BATCH_PAGES", 1) + 3)
     app.extensions[OCR_EXECUTOR] = Executor(app, name="ocr")
+    app.extensions[OCR_SCHEDULER] = FairScheduler(
+        app.config["OCR_EXECUTOR_MAX_WORKERS"],
+        app.config.get("OCR_SCHEDULER_WEIGHTS"), app.logger)
+    app.extensions[OCR_JOBS] = JobStore(
+        app.config.get("OCR_JOBS_PATH"), app.config.get("OCR_SPOOL_DIR"),
+        app.config.get("OCR_JOBS_LEASE", 30), app.logger,
+        app.config.get("OCR_JOBS_MAX_ATTEMPTS", 3), app.config.get("OCR_SOURCES_DIR"))
+    if app.config.get("OCR_PHASH"):
+        app.extensions[OCR_PHASH] = PerceptualIndex(
+            app.config.get("OCR_PHASH_PATH"), app.config.get("OCR_PHASH_MAX_DISTANCE", 3),
+            logger=app.logger)
 
     with app.app_context():
         app.queue = dict()
         app.queue_lock = threading.Lock()
-        if app.config.get("PRELOAD_OCR"):
-            app.logger.info("Preloading MangaPageOCR")
-            # executor needs a request context to work
-            with app.test_request_context():
-                app.extensions[OCR_EXECUTOR].submit(lambda: manga_page_ocr())
 
     from . import routes
     app.register_blueprint(routes.v1)
     app.register_blueprint(routes.site)
 
+    jobs = app.extensions[OCR_JOBS]
+    if app.config.get("OCR_REFRESH") and jobs.sources_dir:
+        def refresh_page(hs):
+            with app.test_request_context():
+                return routes.refresh_page(hs)
+
+        def refresh_slots():
+            with app.app_context():
+                return routes.refresh_slots()
+        refresher = StaleRefresher(
+            ocr_cache, jobs, refresh_page, refresh_slots, app.config.get("OCR_REFRESH_VERSION"),
+            app.config.get("OCR_REFRESH_SCAN_INTERVAL", 3600), logger=app.logger)
+        if refresher.version is None:
+            app.logger.warning("Not refreshing stale OCR results, mokuro's version is unknown")
+        else:
+            app.extensions[OCR_REFRESH] = refresher
+
+    from . import cli
+    app.cli.add_command(cli.cache_cli)
+    app.cli.add_command(cli.worker)
+
+    # servers other than gunicorn start them on the first request
+    app.before_request(functools.partial(start_background, app))
+
     return app
+
+
+def start_background(app):
+    # Preloads the OCR, recovers the queue and starts the background threads
+    # of a process serving the app, once. create_app leaves them out, so the
+    # `flask` commands don't take over the jobs. See gunicorn.conf.py
+    with _background_lock:
+        if app.extensions.get(OCR_BACKGROUND):
+            return
+        app.extensions[OCR_BACKGROUND] = True
+    from . import routes
+    jobs = app.extensions[OCR_JOBS]
+
+    if app.config.get("PRELOAD_OCR") and not app.config.get("OCR_REMOTE_WORKERS"):
+        app.logger.info("Preloading MangaPageOCR")
+        # executor needs a request context to work
+        with app.test_request_context():
+            if OCR_PROCESS_POOL in app.extensions:
+                app.extensions[OCR_EXECUTOR].submit(
+                    app.extensions[OCR_PROCESS_POOL].preload)
+            else:
+                app.extensions[OCR_EXECUTOR].submit(lambda: manga_page_ocr())
+
+    def resume_jobs(adopted):
+        with app.test_request_context():
+            routes.resume_jobs(adopted)
+    if not app.config.get("OCR_REMOTE_WORKERS"):
+        resume_jobs(jobs.adopt_expired())
+        # the jobs of processes that die later are adopted by the survivors
+        jobs.on_adopt = resume_jobs
+    jobs.start_heartbeat()
+    jobs.collect_garbage(app.config.get("OCR_JOBS_KEEP_FINISHED", 86400))
+    if jobs.sources_dir:
+        jobs.prune_sources(functools.partial(cached_keys, app.extensions[OCR_CACHE]))
+
+    if OCR_REFRESH in app.extensions:
+        app.extensions[OCR_REFRESH].start()
@@ -0,0 +1,413 @@
+from collections import OrderedDict, defaultdict
+import threading
+import logging
+import atexit
+import json
+import os
+
+
+def find_method(cache, name):
+    # walk down wrappers and the flask_caching.Cache proxy, which only
+    # proxies the common BaseCache methods
+    while cache is not None:
+        method = getattr(type(cache), name, None) and getattr(cache, name)
+        if method is not None:
+            return method
+        cache = getattr(cache, "cache", None)
+    return None
+
+
+def cached_keys(cache, *keys):
+    # the keys found, with has_many where some layer has it
+    has_many = find_method(cache, "has_many")
+    if has_many is not None:
+        return has_many(*keys)
+    return [key for key in keys if cache.has(key)]
+
+
+def innermost(cache):
+    while getattr(cache, "cache", None) is not None:
+        cache = cache.cache
+    return cache
+
+
+def layer_stats(cache):
+    stats = {}
+    while cache is not None:
+        if hasattr(type(cache), "stats_name"):
+            stats[cache.stats_name] = cache.stats()
+        cache = getattr(cache, "cache", None)
+    return stats
+
+
+def dump_json(value):
+    return json.dumps(value, ensure_ascii=False).encode()
+
+
+class MemoryTier:
+    # Bounded in-process tier in front of the OCR cache. The budget counts
+    # the serialized json of the entries, parsed values are kept alongside
+    # it so repeated reads don't parse again. Values are shared between
+    # callers and must be treated as read-only.
+    stats_name = "memory_tier"
+
+    def __init__(self, cache, max_bytes, logger=None):
+        self.cache = cache
+        self.max_bytes = int(max_bytes)
+        self.logger = logger or logging.getLogger(__name__)
+        self._entries = OrderedDict()  # key -> [raw, value]
+        self._size = 0
+        self._lock = threading.Lock()
+        # bumped on every write, read-throughs started before it are dropped
+        self._generation = 0
+        self._stats = dict(hits=0, misses=0, evictions=0)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(entries=len(self._entries), bytes=self._size,
+                         max_bytes=self.max_bytes)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = entry
+            self._stats["hits"] += len(found)
+            self._stats["misses"] += len(keys) - len(found)
+            return found, self._generation
+
+    def _store(self, key, raw, value, generation=None):
+        if len(raw) > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return  # a write happened meanwhile, this may be stale
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = [raw, value]
+            self._size += len(raw)
+            while self._size > self.max_bytes:
+                _, (old_raw, _) = self._entries.popitem(last=False)
+                self._size -= len(old_raw)
+                self._stats["evictions"] += 1
+
+    def _forget(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._size -= len(old[0])
+
+    def _read_through(self, keys, generation):
+        # returns {key: [raw, value]} for the keys found in the inner cache
+        get_many_raw = find_method(self.cache, "get_many_raw")
+        found = {}
+        if get_many_raw is not None:
+            for key, raw in zip(keys, get_many_raw(*keys)):
+                if raw is not None:
+                    found[key] = [bytes(raw), None]
+        else:
+            for key, value in zip(keys, self.cache.get_many(*keys)):
+                if value is not None:
+                    found[key] = [dump_json(value), value]
+        for key, (raw, value) in found.items():
+            self._store(key, raw, value, generation)
+        return found
+
+    def _parsed(self, entry):
+        if entry[1] is None:
+            entry[1] = json.loads(entry[0])
+        return entry[1]
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        found, generation = self._lookup(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            found.update(self._read_through(missing, generation))
+        return [
+            self._parsed(found[key]) if key in found else None
+            for key in keys
+        ]
+
+    def get_many_raw(self, *keys):
+        found, generation = self._lookup(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            found.update(self._read_through(missing, generation))
+        return [found[key][0] if key in found else None for key in keys]
+
+    def has(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.cache.has(key)
+
+    def has_many(self, *keys):
+        with self._lock:
+            cached = [key for key in keys if key in self._entries]
+        cached_set = set(cached)
+        missing = [key for key in keys if key not in cached_set]
+        if not missing:
+            return cached
+        has_many = find_method(self.cache, "has_many")
+        if has_many is not None:
+            return cached + list(has_many(*missing))
+        return cached + [key for key in missing if self.cache.has(key)]
+
+    # Writes go to the inner cache first. Forgetting the keys afterwards
+    # also drops read-throughs that could still hold the old values.
+
+    def set(self, key, value, timeout=None):
+        result = self.cache.set(key, value, timeout=timeout)
+        self._forget((key,))
+        self._store(key, dump_json(value), value)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        result = self.cache.set_many(mapping, timeout=timeout)
+        self._forget(mapping)
+        for key, value in mapping.items():
+            self._store(key, dump_json(value), value)
+        return result
+
+    def add(self, key, value, timeout=None):
+        added = self.cache.add(key, value, timeout=timeout)
+        if added:
+            self._forget((key,))
+            self._store(key, dump_json(value), value)
+        return added
+
+    def delete(self, key):
+        result = self.cache.delete(key)
+        self._forget((key,))
+        return result
+
+    def delete_many(self, *keys):
+        result = self.cache.delete_many(*keys)
+        self._forget(keys)
+        return result
+
+    def clear(self):
+        result = self.cache.clear()
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+        return result
+
+
+class WriteBehind:
+    # Buffers writes in memory and merges them into one set_many per
+    # flush_interval seconds or batch_size keys. Buffered values are
+    # visible to every read, and the buffer is flushed at exit. Callbacks
+    # registered with when_flushed run once their key has been written.
+    stats_name = "write_behind"
+
+    def __init__(self, cache, flush_interval, batch_size=0, logger=None):
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size or 0
+        self.logger = logger or logging.getLogger(__name__)
+        self._pending = {}  # key -> (value, timeout)
+        self._flushing = {}  # being written by the current flush
+        self._callbacks = defaultdict(list)  # key -> [callback(error)]
+        self._lock = threading.Lock()
+        # held while writing to the inner cache, so deletes can't be
+        # overwritten by a flush that started before them
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._stats = dict(flushes=0, flushed=0, failed=0)
+        atexit.register(self.flush)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(pending=len(self._pending) + len(self._flushing))
+        return stats
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid():
+                return
+            self._thread = threading.Thread(
+                target=self._loop, name="ocr-cache-write-behind", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Write-behind flush failed: {e}")
+
+    def when_flushed(self, key, callback):
+        # callback(error) once the buffered value of key is written, or its
+        # write failed. Right away if key isn't buffered
+        with self._lock:
+            if key in self._pending or key in self._flushing:
+                self._callbacks[key].append(callback)
+                return
+        callback(None)
+
+    def _run_callbacks(self, callbacks, error=None):
+        for callback in callbacks:
+            try:
+                callback(error)
+            except Exception as e:
+                self.logger.error(f"Write-behind callback failed: {e}")
+
+    def _pop_callbacks(self, keys):
+        # with self._lock held
+        return [callback for key in keys for callback in self._callbacks.pop(key, ())]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+
+            by_timeout = defaultdict(dict)
+            for key, (value, timeout) in batch.items():
+                by_timeout[timeout][key] = value
+            try:
+                for timeout, mapping in by_timeout.items():
+                    self.cache.set_many(mapping, timeout=timeout)
+            except Exception as e:
+                with self._lock:
+                    # keep them for the next flush, unless overwritten since
+                    self._pending = {**batch, **self._pending}
+                    self._flushing = {}
+                    self._stats["failed"] += 1
+                    callbacks = self._pop_callbacks(batch)
+                self._run_callbacks(callbacks, e)
+                raise
+
+            with self._lock:
+                self._flushing = {}
+                self._stats["flushes"] += 1
+                self._stats["flushed"] += len(batch)
+                callbacks = self._pop_callbacks(batch)
+            self._run_callbacks(callbacks)
+            return len(batch)
+
+    def _buffered(self, key):
+        # (found, value) from the buffer, newest first
+        with self._lock:
+            for buffer in (self._pending, self._flushing):
+                if key in buffer:
+                    return True, buffer[key][0]
+        return False, None
+
+    def get(self, key):
+        found, value = self._buffered(key)
+        if found:
+            return value
+        return self.cache.get(key)
+
+    def get_many(self, *keys):
+        buffered = {}
+        for key in keys:
+            found, value = self._buffered(key)
+            if found:
+                buffered[key] = value
+        missing = [key for key in dict.fromkeys(keys) if key not in buffered]
+        if missing:
+            buffered.update(zip(missing, self.cache.get_many(*missing)))
+        return [buffered.get(key) for key in keys]
+
+    def get_many_raw(self, *keys):
+        buffered = {}
+        for key in keys:
+            found, value = self._buffered(key)
+            if found:
+                buffered[key] = dump_json(value)
+        missing = [key for key in dict.fromkeys(keys) if key not in buffered]
+        if missing:
+            get_many_raw = find_method(self.cache, "get_many_raw")
+            if get_many_raw is not None:
+                buffered.update(zip(missing, get_many_raw(*missing)))
+            else:
+                buffered.update(
+                    (key, None if value is None else dump_json(value))
+                    for key, value in zip(missing, self.cache.get_many(*missing)))
+        return [buffered.get(key) for key in keys]
+
+    def has(self, key):
+        return self._buffered(key)[0] or self.cache.has(key)
+
+    def has_many(self, *keys):
+        buffered = [key for key in keys if self._buffered(key)[0]]
+        buffered_set = set(buffered)
+        missing = [key for key in keys if key not in buffered_set]
+        if not missing:
+            return buffered
+        has_many = find_method(self.cache, "has_many")
+        if has_many is not None:
+            return buffered + list(has_many(*missing))
+        return buffered + [key for key in missing if self.cache.has(key)]
+
+    def set(self, key, value, timeout=None):
+        return self.set_many({key: value}, timeout=timeout) == [key]
+
+    def set_many(self, mapping, timeout=None):
+        self._ensure_thread()
+        with self._lock:
+            for key, value in mapping.items():
+                self._pending[key] = (value, timeout)
+            full = self.batch_size and len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+        return list(mapping)
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout=timeout)
+
+    def delete(self, key):
+        return bool(self.delete_many(key))
+
+    def delete_many(self, *keys):
+        with self._flush_lock:
+            with self._lock:
+                buffered = [key for key in keys if self._pending.pop(key, None)]
+                callbacks = self._pop_callbacks(buffered)
+            deleted = self.cache.delete_many(*keys)
+        self._run_callbacks(callbacks)
+        return list(dict.fromkeys([*buffered, *(deleted or ())]))
+
+    def clear(self):
+        with self._flush_lock:
+            with self._lock:
+                callbacks = self._pop_callbacks(self._pending)
+                self._pending.clear()
+            result = self.cache.clear()
+        self._run_callbacks(callbacks)
+        return result
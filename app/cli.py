@@ -0,0 +1,145 @@
+from flask import current_app
+from flask.cli import AppGroup
+from . import OCR_CACHE
+from .cache_layers import innermost
+from .compression import train_dictionary
+from .db import reshard as reshard_cache, shard_paths
+from .snapshot import MERGE_RULES, SnapshotError, export_snapshot, import_snapshot
+from .worker import run_workers
+from datetime import datetime
+from pathlib import Path
+import click
+import json
+
+cache_cli = AppGroup("cache", help="Manage the OCR results cache.")
+
+
+def ocr_cache_backend():
+    # unwrap the cache layers and the flask_caching.Cache proxy
+    return innermost(current_app.extensions[OCR_CACHE])
+
+
+def require(backend, method):
+    if not hasattr(backend, method):
+        raise click.ClickException(
+            f"The configured OCR cache ({type(backend).__name__}) doesn't support this command")
+
+
+@cache_cli.command("stats")
+def stats():
+    """Show the size of the cache and how well it compresses."""
+    backend = ocr_cache_backend()
+    require(backend, "compression_stats")
+    # the codec counters only cover this process, so measure a sample
+    backend.codec.reset_stats()
+    for value in backend.sample_values(200):
+        backend.codec.encode(value)
+    click.echo(json.dumps(backend.compression_stats(), indent=2))
+
+
+@cache_cli.command("train-dict")
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--samples", default=1000, show_default=True, help="Number of cached pages to sample.")
+@click.option("--size", default=None, type=int, help="Dictionary size in bytes.")
+def train_dict(output, samples, size):
+    """Train a compression dictionary from cached pages.
+
+    Point OCR_CACHE_COMPRESSION_DICT to OUTPUT and run `cache recompress`
+    afterwards. The dictionary can't be changed again once it was used.
+    """
+    backend = ocr_cache_backend()
+    require(backend, "sample_values")
+    values = backend.sample_values(samples)
+    if not values:
+        raise click.ClickException("The cache is empty, nothing to train on")
+    dictionary = train_dictionary(backend.codec.codec.name, values, size)
+    with open(output, "wb") as f:
+        f.write(dictionary)
+    click.echo(f"Wrote {len(dictionary)} bytes dictionary from {len(values)} pages")
+
+
+@cache_cli.command("recompress")
+@click.option("--batch-size", default=500, show_default=True)
+def recompress(batch_size):
+    """Rewrite rows stored with older formats or codecs."""
+    backend = ocr_cache_backend()
+    require(backend, "recompress")
+    rewritten = backend.recompress(batch_size)
+    click.echo(f"Recompressed {rewritten} rows")
+
+
+@cache_cli.command("reshard")
+@click.option("--shards", default=None, type=int, help="Number of shards, OCR_CACHE_SHARDS by default.")
+@click.argument("sources", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def reshard(shards, sources):
+    """Copy cached rows into a sharded cache at OCR_CACHE_PATH.
+
+    SOURCES default to the single file or the shards found at
+    OCR_CACHE_PATH. Stop the server first, the copy is done offline.
+    """
+    path = Path(current_app.config["OCR_CACHE_PATH"])
+    shards = shards or current_app.config.get("OCR_CACHE_SHARDS", 4)
+    if not sources:
+        sources = [str(path)] if path.exists() else sorted(
+            str(p) for p in path.parent.glob(f"{path.stem}.*-of-*{path.suffix}"))
+    if not sources:
+        raise click.ClickException(f"No cache found at {path}")
+    targets = {str(Path(p).resolve()) for p in shard_paths(path, shards)}
+    if any(str(Path(p).resolve()) in targets for p in sources):
+        raise click.ClickException("The sources can't be shards of the new layout")
+    copied = reshard_cache(sources, path, shards, logger=current_app.logger)
+    click.echo(f"Copied {copied} rows into {shards} shards")
+
+
+def parse_since(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+@cache_cli.command("export")
+@click.argument("output", type=click.File("wb"))
+@click.option("--since", default=None, help="Only rows updated since this unix time or ISO date.")
+def export(output, since):
+    """Write the cached pages to a snapshot file, `-` for stdout."""
+    backend = ocr_cache_backend()
+    require(backend, "iter_rows")
+    count = export_snapshot(backend, output, parse_since(since))
+    click.echo(f"Exported {count} rows", err=True)
+
+
+@cache_cli.command("import")
+@click.argument("snapshot", type=click.File("rb"))
+@click.option("--merge", default="newer", show_default=True, type=click.Choice(MERGE_RULES),
+              help="For pages already cached: keep the newer one, keep ours or replace it.")
+@click.option("--batch-size", default=10_000, show_default=True, help="Rows per transaction.")
+def import_(snapshot, merge, batch_size):
+    """Load a snapshot made by `cache export`, `-` for stdin."""
+    backend = ocr_cache_backend()
+    require(backend, "insert_rows")
+    try:
+        read, written = import_snapshot(backend, snapshot, merge, batch_size)
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Imported {written} of {read} rows")
+
+
+@click.command("worker")
+@click.option("--url", required=True, envvar="MOKURO_ONLINE_URL",
+              help="The web node running with OCR_REMOTE_WORKERS.")
+@click.option("--token", required=True, envvar="MOKURO_ONLINE_WORKER_TOKEN",
+              help="Its OCR_WORKER_TOKEN.")
+@click.option("--processes", default=1, show_default=True, help="Worker processes, each with its own models.")
+@click.option("--poll-interval", default=2.0, show_default=True, help="Seconds between polls when idle.")
+@click.option("--detect-max-side", default=None, type=int,
+              help="Downscale longer pages to this for text detection, like OCR_DETECT_MAX_SIDE.")
+def worker(url, token, processes, poll_interval, detect_max_side):
+    """Pull OCR jobs from a web node and OCR them here."""
+    run_workers(url, token, processes, poll_interval, detect_max_side=detect_max_side)
+
+
+# `mokuro-online worker` doesn't need the app nor its configuration
+main = click.Group("mokuro-online", commands=[worker])
@@ -0,0 +1,213 @@
+from time import perf_counter
+import threading
+import struct
+import zlib
+
+# Stored values are framed as: FORMAT_VERSION, codec id, dictionary id, payload.
+# The dictionary id is the crc32 of the compression dictionary, 0 without one.
+# Frames of version 1 have no dictionary id. Values written before this
+# framing existed are either TEXT (json) or pickled BLOBs, which always start
+# with the pickle PROTO opcode (0x80).
+FORMAT_VERSION = 2
+FORMAT_VERSIONS = (1, 2)
+_DICTIONARY_ID = struct.Struct(">I")
+
+
+class DictionaryMismatch(ValueError):
+    pass
+
+
+def dictionary_id(dictionary):
+    return zlib.crc32(dictionary) if dictionary else 0
+
+
+class RawCodec:
+    id = 0
+    name = "none"
+    dictionary_id = 0
+
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return bytes(data)
+
+
+class ZlibCodec:
+    id = 1
+    name = "zlib"
+
+    def __init__(self, level=None, dictionary=None):
+        self.level = 6 if level is None else int(level)
+        self.dictionary = dictionary
+        self.dictionary_id = dictionary_id(dictionary)
+
+    def encode(self, data):
+        if not self.dictionary:
+            return zlib.compress(data, self.level)
+        compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def decode(self, data):
+        if not self.dictionary:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj(zdict=self.dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+class ZstdCodec:
+    id = 2
+    name = "zstd"
+
+    def __init__(self, level=None, dictionary=None):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "The 'zstd' cache compression needs the 'zstandard' package installed")
+        self.level = 3 if level is None else int(level)
+        self.dictionary_id = dictionary_id(dictionary)
+        self.dictionary = zstandard.ZstdCompressionDict(
+            dictionary) if dictionary else None
+        # (de)compressor objects are not thread safe
+        self._local = threading.local()
+        self._zstandard = zstandard
+
+    def _compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._zstandard.ZstdCompressor(
+                level=self.level, dict_data=self.dictionary)
+            self._local.compressor = compressor
+        return compressor
+
+    def _decompressor(self):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._zstandard.ZstdDecompressor(
+                dict_data=self.dictionary)
+            self._local.decompressor = decompressor
+        return decompressor
+
+    def encode(self, data):
+        return self._compressor().compress(data)
+
+    def decode(self, data):
+        return self._decompressor().decompress(data)
+
+
+CODECS = {codec.name: codec for codec in (RawCodec, ZlibCodec, ZstdCodec)}
+
+
+def make_codec(name, level=None, dictionary=None):
+    name = (name or "none").lower()
+    if name not in CODECS:
+        raise ValueError(f"Unknown cache compression '{name}'")
+    if name == "none":
+        return RawCodec()
+    if isinstance(dictionary, str):
+        with open(dictionary, "rb") as f:
+            dictionary = f.read()
+    return CODECS[name](level=level, dictionary=dictionary)
+
+
+def train_dictionary(name, samples, size=None):
+    if (name or "").lower() == "zstd":
+        import zstandard
+        return zstandard.train_dictionary(size or 64 * 1024, samples).as_bytes()
+    # zlib has no trainer, but a preset dictionary made of typical values
+    # already covers the repeated keys. Only its last 32KB are ever used.
+    size = min(size or 32 * 1024, 32 * 1024)
+    return b"".join(samples)[-size:]
+
+
+class ValueCodec:
+    def __init__(self, codec):
+        self.codec = codec
+        self._header = bytes((FORMAT_VERSION, codec.id)) + _DICTIONARY_ID.pack(codec.dictionary_id)
+        # zlib is always available, so rows written with it stay readable
+        self._decoders = {c.id: c for c in (RawCodec(), ZlibCodec(), codec)}
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = dict(
+                encoded=0, encoded_bytes_in=0, encoded_bytes_out=0, encode_seconds=0.0,
+                decoded=0, decoded_bytes_in=0, decoded_bytes_out=0, decode_seconds=0.0,
+                legacy_decoded=0,
+            )
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["codec"] = self.codec.name
+        stats["bytes_saved"] = stats["encoded_bytes_in"] - \
+            stats["encoded_bytes_out"]
+        stats["ratio"] = (
+            stats["encoded_bytes_in"] / stats["encoded_bytes_out"]
+            if stats["encoded_bytes_out"] else 0.0)
+        return stats
+
+    def encode(self, data):
+        start = perf_counter()
+        value = self._header + self.codec.encode(data)
+        elapsed = perf_counter() - start
+        with self._stats_lock:
+            self._stats["encoded"] += 1
+            self._stats["encoded_bytes_in"] += len(data)
+            self._stats["encoded_bytes_out"] += len(value)
+            self._stats["encode_seconds"] += elapsed
+        return value
+
+    def is_current(self, value):
+        return isinstance(value, bytes) and value[:len(self._header)] == self._header
+
+    def is_framed(self, value):
+        return isinstance(value, bytes) and len(value) > 1 and value[0] in FORMAT_VERSIONS
+
+    def _frame(self, value):
+        # (decoder, payload offset), checking the frame's dictionary id
+        decoder = self._decoders.get(value[1])
+        if decoder is None:
+            raise ValueError(f"Cache value uses unavailable codec {value[1]}")
+        if value[0] == 1:
+            return decoder, 2
+        stored_id, = _DICTIONARY_ID.unpack_from(value, 2)
+        if stored_id != decoder.dictionary_id:
+            raise DictionaryMismatch(
+                f"Cache value was compressed with dictionary {stored_id:08x}, "
+                f"but the {decoder.name} codec has {decoder.dictionary_id:08x}")
+        return decoder, 2 + _DICTIONARY_ID.size
+
+    def can_decode(self, value):
+        if not self.is_framed(value):
+            return False
+        try:
+            self._frame(value)
+        except (ValueError, struct.error):
+            return False
+        return True
+
+    def decode(self, value):
+        if isinstance(value, str):
+            # legacy json TEXT row
+            with self._stats_lock:
+                self._stats["legacy_decoded"] += 1
+            return value.encode()
+        if not self.is_framed(value):
+            # legacy pickled BLOB row
+            with self._stats_lock:
+                self._stats["legacy_decoded"] += 1
+            return value
+
+        start = perf_counter()
+        decoder, offset = self._frame(value)
+        data = decoder.decode(memoryview(value)[offset:])
+        elapsed = perf_counter() - start
+        with self._stats_lock:
+            self._stats["decoded"] += 1
+            self._stats["decoded_bytes_in"] += len(value)
+            self._stats["decoded_bytes_out"] += len(data)
+            self._stats["decode_seconds"] += elapsed
+        return data
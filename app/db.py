@@ -3,62 +3,185 @@ from flask_caching.backends.base import BaseCache
 from contextlib import contextmanager
 from time import time
 from functools import wraps
+from hashlib import md5
+from pathlib import Path
+from .compression import ValueCodec, make_codec
+import threading
 import sqlite3
 import logging
+import weakref
 import pickle
 import json
+import os
+
+
+class PooledConnection(sqlite3.Connection):
+    # plain sqlite3.Connection objects can't be weakly referenced
+    pass
 
 
 class SqliteCache(BaseCache):
     _CREATE_SQL = (
         'CREATE TABLE IF NOT EXISTS entries '
-        '( key TEXT PRIMARY KEY, val {}, exp FLOAT, updated FLOAT )'
+        '( key TEXT PRIMARY KEY, val BLOB, exp FLOAT, updated FLOAT, '
+        'accessed FLOAT, hits INTEGER NOT NULL DEFAULT 0 )'
+    )
+    # columns added after the first release, for older cache files
+    _MIGRATE_COLUMNS = (
+        ('accessed', 'FLOAT'),
+        ('hits', 'INTEGER NOT NULL DEFAULT 0'),
+    )
+    _MIGRATE_ACCESSED_SQL = 'UPDATE entries SET accessed = updated WHERE accessed IS NULL'
+    # the primary key is already indexed
+    _DROP_INDEX = 'DROP INDEX IF EXISTS keyname_index'
+    _CREATE_INDEXES = (
+        'CREATE INDEX IF NOT EXISTS exp_index ON entries (exp) WHERE exp > 0',
+        'CREATE INDEX IF NOT EXISTS updated_index ON entries (updated)',
+        'CREATE INDEX IF NOT EXISTS accessed_index ON entries (accessed)',
+        'CREATE INDEX IF NOT EXISTS hits_index ON entries (hits, accessed)',
     )
-    _CREATE_INDEX = 'CREATE INDEX IF NOT EXISTS keyname_index ON entries (key)'
     _HAS_SQL = 'SELECT      exp FROM entries WHERE key = ?'
     _GET_SQL = 'SELECT val, exp FROM entries WHERE key = ?'
     _HAS_MANY_SQL = 'SELECT key,      exp FROM entries WHERE key IN ({})'
     _GET_MANY_SQL = 'SELECT key, val, exp FROM entries WHERE key IN ({})'
     _DEL_SQL = 'DELETE FROM entries WHERE key = ?'
     _DEL_MANY_SQL = 'DELETE FROM entries WHERE key IN ({})'
-    _SET_SQL = 'INSERT OR REPLACE INTO entries (key, val, exp, updated) VALUES (?, ?, ?, ?)'
-    _SET_MANY_SQL = 'INSERT OR REPLACE INTO entries (key, val, exp, updated) VALUES {}'
-    _ADD_SQL = 'INSERT INTO entries (key, val, exp, updated) VALUES (?, ?, ?, ?)'
+    _SET_SQL = 'INSERT OR REPLACE INTO entries (key, val, exp, updated, accessed) VALUES (?, ?, ?, ?, ?)'
+    _ADD_SQL = 'INSERT INTO entries (key, val, exp, updated, accessed) VALUES (?, ?, ?, ?, ?)'
+    _TOUCH_SQL = 'UPDATE entries SET accessed = max(accessed, ?), hits = hits + ? WHERE key = ?'
+    _BATCH_SQL = 'SELECT rowid, key, val FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?'
+    _SET_VAL_SQL = 'UPDATE entries SET val = ? WHERE key = ?'
+    _SAMPLE_SQL = 'SELECT val FROM entries ORDER BY random() LIMIT ?'
+    _STORED_SIZE_SQL = 'SELECT COUNT(*), COALESCE(SUM(length(val)), 0) FROM entries'
+    _ROWS_SQL = (
+        'SELECT rowid, key, val, exp, updated, accessed, hits FROM entries '
+        'WHERE rowid > ? AND COALESCE(updated, 0) >= ? AND (exp <= 0 OR exp > ?) '
+        'ORDER BY rowid LIMIT ?'
+    )
+    _INSERT_ROWS_SQL = (
+        'INSERT {} INTO entries (key, val, exp, updated, accessed, hits) '
+        'VALUES (?, ?, ?, ?, ?, ?) {}'
+    )
+    # what to do with rows whose key is already stored
+    _MERGE_RULES = {
+        "replace": _INSERT_ROWS_SQL.format('OR REPLACE', ''),
+        "skip": _INSERT_ROWS_SQL.format('OR IGNORE', ''),
+        "newer": _INSERT_ROWS_SQL.format('', (
+            'ON CONFLICT(key) DO UPDATE SET val = excluded.val, exp = excluded.exp, '
+            'updated = excluded.updated, accessed = excluded.accessed '
+            'WHERE excluded.updated > COALESCE(entries.updated, 0)')),
+    }
     _CLEAR_SQL = 'DELETE FROM entries'
     _CLEAR_EXPIRED_SQL = 'DELETE FROM entries WHERE exp > 0 AND exp <= ?'
     _TOTAL_SIZE_SQL = 'SELECT page_count * page_size AS total_bytes FROM pragma_page_count, pragma_page_size'
+    # pages on the freelist are reused by new rows, so they don't count
+    _USED_SIZE_SQL = (
+        'SELECT (page_count - freelist_count) * page_size AS used_bytes '
+        'FROM pragma_page_count, pragma_freelist_count, pragma_page_size'
+    )
+    _EVICT_SQL = 'DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY {} LIMIT ?)'
+    _EVICT_SIZES_SQL = 'SELECT length(key) + length(val) FROM entries ORDER BY {}'
+    # eviction order for each policy, every one of them backed by an index
+    _EVICTION_ORDER = {
+        "lru": "accessed ASC",
+        "lfu": "hits ASC, accessed ASC",
+        "fifo": "updated ASC",
+    }
 
     _COUNT_ENTRIES_SQL = 'SELECT COUNT(*) FROM entries'
 
-    def __init__(self, path, default_timeout=0, threshold=0, max_size=0, logger=None, ignore_errors=False, use_json=False):
+    # Bulk lookups bind a fixed number of keys per statement, padded with
+    # NULLs. Any amount of keys takes a predictable number of executions, of
+    # statements that stay compiled in the connection's statement cache.
+    _MANY_CHUNK_SIZES = (16, 512)
+    _MANY_PLACEHOLDERS = {size: ','.join('?' * size) for size in _MANY_CHUNK_SIZES}
+
+    _SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def __init__(self, path, default_timeout=0, threshold=0, max_size=0, logger=None, ignore_errors=False, use_json=False,
+                 synchronous="NORMAL", mmap_size=0, cache_size=None,
+                 janitor_interval=60, janitor_writes=100, low_watermark=0.9,
+                 eviction="lru", access_batch=500,
+                 compression="zlib", compression_level=None, compression_dict=None, codec=None):
         BaseCache.__init__(self, default_timeout)
         self.path = path  # path of the database file
         self.threshold = threshold or 0  # maximum number of entries
         self.max_size = max_size or 0  # max size of the sqlite file in bytes
         self.mem_conn = None
         self.ignore_errors = ignore_errors
+        # connection pragmas, applied once for every pooled connection
+        self.synchronous = str(synchronous or "NORMAL").upper()
+        self.mmap_size = int(mmap_size or 0)
+        self.cache_size = cache_size
+        if self.synchronous not in self._SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid synchronous mode '{synchronous}'")
+        # one connection per thread, reused across calls
+        self._local = threading.local()
+        self._pool = weakref.WeakSet()
+        self._pool_lock = threading.Lock()
+        # eviction runs on a background thread, woken up every
+        # janitor_interval seconds or after janitor_writes writes.
+        # Once a limit is crossed, entries are evicted down to
+        # low_watermark * limit, so a single pass frees a useful amount.
+        self.janitor_interval = janitor_interval or 0
+        self.janitor_writes = janitor_writes or 0
+        self.low_watermark = min(max(float(low_watermark or 1), 0), 1)
+        self._janitor = None
+        self._janitor_pid = None
+        self._janitor_wake = threading.Event()
+        self._janitor_stop = threading.Event()
+        self._janitor_lock = threading.Lock()
+        self._pending_writes = 0
+        # reads are buffered in memory and flushed in batches by the janitor,
+        # so they never write to the database themselves
+        self.eviction = str(eviction or "lru").lower()
+        if self.eviction not in self._EVICTION_ORDER:
+            raise ValueError(f"Invalid eviction policy '{eviction}'")
+        self.access_batch = access_batch or 0
+        self._accesses = {}
+        self._accesses_lock = threading.Lock()
         self.use_json = use_json
         self.logger = logger or logging.getLogger(__name__)
 
+        # values are framed and compressed by the codec, see compression.py
+        self.codec = codec or ValueCodec(make_codec(
+            compression, compression_level, compression_dict))
+
         if self.use_json:
-            self._loader = lambda v: json.loads(v)
-            self._dumper = lambda v: json.dumps(v, ensure_ascii=False)
+            self._loader = lambda v: json.loads(self.codec.decode(v))
+            self._dumper = lambda v: self.codec.encode(
+                json.dumps(v, ensure_ascii=False).encode())
         else:
-            self._loader = lambda v: pickle.loads(v)
-            self._dumper = lambda v: pickle.dumps(
-                v, protocol=pickle.HIGHEST_PROTOCOL)
+            self._loader = lambda v: pickle.loads(self.codec.decode(v))
+            self._dumper = lambda v: self.codec.encode(pickle.dumps(
+                v, protocol=pickle.HIGHEST_PROTOCOL))
 
         with self.get_connection() as conn:
             self.logger.debug(f'Connected to "{self.path}"')
-            conn.execute(self._CREATE_SQL.format(
-                "TEXT" if use_json else "BLOB"))
-            conn.execute(self._CREATE_INDEX)
+            if self.path != ":memory:":
+                # readers never wait for the writer (persistent in the file)
+                conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(self._CREATE_SQL)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(entries)')}
+            for column, definition in self._MIGRATE_COLUMNS:
+                if column not in columns:
+                    conn.execute(
+                        f'ALTER TABLE entries ADD COLUMN {column} {definition}')
+            conn.execute(self._MIGRATE_ACCESSED_SQL)
+            conn.execute(self._DROP_INDEX)
+            for create_index in self._CREATE_INDEXES:
+                conn.execute(create_index)
             conn.commit()
             conn.execute('VACUUM')
 
     @classmethod
     def factory(cls, app, config, args, kwargs):
-        kwargs.update(dict(
+        kwargs.update(cls.config_kwargs(app, config))
+        return cls(*args, **kwargs)
+
+    @staticmethod
+    def config_kwargs(app, config):
+        return dict(
             logger=app.logger,
             path=config.get("CACHE_PATH"),
             default_timeout=config.get("CACHE_DEFAULT_TIMEOUT", None),
@@ -67,8 +190,18 @@ class SqliteCache(BaseCache):
             max_size=config.get("CACHE_MAX_SIZE", None),
             ignore_errors=config.get("CACHE_IGNORE_ERRORS", False),
             use_json=config.get("CACHE_USE_JSON", False),
-        ))
-        return cls(*args, **kwargs)
+            synchronous=config.get("CACHE_SYNCHRONOUS", "NORMAL"),
+            mmap_size=config.get("CACHE_MMAP_SIZE", 0),
+            cache_size=config.get("CACHE_CACHE_SIZE", None),
+            janitor_interval=config.get("CACHE_JANITOR_INTERVAL", 60),
+            janitor_writes=config.get("CACHE_JANITOR_WRITES", 100),
+            low_watermark=config.get("CACHE_LOW_WATERMARK", 0.9),
+            eviction=config.get("CACHE_EVICTION", "lru"),
+            access_batch=config.get("CACHE_ACCESS_BATCH", 500),
+            compression=config.get("CACHE_COMPRESSION", "zlib"),
+            compression_level=config.get("CACHE_COMPRESSION_LEVEL", None),
+            compression_dict=config.get("CACHE_COMPRESSION_DICT", None),
+        )
 
     def log_sqlite_errors(func):
         @wraps(func)
@@ -100,15 +233,42 @@ class SqliteCache(BaseCache):
                 yield self.mem_conn
             return
 
-        conn = None
-        try:
-            conn = sqlite3.connect(self.path, timeout=60)
-            conn.row_factory = sqlite3.Row
-            with conn:
-                yield conn
-        finally:
-            if conn:
-                conn.close()
+        conn = self._thread_connection()
+        with conn:
+            yield conn
+
+    def _thread_connection(self):
+        conn = getattr(self._local, "conn", None)
+        # connections must not be shared with a forked child
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        self._apply_pragmas(conn)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        with self._pool_lock:
+            self._pool.add(conn)
+        return conn
+
+    def _apply_pragmas(self, conn):
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA mmap_size={self.mmap_size}')
+        if self.cache_size is not None:
+            conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+
+    def close(self):
+        # pooled connections are reopened on demand after this
+        self.stop_janitor()
+        self.flush_accesses()
+        with self._pool_lock:
+            conns = list(self._pool)
+            self._pool.clear()
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
 
     @log_sqlite_errors
     def has(self, key):
@@ -123,13 +283,12 @@ class SqliteCache(BaseCache):
     @log_sqlite_errors
     def has_many(self, *keys):
         with self.get_connection() as conn:
-            cur = conn.execute(
-                self._HAS_MANY_SQL.format(','.join('?' * len(keys))), keys)
             results = []
-            for row in cur.fetchall():
-                key, exp = row
-                if exp == 0 or exp > time():
-                    results.append(key)
+            for cur in self._execute_many_keys(conn, self._HAS_MANY_SQL, keys):
+                for row in cur:
+                    key, exp = row
+                    if exp == 0 or exp > time():
+                        results.append(key)
             return results
 
     @log_sqlite_errors
@@ -140,35 +299,63 @@ class SqliteCache(BaseCache):
             if row:
                 value, exp = row
                 if exp == 0 or exp > time():
+                    self._note_accesses((key,))
                     return self._loader(value)
 
     @log_sqlite_errors
     def get_many(self, *keys):
         with self.get_connection() as conn:
-            cur = conn.execute(
-                self._GET_MANY_SQL.format(','.join('?' * len(keys))), keys)
             results = {}
-            for row in cur.fetchall():
-                key, value, exp = row
-                if exp == 0 or exp > time():
-                    results[key] = self._loader(value)
+            for cur in self._execute_many_keys(conn, self._GET_MANY_SQL, keys):
+                for row in cur:
+                    key, value, exp = row
+                    if exp == 0 or exp > time():
+                        results[key] = self._loader(value)
+            self._note_accesses(results)
+            return [results.get(key) for key in keys]
+
+    @log_sqlite_errors
+    def peek_many(self, *keys):
+        # get_many for maintenance, the reads don't count for the eviction
+        with self.get_connection() as conn:
+            results = {}
+            for cur in self._execute_many_keys(conn, self._GET_MANY_SQL, keys):
+                for row in cur:
+                    key, value, exp = row
+                    if exp == 0 or exp > time():
+                        results[key] = self._loader(value)
+            return [results.get(key) for key in keys]
+
+    @log_sqlite_errors
+    def get_many_raw(self, *keys):
+        # serialized values (json bytes) without parsing them
+        if not self.use_json:
+            raise TypeError("Raw values are only available with use_json")
+        with self.get_connection() as conn:
+            results = {}
+            for cur in self._execute_many_keys(conn, self._GET_MANY_SQL, keys):
+                for row in cur:
+                    key, value, exp = row
+                    if exp == 0 or exp > time():
+                        results[key] = self.codec.decode(value)
+            self._note_accesses(results)
             return [results.get(key) for key in keys]
 
     @log_sqlite_errors
     def delete(self, key):
         with self.get_connection() as conn:
             cur = conn.execute(self._DEL_SQL, (key,))
-            self.cleanup_full(conn)
-            return cur.rowcount > 0
+        self._note_writes(cur.rowcount)
+        return cur.rowcount > 0
 
     @log_sqlite_errors
     def delete_many(self, *keys):
         exists = self.has_many(*keys)
         with self.get_connection() as conn:
-            cur = conn.execute(
-                self._DEL_MANY_SQL.format(', '.join('?'*len(exists))), exists)
-            self.cleanup_full(conn)
-            return exists
+            for _ in self._execute_many_keys(conn, self._DEL_MANY_SQL, exists):
+                pass
+        self._note_writes(len(exists))
+        return exists
 
     @log_sqlite_errors
     def clear(self):
@@ -182,62 +369,167 @@ class SqliteCache(BaseCache):
     def add(self, key, value, timeout=None):
         timeout = self._normalize_timeout(timeout)
         exp = 0 if timeout == 0 else time() + timeout
-        with self.get_connection() as conn:
-            try:
+        try:
+            with self.get_connection() as conn:
+                now = time()
                 cur = conn.execute(
-                    self._ADD_SQL, (key, self._dumper(value), exp, time()))
-                self.cleanup_full(conn)
-                return cur.rowcount > 0
-            except sqlite3.IntegrityError:
-                return False
+                    self._ADD_SQL, (key, self._dumper(value), exp, now, now))
+        except sqlite3.IntegrityError:
+            return False
+        self._note_writes(1)
+        return cur.rowcount > 0
 
     @log_sqlite_errors
     def set(self, key, value, timeout=None):
         timeout = self._normalize_timeout(timeout)
         exp = 0 if timeout == 0 else time() + timeout
         with self.get_connection() as conn:
+            now = time()
             cur = conn.execute(
-                self._SET_SQL, (key, self._dumper(value), exp, time()))
-            self.cleanup_full(conn)
-            return cur.rowcount > 0
+                self._SET_SQL, (key, self._dumper(value), exp, now, now))
+        self._note_writes(1)
+        return cur.rowcount > 0
 
     @log_sqlite_errors
     def set_many(self, mapping, timeout=None):
         timeout = self._normalize_timeout(timeout)
         exp = 0 if timeout == 0 else time() + timeout
-        sql = self._SET_MANY_SQL.format(
-            ','.join(('(?, ?, ?, ?)',) * len(mapping)))
+        now = time()
         args = [
-            item
+            (key, self._dumper(value), exp, now, now)
             for key, value in mapping.items()
-            for item in (key, self._dumper(value), exp, time())
         ]
         with self.get_connection() as conn:
-            conn.execute(sql, args)
-            self.cleanup_full(conn)
-            return list(mapping.keys())
+            conn.executemany(self._SET_SQL, args)
+        self._note_writes(len(mapping))
+        return list(mapping.keys())
+
+    def _execute_many_keys(self, conn, sql, keys):
+        keys = tuple(dict.fromkeys(keys))
+        size = next(
+            (size for size in self._MANY_CHUNK_SIZES if len(keys) <= size),
+            self._MANY_CHUNK_SIZES[-1])
+        sql = sql.format(self._MANY_PLACEHOLDERS[size])
+        for i in range(0, len(keys), size):
+            chunk = keys[i:i + size]
+            yield conn.execute(sql, chunk + (None,) * (size - len(chunk)))
+
+    def _note_writes(self, count):
+        if not (self.threshold or self.max_size):
+            return
+        if not (self.janitor_interval or self.janitor_writes):
+            # no janitor configured, keep the limits on every write
+            self.cleanup_full()
+            return
+        self._ensure_janitor()
+        with self._janitor_lock:
+            self._pending_writes += count
+            if self.janitor_writes and self._pending_writes >= self.janitor_writes:
+                self._pending_writes = 0
+                self._janitor_wake.set()
+
+    def _note_accesses(self, keys):
+        if not (self.threshold or self.max_size) or self.eviction == "fifo":
+            return  # nothing would ever read them
+        now = time()
+        with self._accesses_lock:
+            for key in keys:
+                access = self._accesses.get(key)
+                if access is None:
+                    self._accesses[key] = [now, 1]
+                else:
+                    access[0] = now
+                    access[1] += 1
+            full = self.access_batch and len(self._accesses) >= self.access_batch
+        if full and (self.janitor_interval or self.janitor_writes):
+            self._ensure_janitor()
+            self._janitor_wake.set()
+
+    @log_sqlite_errors
+    def flush_accesses(self, conn=None):
+        if not self._accesses:
+            return 0
+        if conn is None:
+            with self.get_connection() as conn:
+                return self.flush_accesses(conn)
+        with self._accesses_lock:
+            accesses, self._accesses = self._accesses, {}
+        conn.executemany(self._TOUCH_SQL, (
+            (accessed, hits, key) for key, (accessed, hits) in accesses.items()
+        ))
+        return len(accesses)
+
+    def _ensure_janitor(self):
+        if self._janitor is not None and self._janitor_pid == os.getpid():
+            return
+        with self._janitor_lock:
+            # threads don't survive a fork, so start a new one in the child
+            if self._janitor is not None and self._janitor_pid == os.getpid():
+                return
+            self._janitor_stop.clear()
+            self._janitor = threading.Thread(
+                target=self._janitor_loop, name="sqlite-cache-janitor", daemon=True)
+            self._janitor_pid = os.getpid()
+            self._janitor.start()
+
+    def _janitor_loop(self):
+        while not self._janitor_stop.is_set():
+            self._janitor_wake.wait(self.janitor_interval or None)
+            self._janitor_wake.clear()
+            if self._janitor_stop.is_set():
+                break
+            try:
+                self.run_maintenance()
+            except Exception as e:
+                self.logger.error(f"Cache maintenance failed: {e}")
+
+    def stop_janitor(self):
+        janitor = self._janitor
+        if janitor is None:
+            return
+        self._janitor_stop.set()
+        self._janitor_wake.set()
+        if janitor is not threading.current_thread() and self._janitor_pid == os.getpid():
+            janitor.join()
+        self._janitor = None
+
+    def run_maintenance(self):
+        start = time()
+        with self.get_connection() as conn:
+            self.flush_accesses(conn)
+            expired = self.cleanup_expired(conn) or 0
+            by_count = self.cleanup_threshold(conn) or 0
+            by_size = self.cleanup_max_size(conn) or 0
+        evicted = expired + by_count + by_size
+        elapsed = (time() - start) * 1000
+        log = self.logger.info if evicted else self.logger.debug
+        log(f"Cache maintenance evicted {evicted} rows ({expired} expired, "
+            f"{by_count} over threshold, {by_size} over max size) in {elapsed:.1f}ms")
+        return evicted
 
     @log_sqlite_errors
     def cleanup_full(self, conn=None):
         if conn is None:
             with self.get_connection() as conn:
                 return self.cleanup_full(conn)
-        self.cleanup_expired(conn)
-        self.cleanup_threshold(conn)
-        self.cleanup_max_size(conn)
+        self.flush_accesses(conn)
+        return (
+            (self.cleanup_expired(conn) or 0) +
+            (self.cleanup_threshold(conn) or 0) +
+            (self.cleanup_max_size(conn) or 0)
+        )
 
     @log_sqlite_errors
     def cleanup_expired(self, conn=None):
         if conn is None:
             with self.get_connection() as conn:
-                conn.execute(self._CLEAR_EXPIRED_SQL, (time(),))
-        else:
-            conn.execute(self._CLEAR_EXPIRED_SQL, (time(),))
+                return self.cleanup_expired(conn)
+        return conn.execute(self._CLEAR_EXPIRED_SQL, (time(),)).rowcount
 
     @log_sqlite_errors
     def cleanup_threshold(self, conn=None):
         if not self.threshold:
-            return True
+            return 0
 
         if conn is None:
             with self.get_connection() as conn:
@@ -246,47 +538,282 @@ class SqliteCache(BaseCache):
         current_count = conn.execute(self._COUNT_ENTRIES_SQL).fetchone()[0]
 
         if current_count <= self.threshold:
-            return True  # Nothing to clear
+            return 0  # Nothing to clear
 
-        excess_count = max(0, current_count - self.threshold)
-
-        # Get the oldest entries with exp > 0
-        cur = conn.execute(
-            'SELECT key FROM entries ORDER BY updated ASC LIMIT ?',
-            (excess_count,),
-        )
-        rows = cur.fetchall()
+        # evict down to the low watermark, not just below the limit
+        target = int(self.threshold * self.low_watermark)
+        excess_count = max(0, current_count - target)
 
-        # Delete all the identified entries in a single query
-        keys = tuple(row[0] for row in rows)
-        conn.execute(self._DEL_MANY_SQL.format(','.join('?'*len(keys))), keys)
-
-        return True
+        return self._evict(conn, excess_count)
 
     @log_sqlite_errors
     def cleanup_max_size(self, conn=None):
         if not self.max_size:
-            return True
+            return 0
 
         if conn is None:
             with self.get_connection() as conn:
                 return self.cleanup_max_size(conn)
 
-        total_size = conn.execute(self._TOTAL_SIZE_SQL).fetchone()[0]
+        used_size = conn.execute(self._USED_SIZE_SQL).fetchone()[0]
+
+        if used_size <= self.max_size:
+            return 0
+
+        # rows only approximate their pages, but freed pages are reused,
+        # so the next pass corrects any difference
+        to_free = used_size - int(self.max_size * self.low_watermark)
+        excess_count = 0
+        # the cursor is stepped lazily, so only the evicted rows are read
+        order = self._EVICTION_ORDER[self.eviction]
+        for entry_size, in conn.execute(self._EVICT_SIZES_SQL.format(order)):
+            excess_count += 1
+            to_free -= entry_size
+            if to_free <= 0:
+                break
 
-        while total_size > self.max_size:
-            # Get the 10 oldest entries with exp > 0
-            cur = conn.execute(
-                'SELECT key, length(val) FROM entries ORDER BY updated ASC LIMIT 10'
-            )
-            entries = cur.fetchall()
+        return self._evict(conn, excess_count)
 
-            if not entries:
-                break
+    def _evict(self, conn, count):
+        order = self._EVICTION_ORDER[self.eviction]
+        return conn.execute(self._EVICT_SQL.format(order), (count,)).rowcount
+
+    @log_sqlite_errors
+    def compression_stats(self):
+        with self.get_connection() as conn:
+            rows, stored_bytes = conn.execute(self._STORED_SIZE_SQL).fetchone()
+        stats = self.codec.stats()
+        stats.update(rows=rows, stored_bytes=stored_bytes)
+        return stats
+
+    @log_sqlite_errors
+    def sample_values(self, count):
+        # decoded (uncompressed) values, e.g. to train a dictionary
+        with self.get_connection() as conn:
+            rows = conn.execute(self._SAMPLE_SQL, (count,)).fetchall()
+        return [self.codec.decode(val) for val, in rows]
+
+    @log_sqlite_errors
+    def recompress(self, batch_size=500):
+        # rewrite rows stored by older formats or codecs with the current one
+        last_rowid, rewritten = 0, 0
+        while True:
+            with self.get_connection() as conn:
+                rows = conn.execute(
+                    self._BATCH_SQL, (last_rowid, batch_size)).fetchall()
+                if not rows:
+                    return rewritten
+                updates = [
+                    (self.codec.encode(self.codec.decode(val)), key)
+                    for _, key, val in rows if not self.codec.is_current(val)
+                ]
+                conn.executemany(self._SET_VAL_SQL, updates)
+            last_rowid = rows[-1][0]
+            rewritten += len(updates)
+
+    @log_sqlite_errors
+    def iter_rows(self, batch_size=1000, since=None):
+        # unexpired rows as stored: (key, val, exp, updated, accessed, hits)
+        last_rowid, now = 0, time()
+        while True:
+            with self.get_connection() as conn:
+                rows = conn.execute(
+                    self._ROWS_SQL, (last_rowid, since or 0, now, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)[1:]
+            last_rowid = rows[-1][0]
+
+    @log_sqlite_errors
+    def insert_rows(self, rows, merge="replace"):
+        # one transaction for all the rows, returns how many were written
+        if merge not in self._MERGE_RULES:
+            raise ValueError(f"Invalid merge rule '{merge}'")
+        with self.get_connection() as conn:
+            written = conn.executemany(self._MERGE_RULES[merge], rows).rowcount
+        self._note_writes(written)
+        return written
+
+
+def shard_paths(path, shards):
+    path = Path(path)
+    return [
+        str(path.with_name(f"{path.stem}.{i}-of-{shards}{path.suffix}"))
+        for i in range(shards)
+    ]
+
+
+def shard_index(key, shards):
+    # by the MD5 key's prefix, its digits are evenly spread already
+    try:
+        return int(key[:8], 16) % shards
+    except ValueError:
+        return int(md5(key.encode()).hexdigest()[:8], 16) % shards
+
+
+class ShardedSqliteCache(BaseCache):
+    # Spreads the keys across N SqliteCache files, each with its own writer
+    # lock. With "global" limits the threshold and max size are split evenly
+    # between the shards, with "per_shard" each shard gets the full limits.
+    _SHARD_LIMITS = ("global", "per_shard")
+
+    def __init__(self, path, shards=4, shard_limits="global", default_timeout=0,
+                 threshold=0, max_size=0, logger=None, compression="zlib",
+                 compression_level=None, compression_dict=None, **kwargs):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.shard_count = int(shards)
+        if self.shard_count < 1:
+            raise ValueError("A sharded cache needs at least one shard")
+        self.shard_limits = shard_limits
+        if self.shard_limits not in self._SHARD_LIMITS:
+            raise ValueError(f"Invalid shard limits '{shard_limits}'")
+        if self.shard_limits == "global":
+            threshold = (threshold or 0) // self.shard_count
+            max_size = (max_size or 0) // self.shard_count
+        self.logger = logger or logging.getLogger(__name__)
+        # one codec for every shard, so its stats cover the whole cache
+        self.codec = ValueCodec(make_codec(
+            compression, compression_level, compression_dict))
+        self.shards = [
+            SqliteCache(
+                shard_path, default_timeout, threshold=threshold, max_size=max_size,
+                logger=self.logger, codec=self.codec, **kwargs)
+            for shard_path in shard_paths(path, self.shard_count)
+        ]
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(SqliteCache.config_kwargs(app, config))
+        kwargs.update(
+            shards=config.get("CACHE_SHARDS", 4),
+            shard_limits=config.get("CACHE_SHARD_LIMITS", "global"),
+        )
+        return cls(*args, **kwargs)
+
+    @property
+    def use_json(self):
+        return self.shards[0].use_json
+
+    def shard(self, key):
+        return self.shards[shard_index(key, self.shard_count)]
+
+    def _group(self, keys):
+        groups = {}
+        for key in dict.fromkeys(keys):
+            groups.setdefault(shard_index(key, self.shard_count), []).append(key)
+        return ((self.shards[i], shard_keys) for i, shard_keys in groups.items())
+
+    def has(self, key):
+        return self.shard(key).has(key)
 
-            for key, value_size in entries:
-                conn.execute(self._DEL_SQL, (key,))
-                total_size -= value_size
-                if not total_size > self.max_size:
-                    break
-        return True
+    def get(self, key):
+        return self.shard(key).get(key)
+
+    def set(self, key, value, timeout=None):
+        return self.shard(key).set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.shard(key).add(key, value, timeout)
+
+    def delete(self, key):
+        return self.shard(key).delete(key)
+
+    def has_many(self, *keys):
+        results = []
+        for shard, shard_keys in self._group(keys):
+            results.extend(shard.has_many(*shard_keys))
+        return results
+
+    def _get_many(self, method, keys):
+        results = {}
+        for shard, shard_keys in self._group(keys):
+            results.update(zip(shard_keys, getattr(shard, method)(*shard_keys)))
+        return [results.get(key) for key in keys]
+
+    def get_many(self, *keys):
+        return self._get_many("get_many", keys)
+
+    def get_many_raw(self, *keys):
+        return self._get_many("get_many_raw", keys)
+
+    def peek_many(self, *keys):
+        return self._get_many("peek_many", keys)
+
+    def delete_many(self, *keys):
+        deleted = []
+        for shard, shard_keys in self._group(keys):
+            deleted.extend(shard.delete_many(*shard_keys) or ())
+        return deleted
+
+    def set_many(self, mapping, timeout=None):
+        for shard, shard_keys in self._group(mapping):
+            shard.set_many({key: mapping[key] for key in shard_keys}, timeout)
+        return list(mapping)
+
+    def clear(self):
+        return all([shard.clear() for shard in self.shards])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def run_maintenance(self):
+        return sum(shard.run_maintenance() or 0 for shard in self.shards)
+
+    def compression_stats(self):
+        stats = self.codec.stats()
+        shard_stats = [shard.compression_stats() for shard in self.shards]
+        stats.update(
+            rows=sum(shard["rows"] for shard in shard_stats),
+            stored_bytes=sum(shard["stored_bytes"] for shard in shard_stats),
+            shards=[{"rows": shard["rows"], "stored_bytes": shard["stored_bytes"]}
+                    for shard in shard_stats],
+        )
+        return stats
+
+    def sample_values(self, count):
+        per_shard = -(-count // self.shard_count)
+        return [
+            value for shard in self.shards
+            for value in shard.sample_values(per_shard)
+        ][:count]
+
+    def recompress(self, batch_size=500):
+        return sum(shard.recompress(batch_size) or 0 for shard in self.shards)
+
+    def iter_rows(self, batch_size=1000, since=None):
+        for shard in self.shards:
+            yield from shard.iter_rows(batch_size, since)
+
+    def insert_rows(self, rows, merge="replace"):
+        groups = {}
+        for row in rows:
+            groups.setdefault(shard_index(row[0], self.shard_count), []).append(row)
+        return sum(
+            self.shards[i].insert_rows(group, merge) or 0
+            for i, group in groups.items())
+
+
+def reshard(source_paths, path, shards, batch_size=10_000, logger=None):
+    # offline copy of the stored rows into a new sharded layout,
+    # values are copied as stored, without decoding them
+    logger = logger or logging.getLogger(__name__)
+    target = ShardedSqliteCache(
+        path, shards, janitor_interval=0, janitor_writes=0, logger=logger)
+    copied = 0
+    for source_path in source_paths:
+        source = SqliteCache(
+            source_path, janitor_interval=0, janitor_writes=0, logger=logger)
+        batch = []
+        for row in source.iter_rows(batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                copied += target.insert_rows(batch)
+                batch = []
+        copied += target.insert_rows(batch)
+        source.close()
+        logger.info(f'Copied "{source_path}" into {shards} shards')
+    target.close()
+    return copied
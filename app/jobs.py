@@ -0,0 +1,459 @@
+from concurrent.futures import Future
+from hashlib import md5
+from pathlib import Path
+from time import time
+import threading
+import tempfile
+import shutil
+import uuid
+import sqlite3
+import logging
+import socket
+import os
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class SpoolError(ValueError):
+    # the upload was discarded
+    pass
+
+
+class UploadTooLarge(SpoolError):
+    pass
+
+
+class UploadEmpty(SpoolError):
+    pass
+
+
+class UploadHashMismatch(SpoolError):
+    pass
+
+
+class JobStore:
+    # Keeps the OCR jobs and their uploaded images on disk, so queued pages
+    # survive restarts. Images are spooled to spool_dir, named by their hash.
+    # The store is shared by every process serving the app: a job is run by
+    # the process that claimed it, which renews its lease while it's alive.
+    # Jobs whose lease expired are adopted by another process. Jobs claimed
+    # with local=False have no owner until an OCR worker node leases them.
+    _CREATE_SQL = (
+        'CREATE TABLE IF NOT EXISTS jobs '
+        '( key TEXT PRIMARY KEY, name TEXT, path TEXT, state TEXT NOT NULL, '
+        'client TEXT, priority INTEGER NOT NULL DEFAULT 0, '
+        'created FLOAT, updated FLOAT, error TEXT, owner TEXT, lease FLOAT, '
+        'attempts INTEGER NOT NULL DEFAULT 0, size INTEGER NOT NULL DEFAULT 0 )'
+    )
+    _MIGRATE_COLUMNS = {
+        "owner": 'ALTER TABLE jobs ADD COLUMN owner TEXT',
+        "lease": 'ALTER TABLE jobs ADD COLUMN lease FLOAT',
+        "attempts": 'ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0',
+        "size": 'ALTER TABLE jobs ADD COLUMN size INTEGER NOT NULL DEFAULT 0',
+    }
+    _CREATE_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created)'
+    # every state change of a job, followed by the batches of its page
+    _CREATE_EVENTS_SQL = (
+        'CREATE TABLE IF NOT EXISTS events '
+        '( seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, state TEXT NOT NULL, '
+        'error TEXT, time FLOAT )'
+    )
+    _CREATE_EVENTS_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS events_key ON events (key, seq)'
+    # the pages of an upload, state is set for those that weren't queued
+    _CREATE_BATCHES_SQL = (
+        'CREATE TABLE IF NOT EXISTS batches '
+        '( batch TEXT NOT NULL, key TEXT NOT NULL, name TEXT, state TEXT, error TEXT, '
+        'created FLOAT, PRIMARY KEY (batch, key) )'
+    )
+    _EVENT_SQL = 'INSERT INTO events (key, state, error, time) VALUES (?, ?, ?, ?)'
+    _BATCH_SQL = 'INSERT OR REPLACE INTO batches (batch, key, name, state, error, created) VALUES (?, ?, ?, ?, ?, ?)'
+    _LAST_EVENT_SQL = 'SELECT COALESCE(MAX(seq), 0) FROM events'
+    _BATCH_PAGES_SQL = (
+        'SELECT b.key, b.name, COALESCE(b.state, j.state), COALESCE(b.error, j.error) '
+        'FROM batches b LEFT JOIN jobs j ON j.key = b.key WHERE b.batch = ?'
+    )
+    _BATCH_EVENTS_SQL = (
+        'SELECT e.seq, e.key, b.name, e.state, e.error FROM events e '
+        'JOIN batches b ON b.key = e.key AND b.batch = ? AND b.state IS NULL '
+        'WHERE e.seq > ? ORDER BY e.seq LIMIT ?'
+    )
+    _PURGE_EVENTS_SQL = 'DELETE FROM events WHERE time < ?'
+    _PURGE_BATCHES_SQL = 'DELETE FROM batches WHERE created < ?'
+    # inserts the job, or takes over a finished one or one nobody renews
+    _CLAIM_SQL = (
+        'INSERT INTO jobs (key, name, path, state, client, priority, created, updated, owner, lease, size) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(key) DO UPDATE SET name = excluded.name, path = excluded.path, '
+        'state = excluded.state, client = excluded.client, priority = excluded.priority, '
+        'created = excluded.created, updated = excluded.updated, error = NULL, '
+        'owner = excluded.owner, lease = excluded.lease, attempts = 0, size = excluded.size '
+        'WHERE jobs.state IN (?, ?) OR (jobs.owner IS NOT NULL AND jobs.lease < excluded.updated)'
+    )
+    _MARK_SQL = 'UPDATE jobs SET state = ?, updated = ?, error = ? WHERE key = ?'
+    _RENEW_SQL = 'UPDATE jobs SET lease = ? WHERE owner = ? AND state IN (?, ?)'
+    _RENEW_KEY_SQL = _RENEW_SQL + ' AND key = ?'
+    _ADOPT_SQL = (
+        'UPDATE jobs SET owner = ?, lease = ? '
+        'WHERE key = ? AND state IN (?, ?) AND COALESCE(lease, 0) < ?'
+    )
+    # leases the next job to an OCR worker node, retrying the ones whose
+    # worker stopped renewing them
+    _LEASE_SQL = (
+        'UPDATE jobs SET state = ?, updated = ?, owner = ?, lease = ?, attempts = attempts + 1 '
+        'WHERE key = ? AND state IN (?, ?) AND (owner IS NULL OR lease < ?)'
+    )
+    _SELECT_SQL = (
+        'SELECT key, name, path, state, client, priority, created, updated, error, owner, lease, '
+        'attempts FROM jobs '
+    )
+    _GET_SQL = _SELECT_SQL + 'WHERE key = ?'
+    _EXPIRED_SQL = _SELECT_SQL + 'WHERE state IN (?, ?) AND COALESCE(lease, 0) < ? ORDER BY created'
+    _LEASABLE_SQL = _SELECT_SQL + (
+        'WHERE state IN (?, ?) AND (owner IS NULL OR lease < ?) '
+        'ORDER BY priority, created LIMIT 8'
+    )
+    _QUEUED_SQL = 'SELECT key FROM jobs WHERE state IN (?, ?) AND key IN ({})'
+    _FINISHED_SQL = 'SELECT key, name, error FROM jobs WHERE state IN (?, ?) AND key IN ({})'
+    _SPOOLED_SQL = 'SELECT path FROM jobs WHERE state IN (?, ?)'
+    _PURGE_SQL = 'DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?'
+    _COUNT_SQL = 'SELECT state, COUNT(*) FROM jobs GROUP BY state'
+    _LOAD_SQL = (
+        'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(client = ?), 0) '
+        'FROM jobs WHERE state IN (?, ?)'
+    )
+    _FINISHED_SINCE_SQL = 'SELECT COUNT(*) FROM events WHERE state IN (?, ?) AND time > ?'
+    _COLUMNS = ("key", "name", "path", "state", "client", "priority", "created", "updated", "error",
+                "owner", "lease", "attempts")
+    _MAX_VARIABLES = 500
+
+    def __init__(self, path=None, spool_dir=None, lease_seconds=30, logger=None, max_attempts=3,
+                 sources_dir=None):
+        self.path = path or ":memory:"
+        self.spool_dir = Path(spool_dir or tempfile.mkdtemp(prefix="mokuro_spool_")).resolve()
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        # where the images of the OCR'd pages are kept, None deletes them
+        self.sources_dir = Path(sources_dir).resolve() if sources_dir else None
+        if self.sources_dir:
+            self.sources_dir.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts  # leases of a job before it fails
+        self.logger = logger or logging.getLogger(__name__)
+        # job writes are a few per page, one connection per process is enough
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(self._CREATE_SQL)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, sql in self._MIGRATE_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(sql)
+            conn.execute(self._CREATE_INDEX_SQL)
+            conn.execute(self._CREATE_EVENTS_SQL)
+            conn.execute(self._CREATE_EVENTS_INDEX_SQL)
+            conn.execute(self._CREATE_BATCHES_SQL)
+        self._watched = {}  # key -> futures of the jobs run by other processes
+        self._wake = threading.Event()
+        self._closed = False
+        self._heartbeat = None
+        self._heartbeat_pid = None
+        self.on_adopt = None  # called with the jobs adopted by the heartbeat
+
+    @property
+    def owner(self):
+        # not cached, the app may be forked after it was created
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _row(self, row):
+        return dict(zip(self._COLUMNS, row)) if row else None
+
+    def _select_keys(self, sql, keys, *params):
+        keys = list(keys)
+        rows = []
+        with self._lock:
+            for i in range(0, len(keys), self._MAX_VARIABLES):
+                chunk = keys[i:i + self._MAX_VARIABLES]
+                rows.extend(self._conn.execute(
+                    sql.format(','.join('?' * len(chunk))), (*params, *chunk)))
+        return rows
+
+    def spool(self, key, data, max_size=None, verify=False):
+        # data is bytes or an iterable of chunks, written as they come next
+        # to its final name and renamed, never half written. With verify the
+        # key must be the md5 of the data.
+        path = self.spool_dir / key
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.part")
+        digest = md5()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in [data] if isinstance(data, bytes) else data:
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise UploadTooLarge(f"The upload is larger than {max_size} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if not size:
+                raise UploadEmpty("The upload is empty")
+            if verify and digest.hexdigest() != key:
+                raise UploadHashMismatch("The upload doesn't match its hash")
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        return str(path)
+
+    def claim(self, key, name, path, client=None, priority=0, local=True):
+        # True if the job was queued, False if another process has it. Local
+        # jobs are run by this process, the others by OCR worker nodes.
+        self.start_heartbeat()
+        now = time()
+        owner, lease = (self.owner, now + self.lease_seconds) if local else (None, None)
+        try:
+            size = os.path.getsize(path) if path else 0
+        except OSError:
+            size = 0
+        with self._lock, self._conn as conn:
+            claimed = conn.execute(self._CLAIM_SQL, (
+                key, name, path, PENDING, client, priority, now, now,
+                owner, lease, size, DONE, FAILED)).rowcount > 0
+            if claimed:
+                conn.execute(self._EVENT_SQL, (key, PENDING, None, now))
+            return claimed
+
+    def lease(self, worker):
+        # the next job for an OCR worker node, or None if there's none
+        while True:
+            now = time()
+            with self._lock:
+                rows = self._conn.execute(self._LEASABLE_SQL, (PENDING, RUNNING, now)).fetchall()
+            if not rows:
+                return None
+            for job in map(self._row, rows):
+                if job["attempts"] >= self.max_attempts:
+                    self.finish(job["key"], f"OCR failed {job['attempts']} times")
+                    continue
+                with self._lock, self._conn as conn:
+                    taken = conn.execute(self._LEASE_SQL, (
+                        RUNNING, now, worker, now + self.lease_seconds,
+                        job["key"], PENDING, RUNNING, now)).rowcount
+                    if taken:
+                        conn.execute(self._EVENT_SQL, (job["key"], RUNNING, None, now))
+                if taken:
+                    job.update(state=RUNNING, owner=worker, lease=now + self.lease_seconds,
+                               attempts=job["attempts"] + 1)
+                    return job
+
+    def renew(self, key, worker):
+        # False if the job isn't leased to worker anymore
+        with self._lock, self._conn as conn:
+            return conn.execute(self._RENEW_KEY_SQL, (
+                time() + self.lease_seconds, worker, PENDING, RUNNING, key)).rowcount > 0
+
+    def get(self, key):
+        with self._lock:
+            return self._row(self._conn.execute(self._GET_SQL, (key,)).fetchone())
+
+    def mark(self, key, state, error=None):
+        now = time()
+        with self._lock, self._conn as conn:
+            conn.execute(self._MARK_SQL, (state, now, error, key))
+            conn.execute(self._EVENT_SQL, (key, state, error, now))
+
+    def finish(self, key, error=None):
+        job = self.get(key)
+        if job and job["path"]:
+            if self.sources_dir and not error and Path(job["path"]).is_file():
+                shutil.move(job["path"], self.sources_dir / key)
+            else:
+                Path(job["path"]).unlink(missing_ok=True)
+        self.mark(key, FAILED if error else DONE, error)
+
+    def respool(self, key):
+        # spools the kept image of an OCR'd page again, None if it isn't kept
+        # or the page is spooled already
+        if not self.sources_dir or not (self.sources_dir / key).is_file():
+            return None
+        path = self.spool_dir / key
+        try:
+            os.link(self.sources_dir / key, path)
+        except FileExistsError:
+            return None
+        except OSError:
+            # another filesystem
+            shutil.copyfile(self.sources_dir / key, path)
+        return str(path)
+
+    def queued(self, keys):
+        # the keys pending or running in any process
+        return {row[0] for row in self._select_keys(self._QUEUED_SQL, keys, PENDING, RUNNING)}
+
+    def adopt_expired(self):
+        # takes over the unfinished jobs nobody renews, left by the last
+        # run or by a process that died
+        now = time()
+        with self._lock:
+            rows = self._conn.execute(self._EXPIRED_SQL, (PENDING, RUNNING, now)).fetchall()
+        adopted = []
+        for job in map(self._row, rows):
+            with self._lock, self._conn as conn:
+                taken = conn.execute(self._ADOPT_SQL, (
+                    self.owner, now + self.lease_seconds, job["key"], PENDING, RUNNING, now)).rowcount
+            if taken:
+                adopted.append(job)
+        if adopted:
+            self.start_heartbeat()
+        return adopted
+
+    def create_batch(self, pages):
+        # pages is {key: (name, state, error)}, state None for the queued
+        # ones, which follow their job. Returns the batch id.
+        batch = uuid.uuid4().hex
+        now = time()
+        with self._lock, self._conn as conn:
+            conn.executemany(self._BATCH_SQL, (
+                (batch, key, name, state, error, now)
+                for key, (name, state, error) in pages.items()))
+        return batch
+
+    def batch(self, batch):
+        # ({key: {"name", "state", "error"}}, last event id), or None for an
+        # unknown batch. Events after that id may already show in the pages.
+        with self._lock:
+            last_event = self._conn.execute(self._LAST_EVENT_SQL).fetchone()[0]
+            rows = self._conn.execute(self._BATCH_PAGES_SQL, (batch,)).fetchall()
+        if not rows:
+            return None
+        return {key: dict(name=name, state=state, error=error)
+                for key, name, state, error in rows}, last_event
+
+    def batch_events(self, batch, after=0, limit=500):
+        with self._lock:
+            rows = self._conn.execute(self._BATCH_EVENTS_SQL, (batch, after, limit)).fetchall()
+        return [dict(id=seq, key=key, name=name, state=state, error=error)
+                for seq, key, name, state, error in rows]
+
+    def watch(self, key):
+        # a future for a job run by another process, resolved with
+        # (key, name, {"error": ...} or {}) once it finishes
+        self.start_heartbeat()
+        future = Future()
+        with self._lock:
+            self._watched.setdefault(key, []).append(future)
+        self._wake.set()
+        return future
+
+    def _check_watched(self):
+        with self._lock:
+            keys = list(self._watched)
+        if not keys:
+            return
+        for key, name, error in self._select_keys(self._FINISHED_SQL, keys, DONE, FAILED):
+            with self._lock:
+                futures = self._watched.pop(key, [])
+            for future in futures:
+                future.set_result((key, name, {"error": error} if error else {}))
+
+    def start_heartbeat(self):
+        if self._heartbeat is not None and self._heartbeat_pid == os.getpid():
+            return
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat = threading.Thread(
+                target=self._heartbeat_loop, name="ocr-jobs-heartbeat", daemon=True)
+            self._heartbeat_pid = os.getpid()
+            self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        # renews our leases and adopts the expired jobs every third of a
+        # lease, and polls the watched jobs twice a second
+        interval = max(self.lease_seconds / 3, 0.1)
+        next_renew = 0
+        while not self._closed:
+            try:
+                if time() >= next_renew:
+                    next_renew = time() + interval
+                    with self._lock, self._conn as conn:
+                        conn.execute(self._RENEW_SQL, (
+                            time() + self.lease_seconds, self.owner, PENDING, RUNNING))
+                    if self.on_adopt is not None:
+                        adopted = self.adopt_expired()
+                        if adopted:
+                            self.on_adopt(adopted)
+                self._check_watched()
+            except Exception as e:
+                if not self._closed:
+                    self.logger.error(f"OCR jobs heartbeat failed: {e}")
+            self._wake.wait(0.5 if self._watched else interval)
+            self._wake.clear()
+
+    def collect_garbage(self, keep_finished=86400, keep_spooled=3600):
+        # forget old finished jobs and delete the spooled images no job
+        # needs, unless recent: they may be uploads not yet claimed
+        with self._lock, self._conn as conn:
+            purged = conn.execute(
+                self._PURGE_SQL, (DONE, FAILED, time() - keep_finished)).rowcount
+            conn.execute(self._PURGE_EVENTS_SQL, (time() - keep_finished,))
+            conn.execute(self._PURGE_BATCHES_SQL, (time() - keep_finished,))
+            spooled = {row[0] for row in conn.execute(self._SPOOLED_SQL, (PENDING, RUNNING))}
+        removed = 0
+        for path in self.spool_dir.iterdir():
+            if str(path) in spooled:
+                continue
+            try:
+                if path.stat().st_mtime < time() - keep_spooled:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if purged or removed:
+            self.logger.info(f"Purged {purged} finished jobs and {removed} orphaned spool files")
+        return purged, removed
+
+    def prune_sources(self, has_many, batch_size=500):
+        # deletes the kept images of the pages evicted from the cache,
+        # has_many(*keys) returns the cached ones
+        if not self.sources_dir:
+            return 0
+        removed = 0
+        paths = [path for path in self.sources_dir.iterdir() if path.is_file()]
+        for start in range(0, len(paths), batch_size):
+            batch = {path.name: path for path in paths[start:start + batch_size]}
+            evicted = set(batch) - set(has_many(*batch)) - self.queued(batch)
+            for key in evicted:
+                batch[key].unlink(missing_ok=True)
+            removed += len(evicted)
+        if removed:
+            self.logger.info(f"Deleted {removed} kept images of pages no longer cached")
+        return removed
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute(self._COUNT_SQL).fetchall())
+        return {state: counts.get(state, 0) for state in (PENDING, RUNNING, DONE, FAILED)}
+
+    def load(self, client=None):
+        # the pages queued in every process, their spooled bytes and how
+        # many of them are client's
+        with self._lock:
+            jobs, size, client_jobs = self._conn.execute(
+                self._LOAD_SQL, (client, PENDING, RUNNING)).fetchone()
+        return dict(jobs=jobs, bytes=size, client_jobs=client_jobs)
+
+    def throughput(self, window=300):
+        # pages finished per second over the last window seconds, by any
+        # process or worker node
+        with self._lock:
+            finished, = self._conn.execute(
+                self._FINISHED_SINCE_SQL, (DONE, FAILED, time() - window)).fetchone()
+        return finished / window
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,321 @@
+from .pipeline import Job, Pipeline, Stage
+from pathlib import PurePath
+import threading
+import sys
+
+# mokuro, torch and friends take long to import, they are only imported
+# once the models are needed.
+
+INVALID_IMAGE = "Animation file, Corrupted file or Unsupported type"
+
+
+def is_invalid_image(e):
+    # mokuro's InvalidImage, older versions failed with an AttributeError.
+    # If mokuro raised it, it's already imported
+    module = sys.modules.get("mokuro.manga_page_ocr")
+    return isinstance(e, AttributeError) or (
+        module is not None and isinstance(e, module.InvalidImage))
+
+
+def map_recursive(func, obj):
+    if isinstance(obj, dict):
+        return {k: map_recursive(func, v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [map_recursive(func, elem) for elem in obj]
+    else:
+        return func(obj)
+
+
+def numpy_to_native(v):
+    # numpy dtypes have a .item() to convert themselves to a native python type
+    return v.item() if hasattr(v, "item") else v
+
+
+class BatchedPageOcr:
+    # The steps of mokuro's MangaPageOcr.__call__, but with the text detector
+    # run over a batch of pages and the line recognizer over batches of line
+    # crops. Results are the same as MangaPageOcr's for each page, unless
+    # detect_max_side is set: pages with a longer edge are downscaled for the
+    # text detector, and the boxes it finds are scaled back to the page. The
+    # lines are still cropped from the full size page for the recognizer.
+
+    def __init__(self, mpocr, line_batch_size=16, detect_max_side=None):
+        self.mpocr = mpocr
+        self.line_batch_size = max(int(line_batch_size or 1), 1)
+        self.detect_max_side = detect_max_side
+
+    def __call__(self, images):
+        # returns a result or an exception for each page, see decode
+        pages, results = [], []
+        for image in images:
+            try:
+                img, result = self.decode(image)
+            except Exception as e:
+                results.append(e)
+                continue
+            pages.append((img, result))
+            results.append(result)
+
+        if self.mpocr.disable_ocr or not pages:
+            return results
+
+        crops, lines = [], []
+        detections = self.detect([img for img, _ in pages])
+        for (img, result), detection in zip(pages, detections):
+            page_crops, page_lines = self.crop(img, detection, result)
+            crops.extend(page_crops)
+            lines.extend(page_lines)
+        self.assemble(lines, self.recognize(crops))
+        return results
+
+    @staticmethod
+    def decode(image):
+        # image is a path, the encoded image in any buffer (read in place,
+        # not copied) or an array decoded like cv2.imread does
+        import cv2
+        import numpy as np
+        from mokuro import __version__
+        from mokuro.manga_page_ocr import InvalidImage
+        from mokuro.utils import imread
+        if isinstance(image, np.ndarray):
+            img = image
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            buffer = np.frombuffer(image, np.uint8)
+            img = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if buffer.size else None
+        else:
+            img = imread(image)
+        if img is None:
+            raise InvalidImage()
+        H, W, *_ = img.shape
+        return img, {'version': __version__, 'img_width': W, 'img_height': H, 'blocks': []}
+
+    def crop(self, img, detection, result):
+        # adds the blocks to result, returns the line crops and the
+        # (block, number of crops) of each line to assemble them later
+        _, mask_refined, blk_list = detection
+        crops, lines = [], []
+        for blk in blk_list:
+            result_blk = {'box': list(blk.xyxy), 'vertical': blk.vertical, 'font_size': blk.font_size,
+                          'lines_coords': [], 'lines': []}
+            for line_idx, line in enumerate(blk.lines_array()):
+                line_crops = self.line_crops(img, mask_refined, blk, line_idx)
+                result_blk['lines_coords'].append(line.tolist())
+                lines.append((result_blk, len(line_crops)))
+                crops.extend(line_crops)
+            result['blocks'].append(result_blk)
+        return crops, lines
+
+    @staticmethod
+    def assemble(lines, texts):
+        texts = iter(texts)
+        for result_blk, chunks in lines:
+            result_blk['lines'].append(''.join(next(texts) for _ in range(chunks)))
+
+    def line_crops(self, img, mask_refined, blk, line_idx):
+        import cv2
+        mpocr = self.mpocr
+        max_ratio = mpocr.max_ratio_vert if blk.vertical else mpocr.max_ratio_hor
+        line_crops, _ = mpocr.split_into_chunks(
+            img, mask_refined, blk, line_idx, textheight=mpocr.text_height,
+            max_ratio=max_ratio, anchor_window=mpocr.anchor_window)
+        if blk.vertical:
+            line_crops = [cv2.rotate(crop, cv2.ROTATE_90_CLOCKWISE) for crop in line_crops]
+        return line_crops
+
+    def prescale(self, img):
+        # (the image for the text detector, its scale)
+        import cv2
+        H, W = img.shape[:2]
+        if not self.detect_max_side or max(H, W) <= self.detect_max_side:
+            return img, 1.0
+        scale = self.detect_max_side / max(H, W)
+        size = (max(round(W * scale), 1), max(round(H * scale), 1))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA), scale
+
+    def detect(self, images, prescaled=None):
+        # prescaled is what prescale returned for each image, if known
+        prescaled = prescaled or [self.prescale(img) for img in images]
+        detections = self.run_detector([small for small, _ in prescaled])
+        return [
+            detection if scale == 1.0 else self.upscale(detection, scale, img.shape)
+            for img, (_, scale), detection in zip(images, prescaled, detections)
+        ]
+
+    @staticmethod
+    def upscale(detection, scale, shape):
+        # the detection of a downscaled page, in the page coordinates
+        import cv2
+        import numpy as np
+        mask, mask_refined, blk_list = detection
+        H, W = shape[:2]
+        mask = cv2.resize(mask, (W, H), interpolation=cv2.INTER_LINEAR)
+        mask_refined = cv2.resize(mask_refined, (W, H), interpolation=cv2.INTER_NEAREST)
+        factor = 1 / scale
+        for blk in blk_list:
+            x1, y1, x2, y2 = (round(v * factor) for v in blk.xyxy)
+            blk.xyxy = [min(x1, W), min(y1, H), min(x2, W), min(y2, H)]
+            blk.lines = [
+                np.clip(np.round(np.asarray(line, np.float64) * factor), 0, (W, H)).astype(np.int32).tolist()
+                for line in blk.lines
+            ]
+            blk.font_size *= factor
+            if blk.distance is not None:
+                blk.distance = blk.distance * factor
+            if blk.vec is not None:
+                blk.vec = blk.vec * factor
+            if blk.norm > 0:
+                blk.norm *= factor
+            blk._bounding_rect = None
+        return mask, mask_refined, blk_list
+
+    def run_detector(self, images):
+        detector = self.mpocr.text_detector
+        if len(images) == 1 or detector.backend != 'torch':
+            return [detector(img, refine_mode=1, keep_undetected_mask=True) for img in images]
+
+        import torch
+        from comic_text_detector.inference import preprocess_img
+        inputs = [
+            preprocess_img(img, input_size=detector.input_size, device=detector.device, half=detector.half)
+            for img in images
+        ]
+        with torch.no_grad():
+            blks, mask, lines_map = detector.net(torch.cat([img_in for img_in, *_ in inputs]))
+            return [
+                self._detection(detector, img, blks[i:i + 1], mask[i:i + 1].clone(),
+                                lines_map[i:i + 1].clone(), dw, dh)
+                for i, (img, (_, _, dw, dh)) in enumerate(zip(images, inputs))
+            ]
+
+    @staticmethod
+    def _detection(detector, img, blks, mask, lines_map, dw, dh):
+        # TextDetector.__call__ after the network ran, for a single page
+        import cv2
+        import numpy as np
+        from comic_text_detector.inference import (
+            postprocess_yolo, postprocess_mask, group_output, refine_mask, refine_undetected_mask)
+        refine_mode = 1
+        im_h, im_w = img.shape[:2]
+
+        resize_ratio = (im_w / (detector.input_size[0] - dw), im_h / (detector.input_size[1] - dh))
+        blks = postprocess_yolo(blks, detector.conf_thresh, detector.nms_thresh, resize_ratio)
+        mask = postprocess_mask(mask)
+
+        lines, scores = detector.seg_rep(detector.input_size, lines_map)
+        box_thresh = 0.6
+        idx = np.where(scores[0] > box_thresh)
+        lines, scores = lines[0][idx], scores[0][idx]
+
+        mask = mask[: mask.shape[0] - dh, : mask.shape[1] - dw]
+        mask = cv2.resize(mask, (im_w, im_h), interpolation=cv2.INTER_LINEAR)
+        if lines.size == 0:
+            lines = []
+        else:
+            lines = lines.astype(np.float64)
+            lines[..., 0] *= resize_ratio[0]
+            lines[..., 1] *= resize_ratio[1]
+            lines = lines.astype(np.int32)
+        blk_list = group_output(blks, lines, im_w, im_h, mask)
+        mask_refined = refine_mask(img, mask, blk_list, refine_mode=refine_mode)
+        mask_refined = refine_undetected_mask(img, mask, mask_refined, blk_list, refine_mode=refine_mode)
+        return mask, mask_refined, blk_list
+
+    def recognize(self, crops):
+        from PIL import Image
+        from manga_ocr.ocr import post_process
+        mocr = self.mpocr.mocr
+        if len(crops) == 1 or self.line_batch_size == 1:
+            return [mocr(Image.fromarray(crop)) for crop in crops]
+
+        texts = []
+        for i in range(0, len(crops), self.line_batch_size):
+            imgs = [
+                Image.fromarray(crop).convert('L').convert('RGB')
+                for crop in crops[i:i + self.line_batch_size]
+            ]
+            x = mocr.feature_extractor(imgs, return_tensors="pt").pixel_values
+            x = mocr.model.generate(x.to(mocr.model.device), max_length=300).cpu()
+            texts.extend(
+                post_process(text)
+                for text in mocr.tokenizer.batch_decode(x, skip_special_tokens=True))
+        return texts
+
+
+class OcrPipeline(Pipeline):
+    # The BatchedPageOcr steps as pipeline stages, so that decoding, the
+    # models and storing the results of different pages overlap:
+    #   decode -> prescale -> detect -> crop -> recognize -> finish
+    # Detection and recognition take batches of up to batch_pages pages.
+    DEFAULT_WORKERS = dict(decode=2, prescale=1, detect=1, crop=1, recognize=1, finish=1)
+
+    def __init__(self, page_ocr, store=None, workers=None, queue_size=8,
+                 batch_pages=4, max_wait=0.05, logger=None):
+        self._page_ocr_factory = page_ocr  # called once to get the BatchedPageOcr
+        self._page_ocr = None
+        self._page_ocr_lock = threading.Lock()
+        self.store = store  # called with the key and result of each page
+        workers = {**self.DEFAULT_WORKERS, **(workers or {})}
+        super().__init__([
+            Stage("decode", self._decode, workers["decode"], queue_size),
+            Stage("prescale", self._prescale, workers["prescale"], queue_size),
+            Stage("detect", self._detect, workers["detect"], queue_size, batch_pages, max_wait),
+            Stage("crop", self._crop, workers["crop"], queue_size),
+            Stage("recognize", self._recognize, workers["recognize"], queue_size, batch_pages),
+            Stage("finish", self._finish, workers["finish"], queue_size),
+        ], logger)
+
+    def page_ocr(self):
+        with self._page_ocr_lock:
+            if self._page_ocr is None:
+                self._page_ocr = self._page_ocr_factory()
+            return self._page_ocr
+
+    def _decode(self, jobs):
+        for job in jobs:
+            try:
+                job.img, job.result = BatchedPageOcr.decode(job.image)
+            except Exception as e:
+                job.error = e
+
+    def _prescale(self, jobs):
+        page_ocr = self.page_ocr()
+        for job in jobs:
+            job.prescaled = None if page_ocr.mpocr.disable_ocr else page_ocr.prescale(job.img)
+
+    def _detect(self, jobs):
+        page_ocr = self.page_ocr()
+        if page_ocr.mpocr.disable_ocr:
+            detections = [None] * len(jobs)
+        else:
+            detections = page_ocr.detect([job.img for job in jobs], [job.prescaled for job in jobs])
+        for job, detection in zip(jobs, detections):
+            job.detection = detection
+            job.prescaled = None
+
+    def _crop(self, jobs):
+        page_ocr = self.page_ocr()
+        for job in jobs:
+            job.crops, job.lines = [], []
+            if job.detection is not None:
+                job.crops, job.lines = page_ocr.crop(job.img, job.detection, job.result)
+            job.img = job.detection = None
+
+    def _recognize(self, jobs):
+        texts = self.page_ocr().recognize([crop for job in jobs for crop in job.crops])
+        start = 0
+        for job in jobs:
+            BatchedPageOcr.assemble(job.lines, texts[start:start + len(job.crops)])
+            start += len(job.crops)
+            job.crops = job.lines = None
+
+    def _finish(self, jobs):
+        for job in jobs:
+            job.result = map_recursive(numpy_to_native, job.result)
+            if self.store is not None and job.key is not None:
+                self.store(job.key, job.result)
+
+    def ocr(self, image, key=None):
+        # image is anything BatchedPageOcr.decode takes
+        if isinstance(image, PurePath):
+            image = str(image)
+        return self.submit(Job(image=image, key=key)).result().result
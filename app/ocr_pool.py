@@ -0,0 +1,93 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+import logging
+import os
+
+# Set in each worker process by _init_worker
+_page_ocr = None
+
+
+def _init_worker(torch_threads, line_batch_size, detect_max_side=None):
+    global _page_ocr
+    if torch_threads:
+        # before torch is imported, so its thread pools are sized right
+        os.environ["OMP_NUM_THREADS"] = str(torch_threads)
+        os.environ["MKL_NUM_THREADS"] = str(torch_threads)
+        import torch
+        torch.set_num_threads(torch_threads)
+    from mokuro import OverlayGenerator
+    from .ocr import BatchedPageOcr
+    og = OverlayGenerator()
+    og.init_models()
+    _page_ocr = BatchedPageOcr(og.mpocr, line_batch_size, detect_max_side)
+
+
+def _ping():
+    return os.getpid()
+
+
+def _ocr_file(path):
+    from .ocr import map_recursive, numpy_to_native
+    result, = _page_ocr([path])
+    if isinstance(result, Exception):
+        raise result
+    # converted here, plain python objects are cheaper to send back
+    return map_recursive(numpy_to_native, result)
+
+
+class OcrProcessPool:
+    # Runs MangaPageOcr in worker processes, each loading the models once.
+    # Workers are spawned rather than forked, the web process has threads
+    # (and maybe torch) running that don't survive a fork.
+
+    def __init__(self, workers, torch_threads=None, line_batch_size=16, logger=None,
+                 detect_max_side=None):
+        self.workers = int(workers)
+        self.line_batch_size = line_batch_size
+        self.detect_max_side = detect_max_side
+        self.torch_threads = torch_threads or max(
+            1, (os.cpu_count() or 1) // self.workers)
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self.logger.info(
+                    f"Starting {self.workers} OCR processes with "
+                    f"{self.torch_threads} torch threads each")
+                self._executor = ProcessPoolExecutor(
+                    self.workers, multiprocessing.get_context("spawn"),
+                    initializer=_init_worker, initargs=(self.torch_threads, self.line_batch_size, self.detect_max_side))
+            return self._executor
+
+    def _restart(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def preload(self):
+        # each worker loads the models before running its first task
+        executor = self._get_executor()
+        for future in [executor.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def ocr(self, path):
+        executor = self._get_executor()
+        try:
+            return executor.submit(_ocr_file, str(path)).result()
+        except BrokenProcessPool:
+            # a worker died (e.g. out of memory), start over for the next pages
+            self.logger.error("An OCR process died, restarting the pool")
+            self._restart(executor)
+            raise Exception("OCR worker process crashed")
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,334 @@
+from importlib.util import find_spec
+from pathlib import Path
+from urllib.parse import quote
+import functools
+import re
+
+# The HTML of mokuro's OverlayGenerator, byte for byte, without importing
+# mokuro: that loads torch and the OCR models, which web processes never use.
+# The styles, scripts and icons are still read from the installed mokuro.
+
+ABOUT = """
+<p>HTML overlay generated with <a href="https://github.com/kha-white/mokuro" target="_blank">mokuro</a> version {version}</p>
+<p>Instructions:</p>
+<ul>
+<li>Navigate pages with:
+    <ul>
+    <li>menu buttons</li>
+    <li>Page Up, Page Down, Home, End keys</li>
+    <li>by clicking left/right edge of the screen</li>
+    </ul>
+<li>Click &#10005; button to hide the menu. To bring it back, clip top-left corner of the screen.</li>
+<li>Select "editable boxes" option, to edit text recognized by OCR. Changes are not saved, it's only for ad-hoc fixes when using look-up dictionary.</li>
+<li>E-ink mode turns off animations and simulates display refresh on each page turn.</li>
+</ul>
+"""
+
+ABOUT_DEMO = ABOUT + """
+<br/>
+<p>This demo contains excerpt from <a href="http://www.manga109.org/en/download_s.html" target="_blank">Manga109-s dataset</a>.</p>
+<p>うちの猫’ず日記 &copy; がぁさん</p>
+"""
+
+NO_VALUE = object()
+
+
+@functools.cache
+def mokuro_dir():
+    # find_spec doesn't run the package's __init__
+    spec = find_spec("mokuro")
+    if spec is None or not spec.submodule_search_locations:
+        raise FileNotFoundError("mokuro isn't installed")
+    return Path(next(iter(spec.submodule_search_locations)))
+
+
+@functools.cache
+def mokuro_version():
+    init = (mokuro_dir() / "__init__.py").read_text(encoding="utf-8")
+    return re.search(r"""__version__\s*=\s*['"]([^'"]+)['"]""", init).group(1)
+
+
+@functools.cache
+def asset(name):
+    return (mokuro_dir() / name).read_text(encoding="utf-8")
+
+
+def icon(name):
+    return asset(f"assets/icons/{name}.svg")
+
+
+class HtmlDoc:
+    # the bits of yattag's Doc that mokuro uses, with the same output
+
+    def __init__(self):
+        self.result = []
+
+    @staticmethod
+    def _escape(value, attr=False):
+        if isinstance(value, (int, float)):
+            return str(value)
+        value = value.replace("&", "&amp;").replace("<", "&lt;")
+        return value.replace('"', "&quot;") if attr else value.replace(">", "&gt;")
+
+    def tag(self, name, *args, **kwargs):
+        attrs = {arg: NO_VALUE for arg in args}
+        attrs.update(("class" if key == "klass" else key, value) for key, value in kwargs.items())
+        return _Tag(self, name, attrs)
+
+    def text(self, value):
+        self.result.append(self._escape(value))
+
+    def asis(self, value):
+        self.result.append(value)
+
+    def getvalue(self):
+        return "".join(self.result)
+
+
+class _Tag:
+    def __init__(self, doc, name, attrs):
+        self.doc = doc
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.position = len(self.doc.result)
+        self.doc.result.append("")
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc is None:
+            attrs = " ".join(
+                key if value is NO_VALUE else f'{key}="{HtmlDoc._escape(value, attr=True)}"'
+                for key, value in self.attrs.items())
+            self.doc.result[self.position] = f"<{self.name} {attrs}>" if attrs else f"<{self.name}>"
+            self.doc.result.append(f"</{self.name}>")
+
+
+def clip(value, low, high):
+    # like numpy's, a float if any of them is
+    clipped = min(max(value, low), high)
+    return float(clipped) if any(isinstance(v, float) for v in (value, low, high)) else clipped
+
+
+def index_html(page_htmls, title, as_one_file=True, is_demo=False):
+    doc = HtmlDoc()
+    tag, text = doc.tag, doc.text
+
+    with tag('html'):
+        doc.asis('<meta content="text/html;charset=utf-8" http-equiv="Content-Type">')
+        doc.asis('<meta content="utf-8" http-equiv="encoding">')
+        doc.asis(
+            '<meta name="viewport" content="width=device-width, initial-scale=1, minimum-scale=1, user-scalable=no"/>')
+
+        with tag('head'):
+            with tag('title'):
+                text(title)
+
+            if as_one_file:
+                with tag('style'):
+                    doc.asis(asset('styles.css'))
+            else:
+                with tag('link', rel='stylesheet', href='styles.css'):
+                    pass
+
+        with tag('body'):
+            top_menu(doc, len(page_htmls))
+
+            with tag('div', id='dimOverlay'):
+                pass
+
+            with tag('div', id='popupAbout', klass='popup'):
+                doc.asis((ABOUT_DEMO if is_demo else ABOUT).format(version=mokuro_version()))
+
+            with tag('a', id='leftAScreen', href='#'):
+                pass
+
+            with tag('a', id='rightAScreen', href='#'):
+                pass
+
+            with tag('div', id='pagesContainer'):
+                for i, page_html in enumerate(page_htmls):
+                    with tag('div', id=f'page{i}', klass='page'):
+                        doc.asis(page_html)
+
+                with tag('a', id='leftAPage', href='#'):
+                    pass
+
+                with tag('a', id='rightAPage', href='#'):
+                    pass
+
+            if as_one_file:
+                with tag('script'):
+                    doc.asis(asset('assets/panzoom.min.js'))
+
+                with tag('script'):
+                    doc.asis(asset('script.js'))
+            else:
+                with tag('script', src='panzoom.min.js'):
+                    pass
+
+                with tag('script', src='script.js'):
+                    pass
+
+                if is_demo:
+                    with tag('script'):
+                        doc.asis('showAboutOnStart=true;')
+
+    return doc.getvalue()
+
+
+def top_menu(doc, num_pages):
+    tag, text = doc.tag, doc.text
+
+    with tag('a', id='showMenuA', href='#'):
+        pass
+
+    with tag('div', id='topMenu'):
+        with tag('button', id='buttonHideMenu', klass='menuButton'):
+            doc.asis(icon('cross-svgrepo-com'))
+
+        with tag('button', id='buttonLeftLeft', klass='menuButton'):
+            doc.asis(icon('chevron-left-double-svgrepo-com'))
+
+        with tag('button', id='buttonLeft', klass='menuButton'):
+            doc.asis(icon('chevron-left-svgrepo-com'))
+
+        with tag('button', id='buttonRight', klass='menuButton'):
+            doc.asis(icon('chevron-right-svgrepo-com'))
+
+        with tag('button', id='buttonRightRight', klass='menuButton'):
+            doc.asis(icon('chevron-right-double-svgrepo-com'))
+
+        with tag('input', 'required', type='number', id='pageIdxInput',
+                 min=1, max=num_pages, value=1, size=3):
+            pass
+
+        with tag('span', id='pageIdxDisplay'):
+            pass
+
+        # workaround for yomichan including the menu bar in the {sentence} field when mining for some reason
+        with tag('span', style='color:rgba(255,255,255,0.1);font-size:1px;'):
+            text('。')
+
+        dropdown_menu(doc)
+
+
+def dropdown_menu(doc):
+    tag, text = doc.tag, doc.text
+
+    def option_click(id_, text_content):
+        with tag('a', href='#', klass='dropdown-option', id=id_):
+            text(text_content)
+
+    def option_toggle(id_, text_content):
+        with tag('label', klass='dropdown-option'):
+            text(text_content)
+
+            with tag('input', type='checkbox', id=id_):
+                pass
+
+    def option_select(id_, text_content, values):
+        with tag('label', klass='dropdown-option'):
+            text(text_content)
+            with tag('select', id=id_):
+                for value in values:
+                    with tag('option', value=value):
+                        text(value)
+
+    def option_color(id_, text_content, value):
+        with tag('label', klass='dropdown-option'):
+            text(text_content)
+            with tag('input', type='color', value=value, id=id_):
+                pass
+
+    with tag('div', klass='dropdown'):
+        with tag('button', id='dropbtn', klass='menuButton'):
+            doc.asis(icon('menu-hamburger-svgrepo-com'))
+
+        with tag('div', klass='dropdown-content'):
+            with tag('div', klass='buttonRow'):
+                with tag('button', id='menuFitToScreen', klass='menuButton'):
+                    doc.asis(icon('expand-svgrepo-com'))
+                with tag('button', id='menuFitToWidth', klass='menuButton'):
+                    doc.asis(icon('expand-width-svgrepo-com'))
+                with tag('button', id='menuOriginalSize', klass='menuButton'):
+                    text('1:1')
+                with tag('button', id='menuFullScreen', klass='menuButton'):
+                    doc.asis(icon('fullscreen-svgrepo-com'))
+
+            option_select('menuDefaultZoom', 'on page turn: ', [
+                'fit to screen',
+                'fit to width',
+                'original size',
+                'keep zoom level',
+            ])
+            option_toggle('menuR2l', 'right to left')
+            option_toggle('menuDoublePageView', 'display two pages ')
+            option_toggle('menuHasCover', 'first page is cover ')
+            option_toggle('menuCtrlToPan', 'ctrl+mouse to move ')
+            option_toggle('menuDisplayOCR', 'OCR enabled ')
+            option_toggle('menuTextBoxBorders', 'display boxes outlines ')
+            option_toggle('menuEditableText', 'editable text ')
+            option_select('menuFontSize', 'font size: ',
+                          ['auto', 9, 10, 11, 12, 14, 16, 18, 20, 24, 32, 40, 48, 60])
+            option_toggle('menuEInkMode', 'e-ink mode ')
+            option_toggle('menuToggleOCRTextBoxes', 'toggle OCR text boxes on click')
+            option_color('menuBackgroundColor', 'background color', '#C4C3D0')
+            option_click('menuReset', 'reset settings')
+            option_click('menuAbout', 'about/help')
+
+
+def page_html(result, img_path):
+    doc = HtmlDoc()
+    tag, text = doc.tag, doc.text
+
+    # assign z-index ordering from largest to smallest boxes,
+    # so that smaller boxes don't get hidden underneath larger ones
+    areas = [(x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in (b['box'] for b in result['blocks'])]
+    z_idxs = [0] * len(areas)
+    for rank, i in enumerate(sorted(range(len(areas)), key=lambda i: -areas[i])):
+        z_idxs[i] = rank + 10
+
+    with tag('div', klass='pageContainer', style=container_style(result, quote(str(img_path.as_posix())))):
+        for result_blk, z_index in zip(result['blocks'], z_idxs):
+            with tag('div', klass='textBox', style=box_style(result_blk, z_index, result['img_width'], result['img_height'])):
+                for line in result_blk['lines']:
+                    with tag('p'):
+                        text(line)
+
+    return doc.getvalue()
+
+
+def box_style(result_blk, z_index, W, H, expand=0):
+    xmin, ymin, xmax, ymax = result_blk['box']
+    w = xmax - xmin
+    h = ymax - ymin
+
+    xmin = clip(xmin - int(w * expand / 2), 0, W)
+    ymin = clip(ymin - int(h * expand / 2), 0, H)
+    xmax = clip(xmax + int(w * expand / 2), 0, W)
+    ymax = clip(ymax + int(h * expand / 2), 0, H)
+
+    style = {
+        'left': xmin,
+        'top': ymin,
+        'width': xmax - xmin,
+        'height': ymax - ymin,
+        'font-size': f'{clip(result_blk["font_size"], 12, 32)}px',
+        'z-index': z_index,
+    }
+
+    if result_blk['vertical']:
+        style['writing-mode'] = 'vertical-rl'
+
+    return ' '.join(f'{k}:{v};' for k, v in style.items())
+
+
+def container_style(result, img_path):
+    style = {
+        'width': result['img_width'],
+        'height': result['img_height'],
+        'background-image': f'url("{img_path}")'
+    }
+
+    return ' '.join(f'{k}:{v};' for k, v in style.items())
@@ -0,0 +1,153 @@
+import threading
+import sqlite3
+import logging
+
+BANDS = 4  # of 16 bits each
+MIN_DETAIL_BITS = 8
+# Pages with the same panel layout or mostly white share their dHash, so
+# candidates are confirmed on a grayscale thumbnail: every CELL x CELL cell
+# must be within MAX_CELL_DIFFERENCE levels on average. Re-encoding or
+# resizing a page stays well below, different text in a bubble doesn't.
+THUMB_SIZE = 64
+CELL = 8
+MAX_CELL_DIFFERENCE = 10
+
+
+def dhash(path):
+    # (64 bits difference hash, width, height, thumbnail) of an image file:
+    # the brightness gradients of a 9x8 thumbnail, robust to re-encoding,
+    # and the THUMB_SIZE x THUMB_SIZE grayscale thumbnail to confirm matches
+    import cv2
+    import numpy as np
+    img = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError("Not an image")
+    H, W = img.shape[:2]
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    thumb = cv2.resize(img, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA)
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit)), W, H, thumb.tobytes()
+
+
+def thumbs_match(a, b):
+    if not a or not b or len(a) != THUMB_SIZE * THUMB_SIZE or len(b) != len(a):
+        return False
+    for top in range(0, THUMB_SIZE, CELL):
+        for left in range(0, THUMB_SIZE, CELL):
+            difference = sum(
+                abs(a[i] - b[i])
+                for row in range(top, top + CELL)
+                for i in range(row * THUMB_SIZE + left, row * THUMB_SIZE + left + CELL))
+            if difference > MAX_CELL_DIFFERENCE * CELL * CELL:
+                return False
+    return True
+
+
+def rescale_result(result, width, height):
+    # an OCR result moved to a page of another size
+    sx = width / result["img_width"]
+    sy = height / result["img_height"]
+
+    def point(xy):
+        return [xy[0] * sx, xy[1] * sy]
+
+    blocks = []
+    for block in result["blocks"]:
+        x1, y1, x2, y2 = block["box"]
+        blocks.append({
+            **block,
+            "box": [round(x1 * sx), round(y1 * sy), round(x2 * sx), round(y2 * sy)],
+            "font_size": block["font_size"] * (sx + sy) / 2,
+            "lines_coords": [[point(xy) for xy in line] for line in block["lines_coords"]],
+        })
+    return {**result, "img_width": width, "img_height": height, "blocks": blocks}
+
+
+class PerceptualIndex:
+    # The dHashes of the OCR'd pages, to find the pages within max_distance
+    # bits of a new one. Two hashes that close share at least one of their
+    # BANDS bands (for max_distance < BANDS), so the candidates are looked up
+    # by band and only those are compared bit by bit, then on their thumbnail.
+    _CREATE_SQL = (
+        'CREATE TABLE IF NOT EXISTS phashes '
+        '( key TEXT PRIMARY KEY, hash INTEGER NOT NULL, width INTEGER, height INTEGER, '
+        'b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER, thumb BLOB )'
+    )
+    _MIGRATE_COLUMNS = {
+        "thumb": 'ALTER TABLE phashes ADD COLUMN thumb BLOB',
+    }
+    _CREATE_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS phashes_b{0} ON phashes (b{0})'
+    _ADD_SQL = (
+        'INSERT OR REPLACE INTO phashes (key, hash, width, height, b0, b1, b2, b3, thumb) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    )
+    _CANDIDATES_SQL = (
+        'SELECT key, hash, width, height, thumb FROM phashes '
+        'WHERE b0 = ? OR b1 = ? OR b2 = ? OR b3 = ?'
+    )
+    _DELETE_SQL = 'DELETE FROM phashes WHERE key = ?'
+    _COUNT_SQL = 'SELECT COUNT(*) FROM phashes'
+
+    def __init__(self, path=None, max_distance=3, aspect_tolerance=0.01, logger=None):
+        self.path = path or ":memory:"
+        self.max_distance = min(max_distance, BANDS - 1)
+        self.aspect_tolerance = aspect_tolerance
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(self._CREATE_SQL)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(phashes)')}
+            for column, sql in self._MIGRATE_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(sql)
+            for band in range(BANDS):
+                conn.execute(self._CREATE_INDEX_SQL.format(band))
+
+    @staticmethod
+    def _bands(phash):
+        return [(phash >> (16 * band)) & 0xFFFF for band in range(BANDS)]
+
+    @staticmethod
+    def _signed(phash):
+        # sqlite integers are signed 64 bits
+        return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+    def add(self, key, phash, width, height, thumb=None):
+        with self._lock, self._conn as conn:
+            conn.execute(self._ADD_SQL, (
+                key, self._signed(phash), width, height, *self._bands(phash), thumb))
+
+    def discard(self, key):
+        with self._lock, self._conn as conn:
+            conn.execute(self._DELETE_SQL, (key,))
+
+    def similar(self, phash, width, height, thumb=None, exclude=None):
+        # keys of the pages that look the same, closest first. Near uniform
+        # pages match each other too easily, they never match. With a thumb,
+        # only the pages whose thumbnail matches it too.
+        if not MIN_DETAIL_BITS <= phash.bit_count() <= 64 - MIN_DETAIL_BITS:
+            return []
+        with self._lock:
+            rows = self._conn.execute(self._CANDIDATES_SQL, self._bands(phash)).fetchall()
+        aspect = width / height
+        matches = []
+        for key, other, other_width, other_height, other_thumb in rows:
+            distance = (phash ^ (other & ((1 << 64) - 1))).bit_count()
+            if key == exclude or distance > self.max_distance:
+                continue
+            if abs(other_width / other_height - aspect) > aspect * self.aspect_tolerance:
+                continue
+            if thumb is not None and not thumbs_match(thumb, other_thumb):
+                continue
+            matches.append((distance, key))
+        return [key for _, key in sorted(matches)]
+
+    def stats(self):
+        with self._lock:
+            return {"pages": self._conn.execute(self._COUNT_SQL).fetchone()[0]}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,121 @@
+from concurrent.futures import Future
+import threading
+import logging
+import queue
+import time
+
+
+class Job:
+    # Passed from stage to stage, the stages keep their outputs as attributes
+    def __init__(self, **kwargs):
+        self.error = None
+        self.__dict__.update(kwargs)
+        self.future = Future()
+
+
+class Stage:
+    # A step of the pipeline, run by its own worker threads. func gets a
+    # list of up to batch_size jobs, waiting at most max_wait seconds after
+    # the first one for the rest. Raising fails all the jobs of the batch.
+
+    def __init__(self, name, func, workers=1, queue_size=8, batch_size=1, max_wait=0):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.max_wait = max_wait
+        # bounded, a slow stage holds back the ones before it
+        self.queue = queue.Queue(max(int(queue_size), 1))
+        self._lock = threading.Lock()
+        self._stats = dict(jobs=0, batches=0, errors=0, busy_seconds=0.0, max_queue_depth=0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(queue_depth=self.queue.qsize(), workers=self.workers)
+        stats["avg_job_ms"] = (
+            stats["busy_seconds"] * 1000 / stats["jobs"] if stats["jobs"] else 0.0)
+        return stats
+
+    def put(self, job):
+        self.queue.put(job)
+        with self._lock:
+            self._stats["max_queue_depth"] = max(
+                self._stats["max_queue_depth"], self.queue.qsize())
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self, batch):
+        start = time.perf_counter()
+        try:
+            self.func(batch)
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._stats["jobs"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["busy_seconds"] += elapsed
+
+
+class Pipeline:
+    # Runs jobs through the stages in order. A job whose `error` is set by
+    # a stage skips the rest of them. Threads are started on the first job.
+
+    def __init__(self, stages, logger=None):
+        self.stages = stages
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._started = False
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            for i, stage in enumerate(self.stages):
+                following = self.stages[i + 1] if i + 1 < len(self.stages) else None
+                for n in range(stage.workers):
+                    threading.Thread(
+                        target=self._loop, args=(stage, following),
+                        name=f"ocr-{stage.name}-{n}", daemon=True).start()
+            self._started = True
+
+    def _loop(self, stage, following):
+        while True:
+            batch = stage.next_batch()
+            pending = [job for job in batch if job.error is None]
+            try:
+                if pending:
+                    stage.run(pending)
+            except Exception as e:
+                self.logger.error(f"OCR stage {stage.name} failed: {e}")
+                for job in pending:
+                    job.error = e
+            for job in batch:
+                if job.error is not None:
+                    job.future.set_exception(job.error)
+                elif following is not None:
+                    following.put(job)
+                else:
+                    job.future.set_result(job)
+
+    def submit(self, job):
+        self._ensure_started()
+        self.stages[0].put(job)
+        return job.future
@@ -0,0 +1,150 @@
+from collections import deque
+from importlib.metadata import PackageNotFoundError, version
+import functools
+import threading
+import logging
+import time
+import re
+from .cache_layers import cached_keys, find_method
+from .jobs import DONE, FAILED
+
+SCAN_BATCH = 500
+
+
+@functools.cache
+def installed_version():
+    # mokuro's, without importing it. None if it isn't installed
+    try:
+        return version("mokuro")
+    except PackageNotFoundError:
+        return None
+
+
+def version_tuple(value):
+    return tuple(int(n) for n in re.findall(r"\d+", str(value or "")))
+
+
+def is_stale(result, current=None):
+    # made by an older mokuro than the installed one
+    current = current or installed_version()
+    if current is None or not isinstance(result, dict):
+        return False
+    return version_tuple(result.get("version")) < version_tuple(current)
+
+
+class StaleRefresher:
+    # Re-OCRs the cached pages made by an older mokuro than `version`, from
+    # the images the job store kept. Pages are handed to submit(key) only as
+    # workers go idle: idle_slots() is how many could start now without
+    # delaying anyone's pages. The cache is scanned again scan_interval
+    # seconds after the last scan, once its stale pages are all done.
+
+    def __init__(self, cache, jobs, submit, idle_slots, version=None, scan_interval=3600,
+                 poll_interval=5, logger=None):
+        self.cache = cache
+        self.jobs = jobs
+        self.submit = submit
+        self.idle_slots = idle_slots
+        self.version = version or installed_version()
+        self.scan_interval = scan_interval
+        self.poll_interval = poll_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stale = deque()
+        self._running = set()
+        self._failed = set()  # not retried until a restart
+        self._finished = deque()  # times pages were refreshed, for the throughput
+        self._stats = dict(scans=0, scanned=0, stale=0, submitted=0, refreshed=0, failed=0)
+        self._last_scan = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="ocr-refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _peek(self, keys):
+        # past the in-process layers and without counting as accesses, the
+        # scan would make every kept page look hot to the eviction
+        peek_many = find_method(self.cache, "peek_many") or self.cache.get_many
+        return peek_many(*keys)
+
+    def scan(self):
+        self.jobs.prune_sources(functools.partial(cached_keys, self.cache), SCAN_BATCH)
+        keys = [path.name for path in self.jobs.sources_dir.iterdir()
+                if path.is_file() and path.name not in self._failed]
+        stale = []
+        for start in range(0, len(keys), SCAN_BATCH):
+            batch = keys[start:start + SCAN_BATCH]
+            stale.extend(key for key, result in zip(batch, self._peek(batch))
+                         if is_stale(result, self.version))
+        scanned = len(keys)
+        with self._lock:
+            self._stale = deque(key for key in stale if key not in self._running)
+            self._stats.update(scans=self._stats["scans"] + 1, scanned=scanned, stale=len(stale))
+            self._last_scan = time.monotonic()
+        if stale:
+            self.logger.info(f"Found {len(stale)} pages OCR'd by an older mokuro than {self.version}")
+        return len(stale)
+
+    def step(self):
+        # checks the submitted pages and submits more if the workers are idle
+        with self._lock:
+            running = list(self._running)
+        for key in running:
+            job = self.jobs.get(key)
+            state = job["state"] if job else FAILED
+            if state not in (DONE, FAILED):
+                continue
+            with self._lock:
+                self._running.discard(key)
+                if state == DONE:
+                    self._stats["refreshed"] += 1
+                    self._finished.append(time.monotonic())
+                else:
+                    self._stats["failed"] += 1
+                    self._failed.add(key)
+
+        with self._lock:
+            due = self._last_scan is None or (
+                not self._stale and not self._running and
+                time.monotonic() - self._last_scan >= self.scan_interval)
+        if due:
+            self.scan()
+
+        free = self.idle_slots()
+        while free > 0:
+            with self._lock:
+                if not self._stale:
+                    return
+                key = self._stale.popleft()
+            # the user may have uploaded it again meanwhile
+            if not is_stale(self._peek([key])[0], self.version) or not self.submit(key):
+                continue
+            with self._lock:
+                self._running.add(key)
+                self._stats["submitted"] += 1
+            free -= 1
+
+    def _loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.step()
+            except Exception as e:
+                self.logger.error(f"OCR refresh failed: {e}")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._finished and now - self._finished[0] > 600:
+                self._finished.popleft()
+            stats = dict(self._stats)
+            stats.update(
+                version=self.version, remaining=len(self._stale), running=len(self._running),
+                # over the last 10 minutes
+                pages_per_minute=len(self._finished) / 10)
+        return stats
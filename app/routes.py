@@ -1,13 +1,23 @@
+import hmac
 import json
+import math
 import re
+import time
 import concurrent.futures
 import threading
-import tempfile
-from functools import wraps
+from functools import partial, wraps
 from pathlib import Path, PurePath
-from hashlib import md5
-from flask import request, Response, Blueprint, current_app, flash, get_flashed_messages, stream_with_context
-from . import OCR_CACHE, OCR_EXECUTOR, overlay_generator, manga_page_ocr
+from flask import request, Response, Blueprint, current_app, flash, get_flashed_messages, stream_with_context, \
+    copy_current_request_context, send_file, g
+from . import OCR_CACHE, OCR_JOBS, OCR_PHASH, OCR_PROCESS_POOL, OCR_PIPELINE, OCR_REFRESH, OCR_SCHEDULER, \
+    manga_page_ocr, overlay
+from .cache_layers import find_method, layer_stats
+from .scheduler import PRIORITIES, INTERACTIVE, IDLE
+from .ocr import INVALID_IMAGE, is_invalid_image, map_recursive, numpy_to_native
+from .jobs import PENDING, RUNNING, DONE, FAILED, UploadEmpty, UploadHashMismatch, UploadTooLarge
+from .uploads import MultipartFiles
+from .phash import dhash, rescale_result
+from .refresh import is_stale
 
 v1 = Blueprint('v1', __name__, url_prefix='/v1')
 site = Blueprint('site', __name__)
@@ -26,26 +36,61 @@ def hashes():
 
     hashes = dict.fromkeys(request.json)
     if not hashes:
-        return {"new": [], "in_queue": [], "in_cache": []}
+        return {"new": [], "in_queue": [], "in_cache": [], "capacity": capacity(client_id())}
     hashes_lower = tuple(map(str.lower, hashes))
 
+    # queued in this process, or in any other sharing the job store
+    queued = current_app.extensions[OCR_JOBS].queued(hashes_lower)
     with current_app.queue_lock:
         queue = tuple(
             hs for hs, lhs in zip(hashes, hashes_lower)
-            if lhs in current_app.queue
+            if lhs in current_app.queue or lhs in queued
         )
 
-    if hasattr(current_app.extensions[OCR_CACHE], "has_many"):
-        cache = current_app.extensions[OCR_CACHE].has_many(*hashes_lower)
+    has_many = cache_method("has_many")
+    if has_many is not None:
+        # has_many returns the keys found, in no particular order
+        found = set(has_many(*hashes_lower))
+        cache = tuple(lhs in found for lhs in hashes_lower)
     else:
         def has_in_cache(lhs):
             return current_app.extensions[OCR_CACHE].has(lhs)
         cache = tuple(map(has_in_cache, hashes_lower))
 
     cache = tuple(hs for hs, in_cache in zip(hashes, cache) if in_cache)
-    new = tuple(hs for hs in hashes if hs not in (*queue, *cache))
+    known = {*queue, *cache}
+    new = tuple(hs for hs in hashes if hs not in known)
 
-    return {"new": new, "in_queue": queue, "in_cache": cache}
+    return {"new": new, "in_queue": queue, "in_cache": cache, "capacity": capacity(client_id())}
+
+
+@v1.get('/stats')
+def stats():
+    stats = layer_stats(current_app.extensions[OCR_CACHE])
+    if OCR_PIPELINE in current_app.extensions:
+        stats["ocr_pipeline"] = current_app.extensions[OCR_PIPELINE].stats()
+    stats["ocr_scheduler"] = current_app.extensions[OCR_SCHEDULER].stats()
+    if OCR_PHASH in current_app.extensions:
+        stats["ocr_phash"] = current_app.extensions[OCR_PHASH].stats()
+    if OCR_REFRESH in current_app.extensions:
+        stats["ocr_refresh"] = current_app.extensions[OCR_REFRESH].stats()
+    return stats
+
+
+@v1.post('/queue')
+def queue():
+    if not (request.is_json and valid_hash_list(request.json)):
+        return {"error": "Only JSON arrays of MD5 hashes are accepted"}, 415
+
+    hashes = dict.fromkeys(request.json)
+    hashes_lower = tuple(map(str.lower, hashes))
+    positions = current_app.extensions[OCR_SCHEDULER].positions(hashes_lower)
+    # pages queued by other processes have no known position
+    for lhs in current_app.extensions[OCR_JOBS].queued(hashes_lower):
+        positions.setdefault(lhs, {"position": None, "eta": None})
+    # position 0 is being OCR'd, eta is in seconds (null until known)
+    return {"queue": {
+        hs: positions[hs.lower()] for hs in hashes if hs.lower() in positions}}
 
 
 @v1.post('/results')
@@ -54,6 +99,16 @@ def results():
         return {"error": "Only JSON arrays of MD5 hashes are accepted"}, 415
 
     hashes = tuple(hs for hs in dict.fromkeys(request.json))
+
+    get_many_raw = cache_method("get_many_raw")
+    if get_many_raw is not None:
+        # splice the stored json into the response, without parsing it
+        if request.args.get('stream'):
+            body = raw_results_body(get_many_raw, hashes, RAW_RESULTS_CHUNK)
+            return Response(stream_with_context(body), content_type='application/json')
+        body = raw_results_body(get_many_raw, hashes, len(hashes))
+        return Response(b"".join(body), content_type='application/json')
+
     results = current_app.extensions[OCR_CACHE].get_many(
         *map(lambda hs: hs.lower(), hashes))
 
@@ -63,6 +118,35 @@ def results():
     return {"new": new, "results": ocr}
 
 
+RAW_RESULTS_CHUNK = 50
+
+
+def raw_results_body(get_many_raw, hashes, chunk_size):
+    # "results" goes first, so pages can be read in chunks while streaming
+    new = []
+    yield b'{"results":{'
+    separator = b''
+    for i in range(0, len(hashes), max(chunk_size, 1)):
+        chunk = hashes[i:i + chunk_size]
+        raws = get_many_raw(*map(str.lower, chunk))
+        for hs, raw in zip(chunk, raws):
+            if raw is None:
+                new.append(hs)
+                continue
+            yield b''.join((separator, json.dumps(hs).encode(), b':', raw))
+            separator = b','
+    yield b'},"new":' + json.dumps(new).encode() + b'}'
+
+
+def client_id():
+    return request.headers.get('X-Client-Id') or \
+        (request.access_route[0] if request.access_route else request.remote_addr)
+
+
+def cache_method(name):
+    return find_method(current_app.extensions[OCR_CACHE], name)
+
+
 def flashes_or_jsonlstream():
     def decorator(func):
         @wraps(func)
@@ -75,17 +159,76 @@ def flashes_or_jsonlstream():
                     pass
                 return json.dumps(get_flashed_messages(with_categories=True), ensure_ascii=False)
 
-            return Response(dummy_gen(), content_type='application/json')
+            body = dummy_gen()
+            if "retry_after" in g:
+                # some pages were turned away by the admission limits
+                return Response(body, 429, {"Retry-After": g.retry_after}, content_type='application/json')
+            return Response(body, content_type='application/json')
         return decorated_function
     return decorator
 
 
+ADMISSION_LIMITS = (
+    # config key, load key, what the client is told
+    ("OCR_MAX_QUEUED_JOBS", "jobs", "Too many pages are queued"),
+    ("OCR_MAX_QUEUED_BYTES", "bytes", "Too many bytes of pages are queued"),
+    ("OCR_MAX_CLIENT_JOBS", "client_jobs", "You have too many pages queued"),
+)
+RETRY_AFTER_UNKNOWN = 60  # seconds, until some pages were OCR'd
+RETRY_AFTER_MAX = 3600
+
+
+def capacity(client):
+    # what's left of each admission limit, null if unlimited
+    jobs = current_app.extensions[OCR_JOBS]
+    load = jobs.load(client)
+    left = {}
+    for config_key, load_key, _ in ADMISSION_LIMITS:
+        limit = current_app.config.get(config_key)
+        left[load_key] = max(limit - load[load_key], 0) if limit else None
+    left["pages_per_minute"] = round(jobs.throughput() * 60, 2)
+    return left
+
+
+def admission_error(client, size, pages=1):
+    # checked before the upload is parsed, with room for one more page and
+    # the bytes of the whole request, then for each page as it's spooled
+    jobs = current_app.extensions[OCR_JOBS]
+    load = jobs.load(client)
+    incoming = dict(jobs=pages, bytes=size, client_jobs=pages)
+    for config_key, load_key, message in ADMISSION_LIMITS:
+        limit = current_app.config.get(config_key)
+        if not limit or load[load_key] + incoming[load_key] <= limit:
+            continue
+        if load_key == "bytes" and incoming[load_key] > limit:
+            return {"error": f"Upload at most {limit} bytes at once"}, 413
+        excess = load[load_key] + incoming[load_key] - limit
+        if load_key == "bytes":
+            # in pages of the average queued size
+            excess = excess / (load["bytes"] / load["jobs"]) if load["jobs"] else 1
+        rate = jobs.throughput()
+        retry_after = min(max(math.ceil(excess / rate), 1), RETRY_AFTER_MAX) if rate else RETRY_AFTER_UNKNOWN
+        current_app.logger.info(f"Rejected an upload of {client}: {message}")
+        return {"error": f"{message}, retry in {retry_after} seconds"}, 429, {"Retry-After": str(retry_after)}
+    return None
+
+
 @v1.post('/new_pages')
+def new_pages():
+    rejected = admission_error(client_id(), request.content_length or 0)
+    if rejected is not None:
+        return rejected
+    return upload_new_pages()
+
+
 @stream_with_context
 @flashes_or_jsonlstream()
-def new_pages():
+def upload_new_pages():
     MAX_IMAGE_SIZE = current_app.config["MAX_IMAGE_SIZE"]
     STRICT_NEW_IMAGES = current_app.config["STRICT_NEW_IMAGES"]
+    REMOTE_WORKERS = current_app.config.get("OCR_REMOTE_WORKERS")
+    # return a batch id right away, its progress is at /v1/batches/<id>
+    ASYNC = bool(request.args.get('async'))
 
     # TODO: improve flashing messages to include file name
 
@@ -96,19 +239,38 @@ def new_pages():
     e_not_image = "Files need to be images"
     e_already_have = "We already have the page in cache"
     e_unnaceptable = "Ignoring new images because of unacceptable client error"
+    e_priority = f"Priority must be one of {', '.join(PRIORITIES)}"
+
+    client = client_id()
+    priority = PRIORITIES.get(request.args.get('priority', 'interactive'))
+    scheduler = current_app.extensions[OCR_SCHEDULER]
 
     def cflash(msg, cat):
         flash(msg, cat)
         return json.dumps([str(msg), str(cat)], ensure_ascii=False) + '\n'
 
+    def watch(hs):
+        # async uploads are followed through their batch instead
+        return None if ASYNC else current_app.extensions[OCR_JOBS].watch(hs)
+
     jobs = {}
+    pages = {}  # hash -> (name, state or None if queued, error) for the batch
+
+    if priority is None:
+        yield cflash(e_priority, "error")
+        return
 
-    if not request.files:
-        yield cflash("No files were uploaded", "error")
+    # the files are spooled as they're read from the request, never
+    # held in memory whole
+    uploads = MultipartFiles.from_request(request)
+    files = 0
+    uploaded_pages = set()
+    full = None  # the admission error once a page limit is reached
 
     try:
-        for hs, file in request.files.items():
-            hs = hs.lower()
+        for file in uploads or ():
+            files += 1
+            hs = file.name.lower()
             name = file.filename
 
             if not hash_reg.fullmatch(hs):
@@ -119,65 +281,102 @@ def new_pages():
                 if hs in current_app.queue:
                     yield cflash(f'Already have file "{name}" in queue', "success")
                     jobs[hs] = current_app.queue[hs]
+                    pages[hs] = (name, None, None)
+                    if priority == INTERACTIVE:
+                        scheduler.promote(hs)
                     continue
 
+            if current_app.extensions[OCR_JOBS].queued([hs]):
+                yield cflash(f'Already have file "{name}" in queue', "success")
+                jobs[hs] = watch(hs)
+                pages[hs] = (name, None, None)
+                continue
+
             if current_app.extensions[OCR_CACHE].has(hs):
                 yield cflash(f'Already have file "{name}" in cache', "success")
+                pages[hs] = (name, DONE, None)
                 continue
 
             if file.content_length and file.content_length > MAX_IMAGE_SIZE:
                 yield cflash(e_too_large, "error")
+                pages[hs] = (name, FAILED, e_too_large)
                 continue
 
             if file.mimetype and not file.mimetype.startswith("image/"):
                 yield cflash(e_not_image, "error")
+                pages[hs] = (name, FAILED, e_not_image)
                 continue
 
-            blob = file.read()
-
-            if not blob:
-                yield cflash(e_file_empty, "error")
+            # the pages of this request aren't claimed until it's read whole
+            full = full or admission_error(client, 0, len(uploaded_pages) + 1)
+            if full is not None:
+                error = full[0]["error"]
+                g.retry_after = full[2]["Retry-After"]
+                yield cflash(error, "error")
+                pages[hs] = (name, FAILED, error)
                 continue
 
-            if len(blob) > MAX_IMAGE_SIZE:
-                yield cflash(e_too_large, "error")
-                if STRICT_NEW_IMAGES:
-                    yield cflash(e_unnaceptable, "error")
-                    break
+            try:
+                path = current_app.extensions[OCR_JOBS].spool(
+                    hs, file.chunks(), MAX_IMAGE_SIZE, verify=True)
+            except UploadEmpty:
+                yield cflash(e_file_empty, "error")
+                pages[hs] = (name, FAILED, e_file_empty)
                 continue
-
-            if hs != md5(blob).hexdigest():
-                yield cflash(e_hash_no_match, "error")
+            except (UploadTooLarge, UploadHashMismatch) as e:
+                error = e_too_large if isinstance(e, UploadTooLarge) else e_hash_no_match
+                yield cflash(error, "error")
+                pages[hs] = (name, FAILED, error)
                 if STRICT_NEW_IMAGES:
                     yield cflash(e_unnaceptable, "error")
                     break
                 continue
 
-            temp_file = tempfile.NamedTemporaryFile(prefix="mokuro_page_")
-            temp_file.write(blob)
-            jobs[hs] = (hs, name, temp_file)
+            jobs[hs] = (hs, name, path)
+            pages[hs] = (name, None, None)
+            uploaded_pages.add(hs)
 
             yield cflash(f'Uploaded file "{name}" successfully', "success")
+
+        if not files:
+            yield cflash("No files were uploaded", "error")
     except Exception as e:
         yield cflash(f'Failed uploads: {e}', "error")
     finally:
+        if uploads is not None:
+            uploads.drain()
         with current_app.queue_lock:
             futures = []
             uploaded = 0
             for hs, job in jobs.items():
-                if isinstance(job, tuple) and hs not in current_app.queue:
-                    future = current_app.extensions[OCR_EXECUTOR].submit(
-                        do_page_ocr, *job)
+                if isinstance(job, tuple) and hs in current_app.queue:
+                    futures.append(current_app.queue[hs])
+                elif isinstance(job, tuple) and REMOTE_WORKERS:
+                    # left for the OCR worker nodes, unless another process queued it
+                    uploaded += current_app.extensions[OCR_JOBS].claim(
+                        *job, client, priority, local=False)
+                    futures.append(watch(hs))
+                elif isinstance(job, tuple) and current_app.extensions[OCR_JOBS].claim(
+                        *job, client, priority):
+                    future = scheduler.submit(
+                        hs, copy_current_request_context(partial(do_page_ocr, *job)),
+                        client, priority)
                     current_app.queue[hs] = future
                     futures.append(future)
                     uploaded += 1
                 elif isinstance(job, tuple):
-                    futures.append(current_app.queue[hs])
+                    # claimed by another process meanwhile
+                    futures.append(watch(hs))
                 else:
                     futures.append(job)
         if uploaded:
             current_app.logger.info(f'User uploaded {uploaded} files')
 
+    if ASYNC:
+        if pages:
+            yield cflash(current_app.extensions[OCR_JOBS].create_batch(pages), "batch")
+        return
+
     yield cflash('Awaiting OCR of files', "info")
 
     for future in concurrent.futures.as_completed(futures):
@@ -193,6 +392,175 @@ def new_pages():
         yield cflash('No files were processed', "warning")
 
 
+BATCH_POLL_INTERVAL = 0.5  # seconds between checks of the job store
+BATCH_MAX_WAIT = 30  # seconds a long-poll may wait for events
+BATCH_KEEPALIVE = 15  # seconds between comments on an idle event stream
+# An event stream holds a server thread too, it ends after BATCH_MAX_WAIT
+# seconds and EventSource reconnects this many ms later with Last-Event-ID
+BATCH_RECONNECT = 1000
+
+
+@v1.get('/batches/<batch>')
+def batch_progress(batch):
+    # Server-sent events with `Accept: text/event-stream`, resumed from the
+    # Last-Event-ID header, for BATCH_MAX_WAIT seconds at most. Otherwise a
+    # long-poll, returning the events after ?after= as soon as there are
+    # some or ?wait= seconds passed.
+    snapshot = current_app.extensions[OCR_JOBS].batch(batch)
+    if snapshot is None:
+        return {"error": "Unknown batch"}, 404
+    if request.accept_mimetypes.best == "text/event-stream":
+        after = request.headers.get("Last-Event-ID", request.args.get("after"))
+        return Response(stream_with_context(batch_event_stream(batch, snapshot, after)),
+                        content_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    try:
+        after = int(request.args.get("after", 0))
+        wait = min(float(request.args.get("wait", 0)), BATCH_MAX_WAIT)
+    except ValueError:
+        return {"error": "after must be an event id and wait a number of seconds"}, 400
+    pages, last_event = snapshot
+    deadline = time.monotonic() + wait
+    events = []
+    if after:
+        while True:
+            events = current_app.extensions[OCR_JOBS].batch_events(batch, after)
+            if events or time.monotonic() >= deadline or batch_complete(pages):
+                break
+            time.sleep(BATCH_POLL_INTERVAL)
+        pages, _ = current_app.extensions[OCR_JOBS].batch(batch)
+        last_event = max([after, *(event["id"] for event in events)])
+    return {"pages": pages, "events": events, "last_event": last_event,
+            "queue": batch_queue(pages), "complete": batch_complete(pages)}
+
+
+def batch_complete(pages):
+    return all(page["state"] in (DONE, FAILED) for page in pages.values())
+
+
+def batch_queue(pages):
+    # positions of this process' queued pages, null for other processes'
+    waiting = [key for key, page in pages.items() if page["state"] in (PENDING, RUNNING)]
+    positions = current_app.extensions[OCR_SCHEDULER].positions(waiting)
+    return {key: positions.get(key, {"position": None, "eta": None}) for key in waiting}
+
+
+def sse(event, data, event_id=None):
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines += [f"event: {event}", f"data: {json.dumps(data, ensure_ascii=False)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+def batch_event_stream(batch, snapshot, after=None):
+    pages, last_event = snapshot
+    deadline = time.monotonic() + BATCH_MAX_WAIT
+    yield f"retry: {BATCH_RECONNECT}\n\n"
+    if after is None or not str(after).isdigit():
+        # a new client gets the state of every page first
+        for key, page in pages.items():
+            yield sse("page", dict(key=key, **page), last_event)
+    else:
+        last_event = int(after)
+
+    queue = None
+    idle_since = time.monotonic()
+    while True:
+        for event in current_app.extensions[OCR_JOBS].batch_events(batch, last_event):
+            last_event = event.pop("id")
+            pages[event["key"]].update(state=event["state"], error=event["error"])
+            yield sse("page", event, last_event)
+            idle_since = time.monotonic()
+        if batch_complete(pages):
+            states = [page["state"] for page in pages.values()]
+            yield sse("complete", {DONE: states.count(DONE), FAILED: states.count(FAILED)})
+            return
+        positions = batch_queue(pages)
+        if positions != queue:
+            queue = positions
+            yield sse("queue", queue)
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since >= BATCH_KEEPALIVE:
+            yield ": keepalive\n\n"
+            idle_since = time.monotonic()
+        if time.monotonic() >= deadline:
+            # to be resumed from the last id the client saw
+            return
+        time.sleep(BATCH_POLL_INTERVAL)
+
+
+def worker_error():
+    # the worker API needs OCR_WORKER_TOKEN, POSTs name the worker
+    token = current_app.config.get("OCR_WORKER_TOKEN")
+    if not token:
+        return {"error": "OCR worker nodes are disabled"}, 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return {"error": "Invalid worker token"}, 401
+    if request.method == "POST" and not (
+            request.is_json and isinstance(request.json, dict) and
+            isinstance(request.json.get("worker"), str)):
+        return {"error": 'Only JSON objects with a "worker" name are accepted'}, 415
+    return None
+
+
+@v1.post('/worker/lease')
+def worker_lease():
+    error = worker_error()
+    if error is not None:
+        return error
+    jobs = current_app.extensions[OCR_JOBS]
+    while True:
+        job = jobs.lease(request.json["worker"])
+        if job is None:
+            return "", 204
+        if not reuse_near_duplicate(job["key"], job["name"], page_phash(job["name"], job["path"])):
+            break
+        finish_job(job["key"])
+    current_app.logger.info(f'Leased OCR of "{job["name"]}" to {request.json["worker"]}')
+    return {"key": job["key"], "name": job["name"], "lease_seconds": jobs.lease_seconds}
+
+
+@v1.get('/worker/jobs/<key>/image')
+def worker_image(key):
+    error = worker_error()
+    if error is not None:
+        return error
+    job = current_app.extensions[OCR_JOBS].get(key)
+    if job is None or job["state"] != RUNNING or not (job["path"] and Path(job["path"]).is_file()):
+        return {"error": "The job has no image"}, 404
+    return send_file(job["path"], "application/octet-stream")
+
+
+@v1.post('/worker/jobs/<key>/lease')
+def worker_renew(key):
+    error = worker_error()
+    if error is not None:
+        return error
+    if not current_app.extensions[OCR_JOBS].renew(key, request.json["worker"]):
+        return {"error": "The job isn't leased to this worker"}, 409
+    return {"key": key}
+
+
+@v1.post('/worker/jobs/<key>')
+def worker_result(key):
+    # {"worker": name, "result": {...}} or {"worker": name, "error": "..."}
+    error = worker_error()
+    if error is not None:
+        return error
+    job = current_app.extensions[OCR_JOBS].get(key)
+    if job is None or job["state"] != RUNNING or job["owner"] != request.json["worker"]:
+        # the lease expired and the job went to another worker
+        return {"error": "The job isn't leased to this worker"}, 409
+    error = request.json.get("error")
+    if error is None:
+        if not isinstance(request.json.get("result"), dict):
+            return {"error": "The OCR result must be a JSON object"}, 415
+        current_app.extensions[OCR_CACHE].set(key, request.json["result"])
+        index_page(key, page_phash(job["name"], job["path"]))
+        current_app.logger.info(f'Finished OCR of "{job["name"]}" on {request.json["worker"]}')
+    finish_job(key, error and str(error))
+    return {"key": key, "state": FAILED if error else DONE}
+
+
 @v1.post('/make_html')
 def make_html():
     if not (
@@ -214,12 +582,11 @@ def make_html():
     paths = tuple(map(lambda it: it[0].strip(), request.json["page_map"]))
 
     try:
-        og = overlay_generator()
         page_htmls = [
-            og.get_page_html(result, PurePath(path))
+            overlay.page_html(result, PurePath(path))
             for path, result in zip(paths, results)
         ]
-        return og.get_index_html(page_htmls, f'{title} | mokuro', True, False)
+        return overlay.index_html(page_htmls, f'{title} | mokuro', True, False)
 
     except Exception as e:
         return {"error": str(e)}, 400
@@ -248,23 +615,107 @@ def valid_image_map(img_map):
     )
 
 
-def map_recursive(func, obj):
-    if isinstance(obj, dict):
-        return {k: map_recursive(func, v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [map_recursive(func, elem) for elem in obj]
-    else:
-        return func(obj)
+def resume_jobs(adopted):
+    # queue the jobs adopted from the last run or from a dead process,
+    # needs a request context
+    jobs = current_app.extensions[OCR_JOBS]
+    resumed = 0
+    for job in adopted:
+        hs = job["key"]
+        if not (job["path"] and Path(job["path"]).is_file()):
+            jobs.finish(hs, "The uploaded file was lost")
+            continue
+        with current_app.queue_lock:
+            if hs in current_app.queue:
+                continue
+            current_app.queue[hs] = current_app.extensions[OCR_SCHEDULER].submit(
+                hs, copy_current_request_context(
+                    partial(do_page_ocr, hs, job["name"], job["path"])),
+                job["client"], job["priority"])
+        resumed += 1
+    if resumed:
+        current_app.logger.info(f"Resumed {resumed} OCR jobs")
+    return resumed
+
+
+def refresh_slots():
+    # how many pages could be refreshed now without delaying anyone's
+    if current_app.config.get("OCR_REMOTE_WORKERS"):
+        # worker nodes come and go, one page at a time when nothing is queued
+        return 0 if current_app.extensions[OCR_JOBS].load()["jobs"] else 1
+    scheduler = current_app.extensions[OCR_SCHEDULER].stats()
+    slots = scheduler["workers"]
+    if OCR_PIPELINE in current_app.extensions:
+        # any more would wait inside the pipeline, ahead of new pages
+        slots = current_app.config.get("OCR_BATCH_PAGES", 1)
+    return 0 if scheduler["waiting"] else max(slots - scheduler["running"], 0)
+
+
+def refresh_page(hs):
+    # queue the re-OCR of a cached page from its kept image, behind every
+    # other page. Needs a request context
+    jobs = current_app.extensions[OCR_JOBS]
+    remote = current_app.config.get("OCR_REMOTE_WORKERS")
+    with current_app.queue_lock:
+        if hs in current_app.queue or jobs.queued([hs]):
+            return False
+        path = jobs.respool(hs)
+        if path is None:
+            return False
+        if not jobs.claim(hs, hs, path, None, IDLE, local=not remote):
+            Path(path).unlink(missing_ok=True)
+            return False
+        if not remote:
+            current_app.queue[hs] = current_app.extensions[OCR_SCHEDULER].submit(
+                hs, copy_current_request_context(partial(do_page_ocr, hs, hs, path)), None, IDLE)
+    return True
+
+
+def page_phash(name, path):
+    # (dhash, width, height, thumbnail) of a spooled page, None without OCR_PHASH
+    if OCR_PHASH not in current_app.extensions or not path:
+        return None
+    try:
+        return dhash(str(path))
+    except Exception as e:
+        current_app.logger.warning(f'Failed hashing "{name}": {e}')
+        return None
+
+
+def reuse_near_duplicate(hs, name, phash):
+    # caches and returns the result of a known page that looks like this
+    # one, or returns None
+    if phash is None:
+        return None
+    index = current_app.extensions[OCR_PHASH]
+    phash, width, height, thumb = phash
+    for key in index.similar(phash, width, height, thumb, exclude=hs):
+        result = current_app.extensions[OCR_CACHE].get(key)
+        if result is None:
+            # evicted from the cache, unless it's being OCR'd again
+            if not current_app.extensions[OCR_JOBS].queued([key]):
+                index.discard(key)
+            continue
+        if is_stale(result, current_app.config.get("OCR_REFRESH_VERSION")):
+            continue
+        result = rescale_result(result, width, height)
+        current_app.extensions[OCR_CACHE].set(hs, result)
+        index.add(hs, phash, width, height, thumb)
+        current_app.logger.info(f'Reused the OCR of {key} for "{name}"')
+        return result
+    return None
 
 
-def numpy_to_native(v):
-    # numpy dtypes have a .item() to convert themselves to a native python type
-    return v.item() if hasattr(v, "item") else v
+def index_page(hs, phash):
+    # once its result is cached, so the pages that look like it can reuse it
+    if phash is not None:
+        current_app.extensions[OCR_PHASH].add(hs, *phash)
 
 
-def do_page_ocr(hs, name, temp_file):
+def do_page_ocr(hs, name, path):
+    result = {"error": "Internal Server Error"}
     try:
-        path = Path(temp_file.name)
+        path = Path(path)
 
         if not path.exists():
             raise Exception("Internal Server Error: path doesn't exists")
@@ -273,17 +724,45 @@ def do_page_ocr(hs, name, temp_file):
 
         flash(f'Starting OCR of "{name}"', "info")
         current_app.logger.info(f'Starting OCR of "{name}"')
-        result = manga_page_ocr(path)
-        result = map_recursive(numpy_to_native, result)
-        current_app.extensions[OCR_CACHE].set(hs, result)
+        current_app.extensions[OCR_JOBS].mark(hs, RUNNING)
+        phash = page_phash(name, path)
+        result = reuse_near_duplicate(hs, name, phash)
+        if result:
+            return hs, name, result
+        pool = current_app.extensions.get(OCR_PROCESS_POOL)
+        pipeline = current_app.extensions.get(OCR_PIPELINE)
+        if pool is not None:
+            result = pool.ocr(path)
+            current_app.extensions[OCR_CACHE].set(hs, result)
+        elif pipeline is not None:
+            # the pipeline stores the result itself
+            result = pipeline.ocr(path, hs)
+        else:
+            result = manga_page_ocr(path)
+            result = map_recursive(numpy_to_native, result)
+            current_app.extensions[OCR_CACHE].set(hs, result)
+        index_page(hs, phash)
 
         return hs, name, result
-    except AttributeError:
-        return hs, name, {"error": "Animation file, Corrupted file or Unsupported type"}
     except Exception as e:
-        return hs, name, {"error": str(e)}
+        result = {"error": INVALID_IMAGE if is_invalid_image(e) else str(e)}
+        return hs, name, result
     finally:
         with current_app.queue_lock:
             del current_app.queue[hs]
-        # either way, when temp_file is garbage collected, it will be deleted
-        temp_file.close()
+        # either way the spooled image isn't needed anymore
+        finish_job(hs, result.get("error"))
+
+
+def finish_job(hs, error=None):
+    # other processes take a finished job's result from the cache, so with
+    # the write-behind buffer it's done once the buffer is flushed
+    jobs = current_app.extensions[OCR_JOBS]
+    when_flushed = find_method(current_app.extensions[OCR_CACHE], "when_flushed")
+    if when_flushed is None or error:
+        jobs.finish(hs, error)
+        return
+
+    def finish(flush_error):
+        jobs.finish(hs, flush_error and f"Storing the result failed: {flush_error}")
+    when_flushed(hs, finish)
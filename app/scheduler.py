@@ -0,0 +1,148 @@
+from concurrent.futures import Future
+from heapq import heappush, heappop
+import itertools
+import threading
+import logging
+import time
+
+INTERACTIVE = 0
+BACKGROUND = 1
+IDLE = 2  # re-OCR of stale results, never asked for by clients
+PRIORITIES = {"interactive": INTERACTIVE, "background": BACKGROUND}
+
+
+class FairScheduler:
+    # Runs OCR jobs on `workers` threads. Pages someone waits on go before
+    # background ones, and within a priority the clients take turns (start
+    # time fair queuing, a client's weight is its share of the workers).
+    # Each client's pages keep their upload order.
+
+    def __init__(self, workers=1, weights=None, logger=None, ewma_alpha=0.2):
+        self.workers = max(int(workers), 1)
+        self.weights = weights or {}
+        for client, weight in self.weights.items():
+            if not weight > 0:
+                raise ValueError(f"The scheduler weight of '{client}' must be positive, not {weight}")
+        self.logger = logger or logging.getLogger(__name__)
+        self.ewma_alpha = ewma_alpha
+        self._cond = threading.Condition()
+        self._heap = []  # [priority, tag, seq, key], key is None once removed
+        self._jobs = {}  # key -> waiting job
+        self._running = {}  # key -> start time
+        self._client_tags = {}  # of the clients that could still be behind
+        self._client_jobs = {}  # client -> waiting jobs
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._threads = []
+        self.avg_seconds = None  # moving average of the time per page
+        self._stats = dict(submitted=0, completed=0, failed=0, promoted=0)
+
+    def _ensure_threads(self):
+        # with _cond held
+        if self._threads:
+            return
+        for n in range(self.workers):
+            thread = threading.Thread(
+                target=self._loop, name=f"ocr-scheduler-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn, client=None, priority=INTERACTIVE):
+        with self._cond:
+            self._ensure_threads()
+            # a client's pages are spaced 1 / weight apart in virtual time,
+            # an idle client starts over at the current virtual time
+            tag = max(self._vtime, self._client_tags.get(client, 0.0)) + \
+                1 / self.weights.get(client, 1)
+            self._client_tags[client] = tag
+            self._client_jobs[client] = self._client_jobs.get(client, 0) + 1
+            entry = [priority, tag, next(self._seq), key]
+            job = dict(entry=entry, fn=fn, future=Future(), client=client)
+            self._jobs[key] = job
+            heappush(self._heap, entry)
+            self._stats["submitted"] += 1
+            self._cond.notify()
+            return job["future"]
+
+    def promote(self, key, priority=INTERACTIVE):
+        # someone is waiting for a page that was queued in the background
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is None or job["entry"][0] <= priority:
+                return False
+            old = job["entry"]
+            job["entry"] = [priority, *old[1:]]
+            old[3] = None
+            heappush(self._heap, job["entry"])
+            self._stats["promoted"] += 1
+            return True
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][3] is None:
+                    heappop(self._heap)
+                if self._heap:
+                    break
+                self._cond.wait()
+            _, tag, _, key = heappop(self._heap)
+            self._vtime = tag
+            self._running[key] = time.monotonic()
+            job = self._jobs.pop(key)
+            self._client_jobs[job["client"]] -= 1
+            if not self._client_jobs[job["client"]]:
+                del self._client_jobs[job["client"]]
+            # an idle client at or before the virtual time starts over from it
+            # anyway, forget it
+            for client in [c for c, t in self._client_tags.items()
+                           if t <= tag and c not in self._client_jobs]:
+                del self._client_tags[client]
+            return key, job
+
+    def _loop(self):
+        while True:
+            key, job = self._next_job()
+            future = job["future"]
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(job["fn"]())
+                except BaseException as e:
+                    failed = True
+                    future.set_exception(e)
+            with self._cond:
+                elapsed = time.monotonic() - self._running.pop(key)
+                self._stats["failed" if failed else "completed"] += 1
+                if not failed:
+                    self.avg_seconds = elapsed if self.avg_seconds is None else (
+                        self.ewma_alpha * elapsed + (1 - self.ewma_alpha) * self.avg_seconds)
+
+    def positions(self, keys):
+        # {key: {"position", "eta"}} for the queued keys, position 0 is running
+        with self._cond:
+            waiting = sorted(entry for entry in self._heap if entry[3] is not None)
+            order = {entry[3]: i + 1 for i, entry in enumerate(waiting)}
+            now = time.monotonic()
+            avg = self.avg_seconds
+            positions = {}
+            for key in keys:
+                if key in self._running:
+                    eta = None if avg is None else max(avg - (now - self._running[key]), 0.0)
+                    positions[key] = dict(position=0, eta=eta)
+                elif key in order:
+                    # pages are OCR'd `workers` at a time
+                    eta = None if avg is None else \
+                        ((order[key] - 1) // self.workers + 1) * avg
+                    positions[key] = dict(position=order[key], eta=eta)
+            return positions
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                waiting=len(self._jobs), running=len(self._running),
+                clients=len({job["client"] for job in self._jobs.values()}),
+                workers=self.workers, avg_seconds=self.avg_seconds)
+        stats["pages_per_minute"] = (
+            60 * self.workers / stats["avg_seconds"] if stats["avg_seconds"] else None)
+        return stats
@@ -0,0 +1,112 @@
+from time import time
+import tempfile
+import struct
+import json
+import zlib
+
+# A snapshot is MAGIC, a length-prefixed json header and then one record per
+# cached page, keyed by the md5 of the page image like the cache itself:
+#   key length, value length, exp, updated, crc32 of the value, key, value.
+# Values are copied as stored (already compressed by the cache codec).
+# A record with an empty key ends the file, followed by the record count.
+MAGIC = b"MOKURO-OCR-SNAPSHOT\x01"
+_RECORD = struct.Struct(">HIddI")
+_COUNT = struct.Struct(">Q")
+_HEADER_SIZE = struct.Struct(">I")
+
+MERGE_RULES = ("newer", "skip", "replace")
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def export_snapshot(cache, f, since=None, batch_size=1000):
+    header = json.dumps(dict(created=time(), since=since)).encode()
+    f.write(MAGIC + _HEADER_SIZE.pack(len(header)) + header)
+    count = 0
+    for key, val, exp, updated, _, _ in cache.iter_rows(batch_size, since):
+        if not cache.codec.is_framed(val):
+            # legacy row, store it in the current format
+            val = cache.codec.encode(cache.codec.decode(val))
+        key = key.encode()
+        f.write(_RECORD.pack(len(key), len(val), exp or 0,
+                updated or 0, zlib.crc32(val)))
+        f.write(key)
+        f.write(val)
+        count += 1
+    f.write(_RECORD.pack(0, 0, 0, 0, 0) + _COUNT.pack(count))
+    return count
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise SnapshotError("The snapshot is truncated")
+    return data
+
+
+def read_snapshot(f):
+    # yields (key, val, exp, updated) and checks the file on the way
+    if f.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError("Not an OCR cache snapshot")
+    header_size, = _HEADER_SIZE.unpack(_read(f, _HEADER_SIZE.size))
+    _read(f, header_size)
+    count = 0
+    while True:
+        key_size, val_size, exp, updated, crc = _RECORD.unpack(
+            _read(f, _RECORD.size))
+        if not key_size:
+            break
+        key = _read(f, key_size).decode()
+        val = _read(f, val_size)
+        if zlib.crc32(val) != crc:
+            raise SnapshotError(f"Corrupted value for '{key}'")
+        count += 1
+        yield key, val, exp, updated
+    expected, = _COUNT.unpack(_read(f, _COUNT.size))
+    if expected != count:
+        raise SnapshotError(f"Expected {expected} records, read {count}")
+
+
+class _Tee:
+    # keeps a copy of what is read from f
+
+    def __init__(self, f, copy):
+        self.f = f
+        self.copy = copy
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.copy.write(data)
+        return data
+
+
+def import_snapshot(cache, f, merge="newer", batch_size=10_000):
+    # loads the records in transactions of batch_size rows,
+    # returns (records read, rows written)
+    if merge not in MERGE_RULES:
+        raise ValueError(f"Invalid merge rule '{merge}'")
+    with tempfile.TemporaryFile() as copy:
+        # the whole snapshot is checked before writing anything, a truncated
+        # or corrupted one would leave a partial import behind
+        for key, val, _, _ in read_snapshot(_Tee(f, copy)):
+            if not cache.codec.can_decode(val):
+                raise SnapshotError(
+                    f"'{key}' was compressed with a codec or dictionary "
+                    "that isn't available here")
+        copy.seek(0)
+
+        now = time()
+        read, written, batch = 0, 0, []
+        for key, val, exp, updated in read_snapshot(copy):
+            if exp and exp <= now:
+                continue
+            batch.append((key, val, exp, updated, now, 0))
+            read += 1
+            if len(batch) >= batch_size:
+                written += cache.insert_rows(batch, merge) or 0
+                batch = []
+        if batch:
+            written += cache.insert_rows(batch, merge) or 0
+    return read, written
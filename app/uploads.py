@@ -0,0 +1,80 @@
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.http import parse_options_header
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadedFile:
+    # A file part of a multipart body. Its data is read from the request
+    # as chunks() is consumed, and skipped if it isn't.
+
+    def __init__(self, event, chunks):
+        self.name = event.name
+        self.filename = event.filename
+        self.headers = event.headers
+        self.mimetype = parse_options_header(event.headers.get("content-type", ""))[0]
+        content_length = event.headers.get("content-length", "")
+        self.content_length = int(content_length) if content_length.isdigit() else 0
+        self._chunks = chunks
+
+    def chunks(self):
+        return self._chunks
+
+
+class MultipartFiles:
+    # Iterates over the files of a multipart/form-data body without
+    # buffering them, unlike request.files. Other fields are skipped.
+
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = MultipartDecoder(boundary.encode())
+        self.finished = False
+
+    @classmethod
+    def from_request(cls, request, chunk_size=CHUNK_SIZE):
+        # None if the request isn't multipart
+        mimetype, options = parse_options_header(request.headers.get("content-type", ""))
+        if mimetype != "multipart/form-data" or not options.get("boundary"):
+            return None
+        return cls(request.stream, options["boundary"], chunk_size)
+
+    def _next_event(self):
+        while True:
+            event = self.decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            self.decoder.receive_data(self.stream.read(self.chunk_size) or None)
+
+    def _data(self):
+        # the data of the current part
+        while True:
+            event = self._next_event()
+            if not isinstance(event, Data):
+                raise ValueError("Malformed multipart body")
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+    def __iter__(self):
+        while not self.finished:
+            event = self._next_event()
+            if isinstance(event, Epilogue):
+                self.finished = True
+            elif isinstance(event, File):
+                data = self._data()
+                yield UploadedFile(event, data)
+                # whatever the caller didn't read
+                for _ in data:
+                    pass
+            elif isinstance(event, Field):
+                for _ in self._data():
+                    pass
+
+    def drain(self):
+        # reads the rest of the body, so the connection can be reused
+        if not self.finished:
+            while self.stream.read(self.chunk_size):
+                pass
+            self.finished = True
@@ -0,0 +1,131 @@
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from functools import partial
+from .ocr import INVALID_IMAGE, is_invalid_image, map_recursive, numpy_to_native
+import multiprocessing
+import threading
+import logging
+import socket
+import json
+import os
+
+
+def local_page_ocr(image, detect_max_side=None):
+    from . import ocr_image
+    return map_recursive(numpy_to_native, ocr_image(image, detect_max_side=detect_max_side))
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class OcrWorker:
+    # Pulls OCR jobs from a web node running with OCR_REMOTE_WORKERS, see
+    # the /v1/worker routes. The lease of a job is renewed while its page
+    # is OCR'd, if the worker dies the job is retried by another one.
+    # Images are OCR'd from memory, ocr gets a memoryview of the download.
+
+    def __init__(self, url, token, ocr=local_page_ocr, name=None,
+                 poll_interval=2.0, timeout=60, logger=None):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.ocr = ocr
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+    def _request(self, path, body=None):
+        # the response body, None for 204 No Content
+        data = None if body is None else json.dumps({"worker": self.name, **body}).encode()
+        request = Request(f"{self.url}/v1/worker{path}", data, {
+            "Authorization": f"Bearer {self.token}", "Content-Type": "application/json"})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return None if response.status == 204 else response.read()
+        except HTTPError as e:
+            if e.code == 409:
+                raise LeaseLost(path) from e
+            raise
+
+    def lease(self):
+        body = self._request("/lease", {})
+        return None if body is None else json.loads(body)
+
+    def _renew(self, job, done):
+        # every third of the lease until done is set
+        while not done.wait(job["lease_seconds"] / 3):
+            try:
+                self._request(f"/jobs/{job['key']}/lease", {})
+            except LeaseLost:
+                self.logger.warning(f'Lost the lease of "{job["name"]}"')
+                return
+            except Exception as e:
+                self.logger.error(f'Failed renewing the lease of "{job["name"]}": {e}')
+
+    def run_job(self, job):
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(job, done), daemon=True)
+        renewer.start()
+        try:
+            image = memoryview(self._request(f"/jobs/{job['key']}/image"))
+            self.logger.info(f'Starting OCR of "{job["name"]}"')
+            try:
+                body = {"result": self.ocr(image)}
+            except Exception as e:
+                body = {"error": INVALID_IMAGE if is_invalid_image(e) else str(e)}
+        finally:
+            done.set()
+        self._request(f"/jobs/{job['key']}", body)
+        self.logger.info(f'Finished OCR of "{job["name"]}"')
+
+    def run_once(self):
+        # False if there was nothing to do
+        job = self.lease()
+        if job is None:
+            return False
+        try:
+            self.run_job(job)
+        except LeaseLost:
+            self.logger.warning(f'Dropped the OCR of "{job["name"]}", its lease expired')
+        return True
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        self.logger.info(f"OCR worker {self.name} pulling jobs from {self.url}")
+        while not stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except (HTTPError, URLError, OSError) as e:
+                self.logger.error(f"OCR worker request failed: {e}")
+            stop.wait(self.poll_interval)
+
+
+def run_worker(url, token, poll_interval=2.0, preload=True, detect_max_side=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(message)s")
+    if preload:
+        from . import manga_page_ocr
+        manga_page_ocr()
+    ocr = partial(local_page_ocr, detect_max_side=detect_max_side)
+    OcrWorker(url, token, ocr, poll_interval=poll_interval).run()
+
+
+def run_workers(url, token, processes=1, poll_interval=2.0, preload=True, detect_max_side=None):
+    # each process loads its own models and pulls its own jobs
+    if processes <= 1:
+        return run_worker(url, token, poll_interval, preload, detect_max_side)
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(url, token, poll_interval, preload, detect_max_side),
+                        name=f"ocr-worker-{n}")
+        for n in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,60 @@
+# Latency of SqliteCache bulk lookups (has_many / get_many) by number of keys.
+#
+#   python benchmarks/bench_bulk_lookup.py [entries]
+import json
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from app.db import SqliteCache  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+SIZES = (10, 1_000, 50_000)
+
+
+def timed(func, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best * 1000
+
+
+def single_in(cache, sql, keys):
+    # what the cache did before: one statement with a placeholder per key
+    with cache.get_connection() as conn:
+        return conn.execute(sql.format(','.join('?' * len(keys))), keys).fetchall()
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with open(ROOT / "tests/res/test_chapter.json", "r", encoding="utf-8") as f:
+        page = next(iter(json.load(f).values()))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = SqliteCache(str(Path(tmp) / "bench.sqlite3"), use_json=True)
+        keys = [f"{i:032x}" for i in range(entries)]
+        cache.set_many({key: page for key in keys})
+
+        print(f"{entries} entries, sqlite {sqlite3.sqlite_version}")
+        print(f"{'keys':>7} {'has_many':>10} {'get_many':>10} {'single IN':>10}")
+        for size in SIZES:
+            # half of the keys hit, half miss
+            lookup = keys[:size // 2] + [f"{i:032}" for i in range(size - size // 2)]
+            rounds = 20 if size < 10_000 else 3
+            has_ms = timed(lambda: cache.has_many(*lookup), rounds)
+            get_ms = timed(lambda: cache.get_many(*lookup), rounds)
+            try:
+                old_ms = f"{timed(lambda: single_in(cache, cache._HAS_MANY_SQL, lookup), rounds):>8.2f}ms"
+            except sqlite3.OperationalError as e:
+                old_ms = f"{'error':>10}  ({e})"
+            print(f"{size:>7} {has_ms:>8.2f}ms {get_ms:>8.2f}ms {old_ms}")
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
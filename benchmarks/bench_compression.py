@@ -0,0 +1,68 @@
+# Compression ratio and cost of the OCR cache codecs on real pages.
+#
+#   python benchmarks/bench_compression.py [chapter.json ...]
+import json
+import sys
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from app.compression import ValueCodec, make_codec, train_dictionary  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+DEFAULT_CHAPTERS = [ROOT / "tests/res/test_chapter.json"]
+
+
+def load_pages(paths):
+    pages = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            pages.extend(json.load(f).values())
+    return [json.dumps(page, ensure_ascii=False).encode() for page in pages]
+
+
+def bench(name, codec, pages, rounds=50):
+    value_codec = ValueCodec(codec)
+    encoded = [value_codec.encode(page) for page in pages]
+
+    start = perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            value_codec.encode(page)
+    encode_us = (perf_counter() - start) / rounds / len(pages) * 1e6
+
+    start = perf_counter()
+    for _ in range(rounds):
+        for value in encoded:
+            value_codec.decode(value)
+    decode_us = (perf_counter() - start) / rounds / len(pages) * 1e6
+
+    raw = sum(map(len, pages))
+    stored = sum(map(len, encoded))
+    print(f"{name:<12} {raw:>9} {stored:>9} {raw / stored:>6.2f}x "
+          f"{encode_us:>9.1f}us {decode_us:>9.1f}us")
+
+
+def main():
+    pages = load_pages(sys.argv[1:] or DEFAULT_CHAPTERS)
+    # dictionaries are trained on every other page
+    samples = pages[::2] or pages
+
+    print(f"{len(pages)} pages")
+    print(f"{'codec':<12} {'raw':>9} {'stored':>9} {'ratio':>7} {'encode':>11} {'decode':>11}")
+    bench("none", make_codec("none"), pages)
+    for level in (1, 6, 9):
+        bench(f"zlib-{level}", make_codec("zlib", level), pages)
+    bench("zlib-dict", make_codec(
+        "zlib", dictionary=train_dictionary("zlib", samples)), pages)
+    try:
+        bench("zstd-3", make_codec("zstd", 3), pages)
+        # the zstd trainer refuses to work with only a handful of samples
+        bench("zstd-dict", make_codec(
+            "zstd", 3, train_dictionary("zstd", samples * 10, 16 * 1024)), pages)
+    except ImportError as e:
+        print(f"zstd skipped: {e}")
+
+
+if __name__ == "__main__":
+    main()
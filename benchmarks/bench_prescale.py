@@ -0,0 +1,85 @@
+# Latency and accuracy of the OCR when pages are downscaled for the text
+# detector (OCR_DETECT_MAX_SIDE). Accuracy is against the full size run:
+# how similar the text is and how well the line boxes overlap. Pages are
+# also upscaled 2x and 4x, like the raw scans some users upload. It needs
+# mokuro's models, downloaded from GitHub and Hugging Face on the first run.
+#
+#   python benchmarks/bench_prescale.py [image ...]
+import sys
+from difflib import SequenceMatcher
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from app import batched_page_ocr  # noqa: E402
+from app.ocr import BatchedPageOcr  # noqa: E402
+
+ROOT = Path(__file__).parent.parent
+DEFAULT_PAGES = [ROOT / "tests/res/page1.webp", ROOT / "tests/res/page2.jpg"]
+TARGETS = (None, 3072, 2048, 1536, 1024)
+UPSCALES = (1, 2, 4)
+
+
+def load_pages(paths):
+    import cv2
+    pages = []
+    for path in paths:
+        img, _ = BatchedPageOcr.decode(str(path))
+        for factor in UPSCALES:
+            H, W = img.shape[:2]
+            pages.append((f"{Path(path).name} x{factor}", cv2.resize(
+                img, (W * factor, H * factor), interpolation=cv2.INTER_CUBIC)))
+    return pages
+
+
+def text(result):
+    return "\n".join(line for block in result["blocks"] for line in block["lines"])
+
+
+def box_iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(x2 - x1, 0) * max(y2 - y1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union else 1.0
+
+
+def mean_box_iou(result, baseline):
+    # each baseline block against its best match
+    boxes = [block["box"] for block in result["blocks"]]
+    if not baseline["blocks"]:
+        return 1.0
+    return sum(
+        max((box_iou(block["box"], box) for box in boxes), default=0.0)
+        for block in baseline["blocks"]) / len(baseline["blocks"])
+
+
+def run(page_ocr, img, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = perf_counter()
+        result, = page_ocr([img])
+        best = min(best, perf_counter() - start)
+    if isinstance(result, Exception):
+        raise result
+    return result, best * 1000
+
+
+def main():
+    pages = load_pages(sys.argv[1:] or DEFAULT_PAGES)
+    page_ocrs = {target: batched_page_ocr(16, target) for target in TARGETS}
+
+    print(f"{'page':<18} {'size':>11} {'target':>7} {'latency':>10} {'text':>7} {'boxes':>7}")
+    for name, img in pages:
+        H, W = img.shape[:2]
+        baseline = None
+        for target, page_ocr in page_ocrs.items():
+            result, ms = run(page_ocr, img, rounds=3)
+            baseline = baseline or result
+            similarity = SequenceMatcher(None, text(baseline), text(result)).ratio()
+            print(f"{name:<18} {f'{W}x{H}':>11} {target or 'full':>7} {ms:>8.0f}ms "
+                  f"{similarity:>7.3f} {mean_box_iou(result, baseline):>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,96 @@ class Config(object):
     OCR_CACHE_THRESHOLD = 0
     OCR_CACHE_DEFAULT_TIMEOUT = 0
     OCR_CACHE_IGNORE_ERRORS = False
+    OCR_CACHE_SYNCHRONOUS = "NORMAL"  # OFF, NORMAL, FULL or EXTRA
+    OCR_CACHE_MMAP_SIZE = 268_435_456  # 256MB
+    OCR_CACHE_CACHE_SIZE = -16_000  # negative is in KiB, so ~16MB per connection
+    OCR_CACHE_JANITOR_INTERVAL = 60  # seconds between eviction passes
+    OCR_CACHE_JANITOR_WRITES = 100  # or after this many writes, whichever is first
+    OCR_CACHE_LOW_WATERMARK = 0.9  # evict down to 90% of the limits
+    OCR_CACHE_EVICTION = "lru"  # lru, lfu or fifo
+    OCR_CACHE_ACCESS_BATCH = 500  # buffered reads before an access-time flush
+    OCR_CACHE_COMPRESSION = "zlib"  # none, zlib or zstd (needs `zstandard`)
+    OCR_CACHE_COMPRESSION_LEVEL = None  # codec default
+    # Preset dictionary file made by `flask cache train-dict`.
+    # Don't change it once rows were compressed with it.
+    OCR_CACHE_COMPRESSION_DICT = None
+    # With OCR_CACHE_TYPE = "app.db.ShardedSqliteCache" the keys are spread
+    # over OCR_CACHE_SHARDS files, see `flask cache reshard`
+    OCR_CACHE_SHARDS = 4
+    OCR_CACHE_SHARD_LIMITS = "global"  # global splits the limits, or per_shard
+    # In-process tier in front of OCR_CACHE for hot pages, in bytes of json
+    OCR_MEMORY_TIER_MAX_BYTES = 0  # 0 disables it
+    # Merge new OCR results into one write per interval (seconds) or batch
+    OCR_WRITE_BEHIND_INTERVAL = 0  # 0 disables it
+    OCR_WRITE_BEHIND_BATCH = 32
     OCR_EXECUTOR_MAX_WORKERS = 1
+    # Share of the OCR workers of each client (X-Client-Id header or address),
+    # the others get 1
+    OCR_SCHEDULER_WEIGHTS = {}
+    # Set when several processes serve the app from the same OCR_JOBS_PATH.
+    # It turns off OCR_MEMORY_TIER_MAX_BYTES and OCR_WRITE_BEHIND_INTERVAL,
+    # which would hide results from the other processes.
+    OCR_MULTIPROCESS = False
+    # Queued jobs and their uploaded images, kept across restarts
+    OCR_JOBS_PATH = "./ocr_jobs.sqlite3"
+    OCR_SPOOL_DIR = "./ocr_spool"
+    OCR_JOBS_KEEP_FINISHED = 86400  # seconds finished jobs are remembered
+    # Processes sharing OCR_JOBS_PATH take over the jobs of a process that
+    # didn't renew them for this many seconds
+    OCR_JOBS_LEASE = 30
+    # Leave the OCR to `mokuro-online worker` nodes, which pull the jobs
+    # from /v1/worker with OCR_WORKER_TOKEN. A job whose worker stops
+    # renewing its lease is retried, up to OCR_JOBS_MAX_ATTEMPTS times.
+    OCR_REMOTE_WORKERS = False
+    OCR_WORKER_TOKEN = None  # None disables the worker API
+    OCR_JOBS_MAX_ATTEMPTS = 3
+    # Uploads that would queue more than these get a 429 with a Retry-After
+    # from the measured OCR throughput, 0 is unlimited. The pages of an
+    # upload past a limit are turned away one by one, the others are queued.
+    OCR_MAX_QUEUED_JOBS = 0  # pages queued by everyone
+    OCR_MAX_QUEUED_BYTES = 0  # bytes of the queued pages
+    OCR_MAX_CLIENT_JOBS = 0  # pages queued by a client
+    # Run the OCR in this many worker processes, each with its own models.
+    # Keep workers * torch threads within the cpu cores.
+    OCR_PROCESS_WORKERS = 0  # 0 runs it in the executor threads
+    OCR_PROCESS_TORCH_THREADS = None  # cpu cores / workers
+    # Split the OCR into decode, detect, crop, recognize and finish stages
+    # running on their own threads, see /v1/stats for their timings. To keep
+    # it full, OCR_EXECUTOR_MAX_WORKERS is raised to 2 * OCR_BATCH_PAGES + 3
+    # pages OCR'd at once, so the clients take turns less finely.
+    OCR_PIPELINE = False
+    OCR_PIPELINE_WORKERS = dict(decode=2, prescale=1, detect=1, crop=1, recognize=1, finish=1)
+    OCR_PIPELINE_QUEUE_SIZE = 8  # pages waiting before each stage
+    # Run the text detector over up to OCR_BATCH_PAGES queued pages at once,
+    # waiting at most OCR_BATCH_MAX_WAIT seconds for them, and the recognizer
+    # over OCR_BATCH_LINES line crops. Bigger batches trade latency for throughput.
+    OCR_BATCH_PAGES = 4
+    OCR_BATCH_MAX_WAIT = 0.05
+    OCR_BATCH_LINES = 16
+    # Detect the text of pages with a longer edge than this on a downscaled
+    # copy, the lines are still read at full size. None detects at full size.
+    # No sizes have been measured yet: run benchmarks/bench_prescale.py on the
+    # server's pages to see the latency and accuracy of each one before setting it.
+    OCR_DETECT_MAX_SIDE = None
+    # Reuse the OCR of a cached page that looks the same as a new one, like
+    # the same scan re-encoded: their dHashes are at most
+    # OCR_PHASH_MAX_DISTANCE bits apart (3 at most), their aspect ratios
+    # match and so do their 64x64 grayscale thumbnails. The result is
+    # rescaled to the new page. Pages that differ only in small details, like
+    # a few characters, can still be taken for each other and get the wrong text.
+    OCR_PHASH = False
+    OCR_PHASH_PATH = "./ocr_phash.sqlite3"
+    OCR_PHASH_MAX_DISTANCE = 2
+    # Keep the images of the OCR'd pages here, None deletes them once OCR'd.
+    # They're deleted at startup and by each OCR_REFRESH scan once their
+    # page was evicted from the cache.
+    OCR_SOURCES_DIR = None
+    # Re-OCR the kept pages whose cached result is from an older mokuro than
+    # OCR_REFRESH_VERSION (None is the installed one), only while no one
+    # else's pages are queued. See "ocr_refresh" in /v1/stats.
+    OCR_REFRESH = False
+    OCR_REFRESH_VERSION = None
+    OCR_REFRESH_SCAN_INTERVAL = 3600  # seconds between scans of the cache
     STRICT_NEW_IMAGES = True
     MAX_IMAGE_SIZE = 5_000_000  # 5MB
     DEBUG = False
@@ -16,6 +105,9 @@ class TestingConfig(Config):
     TESTING = True
     STRICT_NEW_IMAGES = False
     OCR_CACHE_TYPE = "SimpleCache"
+    OCR_JOBS_PATH = None  # in memory
+    OCR_SPOOL_DIR = None  # a temporary directory
+    OCR_PHASH_PATH = None  # in memory
 
 
 class DevelopmentConfig(Config):
@@ -24,6 +116,8 @@ class DevelopmentConfig(Config):
 
 class ProductionConfig(Config):
     PRELOAD_OCR = True
+    OCR_MEMORY_TIER_MAX_BYTES = 64_000_000  # 64MB
+    OCR_WRITE_BEHIND_INTERVAL = 1.0
 
 
 class LocalConfig(ProductionConfig):
@@ -1,5 +1,13 @@
 import multiprocessing
 
 bind = "127.0.0.1:8000"
+# also one per client waiting on /v1/batches/<id>, for 30 seconds at most
 threads = multiprocessing.cpu_count() + 1
 wsgi_app = "app:create_app('local')"
+
+
+def post_worker_init(worker):
+    # recover the queue and start the OCR threads in each worker process,
+    # create_app leaves them out for the `flask` commands
+    from app import start_background
+    start_background(worker.wsgi)
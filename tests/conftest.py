@@ -1,6 +1,10 @@
+from hashlib import md5
 import pytest
-from app import create_app, OCR_CACHE
+from app import create_app, OCR_CACHE, OCR_JOBS
+from app.db import SqliteCache
+from app.cache_layers import innermost
 from flask import url_for
+import config
 
 
 @pytest.fixture()
@@ -12,6 +16,52 @@ def app():
     # clean up / reset resources here
 
 
+@pytest.fixture()
+def sqlite_app(tmp_path):
+    class SqliteTestingConfig(config.TestingConfig):
+        OCR_CACHE_TYPE = "app.db.SqliteCache"
+        OCR_CACHE_PATH = str(tmp_path / "ocr_results.sqlite3")
+
+    app = create_app(SqliteTestingConfig)
+    with app.test_request_context():
+        yield app
+    innermost(app.extensions[OCR_CACHE]).close()
+
+
+class RemoteTestingConfig(config.TestingConfig):
+    # pages are only queued, tests lease them as an OCR worker node would
+    OCR_REMOTE_WORKERS = True
+    OCR_WORKER_TOKEN = "worker-token"
+
+
+@pytest.fixture()
+def remote_config():
+    # override it in a test module to change the remote_app's settings
+    return RemoteTestingConfig
+
+
+@pytest.fixture()
+def remote_app(remote_config):
+    app = create_app(remote_config)
+    yield app
+    app.extensions[OCR_JOBS].close()
+
+
+@pytest.fixture()
+def worker_auth(remote_config):
+    return {"Authorization": f"Bearer {remote_config.OCR_WORKER_TOKEN}"}
+
+
+@pytest.fixture()
+def queue_page():
+    # queues a page for the OCR worker nodes, returns its key
+    def queue_page(jobs, path):
+        key = md5(path.read_bytes()).hexdigest()
+        jobs.claim(key, path.name, jobs.spool(key, path.read_bytes()), local=False)
+        return key
+    return queue_page
+
+
 @pytest.fixture()
 def client(app):
     return app.test_client()
@@ -42,3 +92,15 @@ def url_new_pages(app):
 @pytest.fixture()
 def url_make_html(app):
     return url_for("v1.make_html")
+
+
+@pytest.fixture()
+def sqlite_cache(tmp_path):
+    cache = SqliteCache(str(tmp_path / "ocr_results.sqlite3"), use_json=True)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture()
+def url_results(app):
+    return url_for("v1.results")
@@ -0,0 +1,83 @@
+from hashlib import md5
+from pathlib import Path
+from app import OCR_CACHE, OCR_JOBS
+import app.routes
+from app.jobs import PENDING, RUNNING, DONE, FAILED
+
+p1 = Path(__file__).parent / "res/page1.webp"
+p2 = Path(__file__).parent / "res/page2.jpg"
+h1 = md5(p1.read_bytes()).hexdigest()
+h2 = md5(p2.read_bytes()).hexdigest()
+
+
+def upload(client, *paths):
+    data = {md5(p.read_bytes()).hexdigest(): (p.open("rb"), p.name) for p in paths}
+    res = client.post("/v1/new_pages?async=1", data=data)
+    return next(msg for category, msg in res.json if category == "batch")
+
+
+def parse_sse(body):
+    events = []
+    for chunk in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in chunk.split("\n") if not line.startswith(":"))
+        if "event" in fields:
+            events.append((fields.get("id"), fields["event"], fields["data"]))
+    return events
+
+
+def test_async_upload_returns_a_batch(remote_app):
+    client = remote_app.test_client()
+    remote_app.extensions[OCR_CACHE].set(h2, {"blocks": []})
+    batch = upload(client, p1, p2)
+
+    res = client.get(f"/v1/batches/{batch}")
+    assert res.json["pages"] == {
+        h1: {"name": p1.name, "state": PENDING, "error": None},
+        h2: {"name": p2.name, "state": DONE, "error": None},
+    }
+    assert res.json["queue"] == {h1: {"position": None, "eta": None}}
+    assert not res.json["complete"]
+
+    jobs = remote_app.extensions[OCR_JOBS]
+    jobs.lease("worker")
+    jobs.finish(h1, "Broken image")
+    res = client.get(f"/v1/batches/{batch}?after={res.json['last_event']}&wait=5")
+    assert [(event["key"], event["state"]) for event in res.json["events"]] == [(h1, RUNNING), (h1, FAILED)]
+    assert res.json["pages"][h1] == {"name": p1.name, "state": FAILED, "error": "Broken image"}
+    assert res.json["complete"]
+
+    assert client.get("/v1/batches/unknown").status_code == 404
+
+
+def test_batch_event_stream_resumes(remote_app):
+    client = remote_app.test_client()
+    batch = upload(client, p1)
+    jobs = remote_app.extensions[OCR_JOBS]
+    jobs.lease("worker")
+    jobs.finish(h1)
+
+    headers = {"Accept": "text/event-stream"}
+    events = parse_sse(client.get(f"/v1/batches/{batch}", headers=headers).get_data(as_text=True))
+    assert [event for _, event, _ in events] == ["page", "complete"]
+    assert '"state": "done"' in events[0][2] and events[1][2] == '{"done": 1, "failed": 0}'
+
+    # a client that saw the pending page gets the rest
+    first = jobs.batch_events(batch)[0]["id"]
+    events = parse_sse(client.get(
+        f"/v1/batches/{batch}", headers={**headers, "Last-Event-ID": str(first)}).get_data(as_text=True))
+    assert [(event_id, event) for event_id, event, _ in events] == [
+        (str(first + 1), "page"), (str(first + 2), "page"), (None, "complete")]
+    assert '"state": "running"' in events[0][2] and '"state": "done"' in events[1][2]
+
+
+def test_event_streams_end_to_be_resumed(remote_app, monkeypatch):
+    monkeypatch.setattr(app.routes, "BATCH_MAX_WAIT", 0)
+    client = remote_app.test_client()
+    batch = upload(client, p1)
+
+    body = client.get(f"/v1/batches/{batch}", headers={"Accept": "text/event-stream"}).get_data(as_text=True)
+    assert body.startswith("retry: 1000\n\n")
+    # the page is still pending, the client reconnects from its last event
+    events = parse_sse(body)
+    assert [event for _, event, _ in events] == ["page", "queue"]
+    assert events[0][0] == str(remote_app.extensions[OCR_JOBS].batch(batch)[1])
@@ -0,0 +1,162 @@
+import json
+import time
+import pytest
+from pathlib import Path
+from app import create_app, OCR_CACHE, OCR_JOBS
+from app.cache_layers import MemoryTier, WriteBehind
+from app.jobs import DONE, FAILED
+from app.routes import finish_job
+import config
+from flask import url_for
+
+tc = Path(__file__).parent / "res/test_chapter.json"
+
+
+def test_memory_tier_reads_through_once(sqlite_cache):
+    chapter = json.load(open(tc, "r"))
+    sqlite_cache.set_many(chapter)
+    tier = MemoryTier(sqlite_cache, 1_000_000)
+
+    keys = list(chapter)
+    assert tier.get_many(*keys, "f" * 32) == [*chapter.values(), None]
+    assert tier.get_many(*keys) == list(chapter.values())
+    assert tier.get_many_raw(keys[0]) == [
+        json.dumps(chapter[keys[0]], ensure_ascii=False).encode()]
+    stats = tier.stats()
+    assert stats["hits"] == len(keys) + 1
+    assert stats["misses"] == len(keys) + 1
+    assert stats["entries"] == len(keys)
+
+
+def test_memory_tier_byte_budget(sqlite_cache):
+    tier = MemoryTier(sqlite_cache, 100)
+    for i in range(10):
+        tier.set(str(i), "x" * 30)
+    stats = tier.stats()
+    assert stats["bytes"] <= 100
+    assert stats["entries"] == 3
+    assert stats["evictions"] == 7
+    # evicted entries still come from the inner cache
+    assert tier.get("0") == "x" * 30
+
+
+def test_memory_tier_write_through(sqlite_cache):
+    tier = MemoryTier(sqlite_cache, 1_000_000)
+    tier.set("a", {"blocks": [1]})
+    assert sqlite_cache.get("a") == {"blocks": [1]}
+    tier.set("a", {"blocks": [2]})
+    assert tier.get("a") == {"blocks": [2]}
+    tier.delete("a")
+    assert tier.get("a") is None
+    assert not sqlite_cache.has("a")
+    assert tier.has_many("a") == []
+
+
+def test_memory_tier_stats_route(sqlite_app):
+    sqlite_app.extensions[OCR_CACHE] = MemoryTier(
+        sqlite_app.extensions[OCR_CACHE], 1_000_000)
+    sqlite_app.extensions[OCR_CACHE].set("a" * 32, {"blocks": []})
+
+    client = sqlite_app.test_client()
+    response = client.post(url_for("v1.results"), json=["a" * 32, "b" * 32])
+    assert response.json == {"new": ["b" * 32], "results": {"a" * 32: {"blocks": []}}}
+    stats = client.get(url_for("v1.stats")).json["memory_tier"]
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_write_behind_visible_before_flush(sqlite_cache):
+    buffered = WriteBehind(sqlite_cache, flush_interval=60)
+    buffered.set("a", {"blocks": [1]})
+    buffered.set_many({"b": 2, "c": 3})
+
+    assert not sqlite_cache.has("a")
+    assert buffered.has("a")
+    assert sorted(buffered.has_many("a", "b", "z")) == ["a", "b"]
+    assert buffered.get_many("a", "c", "z") == [{"blocks": [1]}, 3, None]
+    assert buffered.get_many_raw("b") == [b"2"]
+
+    assert buffered.flush() == 3
+    assert sqlite_cache.get_many("a", "b", "c") == [{"blocks": [1]}, 2, 3]
+    assert buffered.stats() == {"flushes": 1, "flushed": 3, "failed": 0, "pending": 0}
+
+
+def test_write_behind_flushes_on_batch_size(sqlite_cache):
+    buffered = WriteBehind(sqlite_cache, flush_interval=60, batch_size=2)
+    buffered.set("a", 1)
+    buffered.set("b", 2)
+    deadline = time.time() + 5
+    while not sqlite_cache.has("b") and time.time() < deadline:
+        time.sleep(0.01)
+    assert sqlite_cache.get_many("a", "b") == [1, 2]
+
+
+def test_write_behind_delete_drops_pending(sqlite_cache):
+    buffered = WriteBehind(sqlite_cache, flush_interval=60)
+    sqlite_cache.set("a", 1)
+    buffered.set("a", 2)
+    buffered.set("b", 2)
+    assert sorted(buffered.delete_many("a", "b")) == ["a", "b"]
+    buffered.flush()
+    assert not buffered.has("a") and not buffered.has("b")
+
+
+def test_write_behind_hashes_route(sqlite_app):
+    sqlite_app.extensions[OCR_CACHE] = WriteBehind(
+        sqlite_app.extensions[OCR_CACHE], flush_interval=60)
+    sqlite_app.extensions[OCR_CACHE].set("a" * 32, {"blocks": []})
+
+    response = sqlite_app.test_client().post(url_for("v1.hashes"), json=["a" * 32])
+    assert {key: response.json[key] for key in ("new", "in_queue", "in_cache")} == \
+        {"new": [], "in_queue": [], "in_cache": ["a" * 32]}
+
+
+def test_finished_jobs_are_flushed(sqlite_app):
+    inner = sqlite_app.extensions[OCR_CACHE]
+    sqlite_app.extensions[OCR_CACHE] = WriteBehind(inner, flush_interval=60)
+    jobs = sqlite_app.extensions[OCR_JOBS]
+    jobs.claim("a" * 32, "page.jpg", jobs.spool("a" * 32, b"image"))
+
+    sqlite_app.extensions[OCR_CACHE].set("a" * 32, {"blocks": []})
+    finish_job("a" * 32)
+    assert jobs.get("a" * 32)["state"] != DONE
+    sqlite_app.extensions[OCR_CACHE].flush()
+    # another process sees the job done and its result cached
+    assert inner.get("a" * 32) == {"blocks": []}
+    assert jobs.get("a" * 32)["state"] == DONE
+
+
+def test_failed_flushes_fail_their_jobs(sqlite_app):
+    inner = sqlite_app.extensions[OCR_CACHE]
+
+    class BrokenCache:
+        broken = True
+
+        def set_many(self, mapping, timeout=None):
+            if self.broken:
+                raise OSError("disk full")
+
+    sqlite_app.extensions[OCR_CACHE] = WriteBehind(BrokenCache(), flush_interval=60)
+    jobs = sqlite_app.extensions[OCR_JOBS]
+    jobs.claim("a" * 32, "page.jpg", jobs.spool("a" * 32, b"image"))
+
+    sqlite_app.extensions[OCR_CACHE].set("a" * 32, {"blocks": []})
+    finish_job("a" * 32)
+    with pytest.raises(OSError):
+        sqlite_app.extensions[OCR_CACHE].flush()
+    job = jobs.get("a" * 32)
+    assert job["state"] == FAILED and "disk full" in job["error"]
+    # kept for the next flush
+    BrokenCache.broken = False
+    assert sqlite_app.extensions[OCR_CACHE].flush() == 1
+    sqlite_app.extensions[OCR_CACHE] = inner
+
+
+def test_multiprocess_skips_in_process_layers():
+    class MultiprocessTestingConfig(config.TestingConfig):
+        OCR_MULTIPROCESS = True
+        OCR_MEMORY_TIER_MAX_BYTES = 1_000_000
+        OCR_WRITE_BEHIND_INTERVAL = 1.0
+
+    app = create_app(MultiprocessTestingConfig)
+    assert not isinstance(app.extensions[OCR_CACHE], (MemoryTier, WriteBehind))
+    app.extensions[OCR_JOBS].close()
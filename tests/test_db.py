@@ -0,0 +1,283 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+import pytest
+from hashlib import md5
+from pathlib import Path
+from app import OCR_CACHE
+from app.db import SqliteCache, ShardedSqliteCache, shard_index
+from app.compression import DictionaryMismatch, train_dictionary
+
+tc = Path(__file__).parent / "res/test_chapter.json"
+
+
+def test_sqlite_cache_roundtrip(sqlite_cache):
+    assert sqlite_cache.set("a", {"blocks": []})
+    assert sqlite_cache.has("a")
+    assert sqlite_cache.get("a") == {"blocks": []}
+    assert sqlite_cache.get_many("a", "b") == [{"blocks": []}, None]
+
+
+def test_sqlite_cache_reuses_thread_connection(sqlite_cache):
+    with sqlite_cache.get_connection() as conn1:
+        pass
+    with sqlite_cache.get_connection() as conn2:
+        pass
+    assert conn1 is conn2
+
+    other = []
+
+    def worker():
+        with sqlite_cache.get_connection() as conn:
+            other.append(conn)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert other[0] is not conn1
+
+
+def test_sqlite_cache_pragmas(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), synchronous="off",
+                        mmap_size=1 << 20, cache_size=-2000)
+    with cache.get_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 0
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] == -2000
+    cache.close()
+
+
+def test_sqlite_cache_readers_dont_wait_for_writer(sqlite_cache):
+    sqlite_cache.set("a", 1)
+    with sqlite_cache.get_connection() as writer:
+        writer.execute("UPDATE entries SET val = '2' WHERE key = 'a'")
+        # the writer transaction is still open here
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(sqlite_cache.get("a")))
+        thread.start()
+        thread.join(timeout=5)
+        assert seen == [1]
+    assert sqlite_cache.get("a") == 2
+
+
+def test_sqlite_cache_janitor_runs_off_the_write_path(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), threshold=10,
+                        janitor_interval=0, janitor_writes=1000, low_watermark=0.5)
+    for i in range(20):
+        cache.set(str(i), i)
+    cache.run_maintenance()
+    with cache.get_connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    # evicted down to the low watermark, keeping the newest entries
+    assert count == 5
+    assert cache.has("19")
+    assert not cache.has("0")
+    cache.close()
+
+
+def test_sqlite_cache_janitor_budget_wakes_thread(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), threshold=4,
+                        janitor_interval=0, janitor_writes=3, low_watermark=1)
+    for i in range(6):
+        cache.set(str(i), i)
+    deadline = time.time() + 5
+    while cache.has("0") and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.has("5")
+    assert not cache.has("0")
+    cache.close()
+
+
+def test_sqlite_cache_max_size_evicts_oldest(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), max_size=200_000, compression="none",
+                        janitor_interval=0, janitor_writes=0)
+    for i in range(40):
+        cache.set(str(i), "x" * 10_000)
+    assert cache.has("39")
+    assert not cache.has("0")
+    cache.close()
+
+
+def test_sqlite_cache_lru_keeps_recently_read(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), threshold=3,
+                        janitor_interval=0, janitor_writes=1000, low_watermark=1)
+    for key in "abc":
+        cache.set(key, key)
+    assert cache.get("a") == "a"  # only buffered, no write on the read path
+    cache.set("d", "d")
+    cache.run_maintenance()
+    assert cache.has("a")
+    assert not cache.has("b")
+    cache.close()
+
+
+def test_sqlite_cache_lfu_keeps_popular(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), threshold=3, eviction="lfu",
+                        janitor_interval=0, janitor_writes=1000, low_watermark=1)
+    for key in "abc":
+        cache.set(key, key)
+    for _ in range(3):
+        cache.get_many("a", "c")
+    cache.get("b")
+    cache.set("d", "d")
+    cache.flush_accesses()
+    cache.get("d")
+    cache.run_maintenance()
+    assert cache.has("a") and cache.has("c") and cache.has("d")
+    assert not cache.has("b")
+    cache.close()
+
+
+def test_sqlite_cache_migrates_old_schema(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE entries ( key TEXT PRIMARY KEY, val TEXT, exp FLOAT, updated FLOAT )")
+    conn.execute("CREATE INDEX keyname_index ON entries (key)")
+    conn.execute("INSERT INTO entries VALUES ('a', '1', 0, 10)")
+    conn.commit()
+    conn.close()
+
+    cache = SqliteCache(path, use_json=True)
+    assert cache.get("a") == 1
+    with cache.get_connection() as conn:
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(entries)")}
+        assert "keyname_index" not in indexes
+        assert "accessed_index" in indexes
+        assert conn.execute("SELECT accessed FROM entries").fetchone()[0] == 10
+    cache.close()
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd"])
+def test_sqlite_cache_compression_roundtrip(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    chapter = json.load(open(tc, "r"))
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), use_json=True, compression=compression)
+    cache.set_many(chapter)
+    assert cache.get_many(*chapter) == list(chapter.values())
+    stats = cache.compression_stats()
+    assert stats["rows"] == len(chapter)
+    if compression != "none":
+        assert stats["stored_bytes"] * 2 < stats["encoded_bytes_in"]
+    cache.close()
+
+
+def test_sqlite_cache_reads_and_recompresses_legacy_rows(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE entries ( key TEXT PRIMARY KEY, val TEXT, exp FLOAT, updated FLOAT )")
+    conn.execute("""INSERT INTO entries VALUES ('a', '{"blocks": []}', 0, 10)""")
+    conn.commit()
+    conn.close()
+
+    cache = SqliteCache(path, use_json=True)
+    assert cache.get("a") == {"blocks": []}
+    assert cache.recompress() == 1
+    assert cache.recompress() == 0
+    assert cache.get("a") == {"blocks": []}
+    with cache.get_connection() as conn:
+        assert conn.execute("SELECT typeof(val) FROM entries").fetchone()[0] == "blob"
+    cache.close()
+
+
+def test_sqlite_cache_zlib_dictionary(tmp_path):
+    chapter = json.load(open(tc, "r"))
+    samples = [json.dumps(page).encode() for page in chapter.values()]
+    dictionary = train_dictionary("zlib", samples)
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), use_json=True,
+                        compression="zlib", compression_dict=dictionary)
+    cache.set_many(chapter)
+    assert cache.get_many(*chapter) == list(chapter.values())
+    cache.close()
+
+    other = SqliteCache(str(tmp_path / "c.sqlite3"), use_json=True,
+                        compression="zlib", compression_dict=dictionary[1:])
+    with pytest.raises(DictionaryMismatch):
+        other.get_many(*chapter)
+    other.close()
+
+
+def test_sqlite_cache_reads_frames_without_dictionary_id(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite3"), use_json=True)
+    # version 1, zlib
+    legacy = bytes((1, 1)) + zlib.compress(b'{"blocks": []}')
+    with cache.get_connection() as conn:
+        conn.execute("INSERT INTO entries (key, val, exp) VALUES (?, ?, 0)", ("a", legacy))
+    assert cache.get("a") == {"blocks": []}
+    assert cache.recompress() == 1
+    assert cache.get("a") == {"blocks": []}
+    cache.close()
+
+
+def test_cache_cli_stats_and_recompress(sqlite_app):
+    chapter = json.load(open(tc, "r"))
+    sqlite_app.extensions[OCR_CACHE].set_many(chapter)
+    runner = sqlite_app.test_cli_runner()
+
+    result = runner.invoke(args=["cache", "stats"])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)["rows"] == len(chapter)
+
+    result = runner.invoke(args=["cache", "recompress"])
+    assert result.exit_code == 0, result.output
+    assert "Recompressed 0 rows" in result.output
+
+
+def test_sqlite_cache_bulk_lookups_past_variable_limit(sqlite_cache):
+    keys = [f"{i:032}" for i in range(40_000)]
+    sqlite_cache.set_many({key: i for i, key in enumerate(keys[::2])})
+
+    assert sorted(sqlite_cache.has_many(*keys)) == keys[::2]
+    assert sqlite_cache.get_many(*keys)[:4] == [0, None, 1, None]
+    assert len(sqlite_cache.delete_many(*keys)) == 20_000
+    assert sqlite_cache.has_many(*keys) == []
+
+
+def test_sharded_cache_spreads_keys(tmp_path):
+    # the fixture's keys share their prefix, real ones are MD5 digests
+    chapter = {md5(key.encode()).hexdigest(): value for key, value in json.load(open(tc, "r")).items()}
+    cache = ShardedSqliteCache(str(tmp_path / "c.sqlite3"), shards=3, use_json=True)
+    cache.set_many(chapter)
+    cache.set("not-a-hash", {"a": 1})
+
+    assert cache.get_many(*chapter) == list(chapter.values())
+    assert cache.get("not-a-hash") == {"a": 1}
+    assert sorted(cache.has_many("missing", *chapter)) == sorted(chapter)
+    assert all(shard.compression_stats()["rows"] for shard in cache.shards)
+    assert cache.compression_stats()["rows"] == len(chapter) + 1
+
+    assert sorted(cache.delete_many(*chapter)) == sorted(chapter)
+    assert cache.has_many(*chapter) == []
+    cache.close()
+
+
+def test_shards_by_key_prefix():
+    assert shard_index("00000005" + "f" * 24, 4) == 1
+    assert shard_index("ffffffff" + "0" * 24, 4) == 3
+    assert shard_index("not-a-hash", 4) in range(4)
+
+
+def test_sharded_cache_splits_global_limits(tmp_path):
+    cache = ShardedSqliteCache(str(tmp_path / "c.sqlite3"), shards=2, threshold=10)
+    assert [shard.threshold for shard in cache.shards] == [5, 5]
+    cache.close()
+    cache = ShardedSqliteCache(str(tmp_path / "d.sqlite3"), shards=2, threshold=10,
+                               shard_limits="per_shard")
+    assert [shard.threshold for shard in cache.shards] == [10, 10]
+    cache.close()
+
+
+def test_reshard_copies_stored_rows(sqlite_app, tmp_path):
+    chapter = json.load(open(tc, "r"))
+    sqlite_app.extensions[OCR_CACHE].set_many(chapter)
+    runner = sqlite_app.test_cli_runner()
+
+    result = runner.invoke(args=["cache", "reshard", "--shards", "2"])
+    assert result.exit_code == 0, result.output
+    assert f"Copied {len(chapter)} rows" in result.output
+
+    cache = ShardedSqliteCache(sqlite_app.config["OCR_CACHE_PATH"], shards=2, use_json=True)
+    assert cache.get_many(*chapter) == list(chapter.values())
+    cache.close()
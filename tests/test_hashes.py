@@ -1,4 +1,9 @@
 from hashlib import md5
+from app import OCR_CACHE, OCR_JOBS
+from flask import url_for
+
+
+NO_LIMITS = {"jobs": None, "bytes": None, "client_jobs": None, "pages_per_minute": 0.0}
 
 
 def sh(s):
@@ -40,7 +45,7 @@ def test_hashes_invalid_error(client, url_hashes, app):
 def test_hashes_empty(client, url_hashes):
     response = client.post(url_hashes, json=[])
     assert response.status_code == 200
-    assert response.json == {"new": [], "in_queue": [], "in_cache": []}
+    assert response.json == {"new": [], "in_queue": [], "in_cache": [], "capacity": NO_LIMITS}
 
 
 def test_hashes_all_new(client, url_hashes):
@@ -48,7 +53,7 @@ def test_hashes_all_new(client, url_hashes):
     response = client.post(url_hashes, json=json)
 
     assert response.status_code == 200
-    assert response.json == {"new": json, "in_queue": [], "in_cache": []}
+    assert response.json == {"new": json, "in_queue": [], "in_cache": [], "capacity": NO_LIMITS}
 
 
 def test_hashes_all_cache(client, url_hashes, cache):
@@ -59,7 +64,7 @@ def test_hashes_all_cache(client, url_hashes, cache):
     response = client.post(url_hashes, json=json)
 
     assert response.status_code == 200
-    assert response.json == {"new": [], "in_queue": [], "in_cache": json}
+    assert response.json == {"new": [], "in_queue": [], "in_cache": json, "capacity": NO_LIMITS}
 
 
 def test_hashes_all_queue(client, url_hashes, app):
@@ -70,7 +75,7 @@ def test_hashes_all_queue(client, url_hashes, app):
     response = client.post(url_hashes, json=json)
 
     assert response.status_code == 200
-    assert response.json == {"new": [], "in_queue": json, "in_cache": []}
+    assert response.json == {"new": [], "in_queue": json, "in_cache": [], "capacity": NO_LIMITS}
 
 
 def test_hashes_some_found(client, url_hashes, cache, app):
@@ -88,4 +93,29 @@ def test_hashes_some_found(client, url_hashes, cache, app):
     response = client.post(url_hashes, json=json)
 
     assert response.status_code == 200
-    assert response.json == {"new": new, "in_queue": que, "in_cache": old}
+    assert response.json == {"new": new, "in_queue": que, "in_cache": old, "capacity": NO_LIMITS}
+
+
+def test_hashes_bulk_sqlite(sqlite_app):
+    cache = sqlite_app.extensions[OCR_CACHE]
+    json = [sh(str(i).encode()) for i in range(3000)]
+    cache.set_many({key: "DUMMY" for key in json[::3]})
+
+    response = sqlite_app.test_client().post(url_for("v1.hashes"), json=json)
+
+    assert response.status_code == 200
+    assert response.json["in_cache"] == json[::3]
+    assert response.json["new"] == [hs for hs in json if hs not in json[::3]]
+
+
+def test_hashes_capacity(client, url_hashes, app):
+    app.config.update(OCR_MAX_QUEUED_JOBS=3, OCR_MAX_CLIENT_JOBS=2)
+    jobs = app.extensions[OCR_JOBS]
+    jobs.claim(sh(b"1"), "1.png", None, "someone")
+    jobs.claim(sh(b"2"), "2.png", None, "me")
+    jobs.claim(sh(b"3"), "3.png", None, "me")
+    jobs.finish(sh(b"3"))
+
+    response = client.post(url_hashes, json=[], headers={"X-Client-Id": "me"})
+    assert response.json["capacity"] == {
+        "jobs": 1, "bytes": None, "client_jobs": 1, "pages_per_minute": 0.2}
@@ -0,0 +1,119 @@
+import time
+from pathlib import Path
+from app import create_app, start_background, OCR_JOBS
+from hashlib import md5
+import pytest
+from app.jobs import JobStore, PENDING, RUNNING, DONE, FAILED, UploadEmpty, UploadHashMismatch, UploadTooLarge
+import config
+
+
+def test_job_store_lifecycle(tmp_path):
+    jobs = JobStore(str(tmp_path / "jobs.sqlite3"), tmp_path / "spool")
+    path = jobs.spool("a" * 32, b"image")
+    jobs.claim("a" * 32, "page.png", path, "client", 1)
+    assert Path(path).read_bytes() == b"image"
+    assert jobs.queued(["a" * 32, "b" * 32]) == {"a" * 32}
+
+    jobs.mark("a" * 32, RUNNING)
+    assert jobs.get("a" * 32)["state"] == RUNNING
+    jobs.finish("a" * 32, "Broken image")
+    assert jobs.get("a" * 32)["state"] == FAILED
+    assert not Path(path).exists()
+    assert jobs.queued(["a" * 32]) == set()
+    assert jobs.stats()[FAILED] == 1
+    jobs.close()
+
+
+def test_job_store_collects_garbage(tmp_path):
+    jobs = JobStore(str(tmp_path / "jobs.sqlite3"), tmp_path / "spool")
+    kept = jobs.spool("a" * 32, b"queued")
+    jobs.claim("a" * 32, "queued.png", kept)
+    orphan = jobs.spool("b" * 32, b"never queued")
+    jobs.claim("c" * 32, "done.png", None)
+    jobs.finish("c" * 32)
+
+    assert jobs.collect_garbage(keep_finished=-1) == (1, 0)  # too recent
+    assert jobs.collect_garbage(keep_finished=-1, keep_spooled=-1) == (0, 1)
+    assert Path(kept).exists() and not Path(orphan).exists()
+    assert jobs.stats() == {PENDING: 1, RUNNING: 0, DONE: 0, FAILED: 0}
+    jobs.close()
+
+
+def test_unfinished_jobs_are_resumed_on_startup(tmp_path):
+    class DurableTestingConfig(config.TestingConfig):
+        OCR_JOBS_PATH = str(tmp_path / "jobs.sqlite3")
+        OCR_SPOOL_DIR = str(tmp_path / "spool")
+
+    # as if left by a process that died, nobody renews their lease
+    jobs = JobStore(DurableTestingConfig.OCR_JOBS_PATH, DurableTestingConfig.OCR_SPOOL_DIR,
+                    lease_seconds=0)
+    path = jobs.spool("a" * 32, b"not an image")
+    jobs.claim("a" * 32, "page.png", path)
+    jobs.claim("b" * 32, "lost.png", str(tmp_path / "spool/missing"))
+    jobs.close()
+
+    app = create_app(DurableTestingConfig)
+    jobs = app.extensions[OCR_JOBS]
+    # like the `flask` commands, building the app takes over nothing
+    assert app.queue == {} and jobs.get("a" * 32)["state"] == PENDING
+    start_background(app)
+    assert "b" * 32 not in app.queue
+    deadline = time.monotonic() + 10
+    while jobs.get("a" * 32)["state"] != FAILED and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert jobs.get("a" * 32)["state"] == FAILED
+    assert jobs.get("b" * 32)["error"] == "The uploaded file was lost"
+    assert not Path(path).exists()
+
+
+def test_job_stores_share_the_queue(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    first = JobStore(path, tmp_path / "spool")
+    second = JobStore(path, tmp_path / "spool")
+    spooled = first.spool("a" * 32, b"image")
+
+    assert first.claim("a" * 32, "page.png", spooled)
+    assert not second.claim("a" * 32, "page.png", spooled)
+    assert second.queued(["a" * 32]) == {"a" * 32}
+    assert second.adopt_expired() == []
+
+    future = second.watch("a" * 32)
+    first.finish("a" * 32, "Broken image")
+    assert future.result(timeout=5) == ("a" * 32, "page.png", {"error": "Broken image"})
+    # finished jobs can be run again
+    assert second.claim("a" * 32, "page.png", spooled)
+    first.close()
+    second.close()
+
+
+def test_expired_jobs_are_adopted(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    dead = JobStore(path, tmp_path / "spool", lease_seconds=0)
+    dead.claim("a" * 32, "page.png", None, "client", 1)
+    dead.close()
+
+    jobs = JobStore(path, tmp_path / "spool")
+    adopted = jobs.adopt_expired()
+    assert [(job["key"], job["client"], job["priority"]) for job in adopted] == [("a" * 32, "client", 1)]
+    assert jobs.get("a" * 32)["owner"] == jobs.owner
+    assert jobs.adopt_expired() == []
+    jobs.close()
+
+
+def test_spool_streams_and_checks_uploads(tmp_path):
+    jobs = JobStore(None, tmp_path / "spool")
+    chunks = [b"abc"] * 4
+    key = md5(b"".join(chunks)).hexdigest()
+
+    path = jobs.spool(key, iter(chunks), max_size=12, verify=True)
+    assert Path(path).read_bytes() == b"abc" * 4
+    with pytest.raises(UploadTooLarge):
+        jobs.spool("b" * 32, iter(chunks), max_size=11)
+    with pytest.raises(UploadHashMismatch):
+        jobs.spool("b" * 32, iter(chunks), verify=True)
+    with pytest.raises(UploadEmpty):
+        jobs.spool("b" * 32, iter([]))
+    # nothing is left of the discarded uploads
+    assert [p.name for p in (tmp_path / "spool").iterdir()] == [key]
+    jobs.close()
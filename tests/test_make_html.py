@@ -1,5 +1,5 @@
 import json
-from app import overlay_generator
+from app import overlay, overlay_generator
 from pathlib import Path, PurePath
 
 tc = Path(__file__).parent / "res/test_chapter.json"
@@ -114,3 +114,26 @@ def test_make_html_works(client, url_make_html, cache):
     data = {"title": "Chapter 1.1", "page_map": pages}
     res = client.post(url_make_html, json=data)
     assert res.status_code == 200, res.json["error"]
+
+
+def test_overlay_matches_overlay_generator():
+    og = overlay_generator()
+    test_chapter = json.load(open(tc, "r"))
+    page_htmls = [og.get_page_html(result, PurePath(f"{hs}.jpg")) for hs, result in test_chapter.items()]
+    assert page_htmls == [
+        overlay.page_html(result, PurePath(f"{hs}.jpg")) for hs, result in test_chapter.items()]
+    assert overlay.index_html(page_htmls, 'Chapter 1.1 | mokuro') == \
+        og.get_index_html(page_htmls, 'Chapter 1.1 | mokuro', True, False)
+
+
+def test_overlay_page_html():
+    result = {"version": "0.1.8", "img_width": 100, "img_height": 200, "blocks": [
+        {"box": [10, 20, 30, 40], "vertical": True, "font_size": 10.5, "lines": ["a<b>"]},
+        {"box": [-5, 0, 150, 250], "vertical": False, "font_size": 20, "lines": ["c&d", "e"]}]}
+    assert overlay.page_html(result, PurePath("vol 1/page 1.jpg")) == (
+        '<div class="pageContainer" style="width:100; height:200; '
+        'background-image:url(&quot;vol%201/page%201.jpg&quot;);">'
+        '<div class="textBox" style="left:10; top:20; width:20; height:20; font-size:12.0px; '
+        'z-index:11; writing-mode:vertical-rl;"><p>a&lt;b&gt;</p></div>'
+        '<div class="textBox" style="left:0; top:0; width:100; height:200; font-size:20px; '
+        'z-index:10;"><p>c&amp;d</p><p>e</p></div></div>')
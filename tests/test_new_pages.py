@@ -1,7 +1,7 @@
 import io
 from pathlib import Path
 from hashlib import md5
-from app import manga_page_ocr
+from app import manga_page_ocr, OCR_PROCESS_POOL, OCR_JOBS
 
 test_dir = Path(__file__).parent
 p1 = test_dir / "res/page1.webp"
@@ -93,6 +93,8 @@ def test_new_pages_multiple_work(client, url_new_pages, cache, app):
         hs2: (p2.open("rb"), p2.name),
     }
     res = client.post(url_new_pages, data=data)
+    # read the streamed response to the end, so it pops its request context
+    res.get_data()
 
     assert cache.has(hs1)
     result = cache.get(hs1)
@@ -103,3 +105,69 @@ def test_new_pages_multiple_work(client, url_new_pages, cache, app):
     result = cache.get(hs2)
     assert "blocks" in result
     assert 5 > len("".join(flat_map(lambda b: b['lines'], result["blocks"])))
+
+
+def test_new_pages_runs_in_process_pool(client, url_new_pages, cache, app):
+    class RecordingPool:
+        def ocr(self, path):
+            # the upload must be on disk for the worker process to read it
+            return {"blocks": [], "hash": md5(Path(path).read_bytes()).hexdigest()}
+
+    app.extensions[OCR_PROCESS_POOL] = RecordingPool()
+    hs1 = md5(p1.read_bytes()).hexdigest()
+    res = client.post(url_new_pages, data={hs1: (p1.open("rb"), p1.name)})
+
+    assert not [msg for msg in res.json if msg[0] == "error"]
+    assert cache.get(hs1) == {"blocks": [], "hash": hs1}
+
+
+def test_new_pages_admission_control(client, url_new_pages, app):
+    app.config.update(OCR_MAX_QUEUED_JOBS=2, OCR_MAX_CLIENT_JOBS=1, OCR_MAX_QUEUED_BYTES=1000)
+    jobs = app.extensions[OCR_JOBS]
+    jobs.claim(f"{1:032}", "1.png", None, "me")
+
+    def upload(client_id, size=10):
+        data = {f"{9:032}": (io.BytesIO(b"x" * size), "file.png", "image/png")}
+        return client.post(url_new_pages, data=data, headers={"X-Client-Id": client_id})
+
+    res = upload("me")
+    assert res.status_code == 429 and res.headers["Retry-After"] == "60"
+    assert upload("someone").status_code == 200
+    assert upload("someone", 2000).status_code == 413
+
+    jobs.claim(f"{2:032}", "2.png", None, "someone")
+    # one page finished in the last 5 minutes, so one more in 300 seconds
+    jobs.claim(f"{3:032}", "3.png", None, "someone")
+    jobs.finish(f"{3:032}")
+    res = upload("someone")
+    assert res.status_code == 429 and res.headers["Retry-After"] == "300"
+
+
+def test_new_pages_streams_uploads_to_the_spool(client, url_new_pages, app):
+    app.config.update(MAX_IMAGE_SIZE=p1.stat().st_size)
+    spool_dir = app.extensions[OCR_JOBS].spool_dir
+    data = {
+        md5(b"other").hexdigest(): (p1.open("rb"), p1.name),
+        md5(p2.read_bytes()).hexdigest(): (p2.open("rb"), p2.name),
+        "note": "not a file",
+    }
+    res = client.post(url_new_pages, data=data)
+    errors = [msg for category, msg in res.json if category == "error"]
+    assert any("same hash" in msg for msg in errors)
+    assert any("too large" in msg for msg in errors)
+    assert list(spool_dir.iterdir()) == []
+
+
+def test_new_pages_admission_per_page(client, url_new_pages, app):
+    app.config.update(OCR_MAX_QUEUED_JOBS=3, OCR_MAX_CLIENT_JOBS=2, OCR_REMOTE_WORKERS=True)
+    jobs = app.extensions[OCR_JOBS]
+    jobs.claim(f"{1:032}", "1.png", None, "me")
+
+    # one request with room for one more of the client's pages
+    data = {md5(bytes([n])).hexdigest(): (io.BytesIO(bytes([n])), f"{n}.png", "image/png")
+            for n in range(5)}
+    res = client.post(url_new_pages + "?async=1", data=data, headers={"X-Client-Id": "me"})
+    assert res.status_code == 429 and res.headers["Retry-After"] == "60"
+    errors = [msg for category, msg in res.json if category == "error"]
+    assert len(errors) == 4 and all("too many pages" in msg for msg in errors)
+    assert jobs.load("me")["client_jobs"] == 2
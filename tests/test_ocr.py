@@ -0,0 +1,89 @@
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from flask import url_for
+from app import create_app
+from app.pipeline import Job, Pipeline, Stage
+import config
+
+
+def test_pipeline_runs_stages_in_order_and_batches():
+    batches = []
+
+    def double(jobs):
+        for job in jobs:
+            job.value *= 2
+
+    def batched(jobs):
+        batches.append(len(jobs))
+        for job in jobs:
+            if job.value == 6:
+                job.error = ValueError("bad page")
+            job.value += 1
+
+    pipeline = Pipeline([
+        Stage("double", double, workers=2),
+        Stage("batched", batched, batch_size=4, max_wait=0.5),
+    ])
+    with ThreadPoolExecutor(5) as executor:
+        futures = [
+            executor.submit(lambda v: pipeline.submit(Job(value=v)).result().value, v)
+            for v in range(5)
+        ]
+    assert futures[0].result() == 1
+    assert futures[4].result() == 9
+    with pytest.raises(ValueError):
+        futures[3].result()
+    assert sum(batches) == 5 and max(batches) > 1
+
+    stats = pipeline.stats()
+    assert stats["double"]["jobs"] == 5
+    assert stats["batched"]["batches"] == len(batches)
+
+
+def test_pipeline_fails_the_batch_and_keeps_running():
+    def slow(jobs):
+        time.sleep(0.01)
+
+    def fail(jobs):
+        if any(job.value == "bad" for job in jobs):
+            raise RuntimeError("out of memory")
+
+    pipeline = Pipeline([Stage("slow", slow), Stage("fail", fail)])
+    with pytest.raises(RuntimeError):
+        pipeline.submit(Job(value="bad")).result()
+    assert pipeline.submit(Job(value="good")).result().value == "good"
+    assert pipeline.stats()["fail"]["errors"] == 1
+
+
+def test_pipeline_stats_route():
+    class PipelineTestingConfig(config.TestingConfig):
+        OCR_PIPELINE = True
+
+    app = create_app(PipelineTestingConfig)
+    with app.test_request_context():
+        stats = app.test_client().get(url_for("v1.stats")).json["ocr_pipeline"]
+    assert sorted(stats) == ["crop", "decode", "detect", "finish", "prescale", "recognize"]
+    assert stats["detect"]["queue_depth"] == 0
+
+
+def test_prescale_maps_detections_back_to_the_page():
+    cv2 = pytest.importorskip("cv2")
+    import numpy as np
+    from types import SimpleNamespace
+    from app.ocr import BatchedPageOcr
+
+    page_ocr = BatchedPageOcr(None, detect_max_side=1000)
+    page = np.zeros((4000, 2000, 3), np.uint8)
+    small, scale = page_ocr.prescale(page)
+    assert small.shape == (1000, 500, 3) and scale == 0.25
+    assert page_ocr.prescale(small)[1] == 1.0
+
+    blk = SimpleNamespace(xyxy=[10, 20, 110, 520], lines=[[[10, 20], [110, 20], [110, 520], [10, 520]]],
+                          font_size=25.0, distance=np.array([3.0]), vec=None, norm=-1, _bounding_rect=[1])
+    mask = np.zeros((1000, 500), np.uint8)
+    mask, mask_refined, (blk,) = BatchedPageOcr.upscale((mask, mask, [blk]), scale, page.shape)
+    assert mask.shape == mask_refined.shape == (4000, 2000)
+    assert blk.xyxy == [40, 80, 440, 2080]
+    assert blk.lines == [[[40, 80], [440, 80], [440, 2080], [40, 2080]]]
+    assert blk.font_size == 100.0 and blk.distance.tolist() == [12.0] and blk._bounding_rect is None
@@ -0,0 +1,115 @@
+from hashlib import md5
+from pathlib import Path
+import pytest
+from app import OCR_CACHE, OCR_JOBS, OCR_PHASH
+from app.jobs import DONE
+from app.phash import THUMB_SIZE, PerceptualIndex, dhash, rescale_result, thumbs_match
+import app.routes
+
+p1 = Path(__file__).parent / "res/page1.webp"
+p2 = Path(__file__).parent / "res/page2.jpg"
+PHASH = 0x0F0F_3C3C_A5A5_F00F
+THUMB = bytes(range(256)) * (THUMB_SIZE * THUMB_SIZE // 256)
+
+
+def test_index_finds_near_duplicates():
+    index = PerceptualIndex(max_distance=3)
+    index.add("same", PHASH, 1000, 1500)
+    index.add("close", PHASH ^ 0b101, 500, 750)  # 2 bits apart, half the size
+    index.add("far", PHASH ^ 0xFFFF, 1000, 1500)
+    index.add("wide", PHASH, 1500, 1000)
+    index.add("top", PHASH ^ (1 << 63), 1000, 1500)
+
+    assert index.similar(PHASH, 2000, 3000) == ["same", "top", "close"]
+    assert index.similar(PHASH, 2000, 3000, exclude="same") == ["top", "close"]
+    # blank pages all look alike
+    index.add("blank", 0, 1000, 1500)
+    assert index.similar(1, 1000, 1500) == []
+    index.discard("same")
+    assert index.stats() == {"pages": 5}
+    index.close()
+
+
+def test_thumbnails_confirm_the_matches():
+    # one bubble of text differs
+    other = bytearray(THUMB)
+    for row in range(8, 16):
+        other[row * THUMB_SIZE + 40:row * THUMB_SIZE + 48] = bytes(8)
+    noisy = bytes(min(value + 3, 255) for value in THUMB)
+    assert thumbs_match(THUMB, noisy)
+    assert not thumbs_match(THUMB, bytes(other))
+    assert not thumbs_match(THUMB, None)
+
+    index = PerceptualIndex(max_distance=3)
+    index.add("same", PHASH, 1000, 1500, noisy)
+    index.add("other", PHASH, 1000, 1500, bytes(other))
+    index.add("unconfirmed", PHASH, 1000, 1500)
+    assert index.similar(PHASH, 1000, 1500, THUMB) == ["same"]
+    index.close()
+
+
+def test_rescale_result():
+    result = {"version": "0.1.8", "img_width": 100, "img_height": 200, "blocks": [{
+        "box": [10, 20, 50, 100], "vertical": True, "font_size": 10.0,
+        "lines_coords": [[[10, 20], [50, 20], [50, 100], [10, 100]]], "lines": ["テスト"]}]}
+    rescaled = rescale_result(result, 200, 400)
+    assert rescaled["img_width"] == 200 and rescaled["img_height"] == 400
+    block, = rescaled["blocks"]
+    assert block["box"] == [20, 40, 100, 200] and block["font_size"] == 20.0
+    assert block["lines_coords"] == [[[20, 40], [100, 40], [100, 200], [20, 200]]]
+    assert block["lines"] == ["テスト"] and block["vertical"]
+
+
+def test_dhash_survives_reencoding(tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    img = cv2.imread(str(p2))
+    cv2.imwrite(str(tmp_path / "page.webp"), cv2.resize(img, None, fx=0.5, fy=0.5), [cv2.IMWRITE_WEBP_QUALITY, 60])
+    original, W, H, thumb = dhash(str(p2))
+    reencoded, w, h, reencoded_thumb = dhash(str(tmp_path / "page.webp"))
+    assert (original ^ reencoded).bit_count() <= 3 and (w, h) == (W // 2, H // 2)
+    assert thumbs_match(thumb, reencoded_thumb)
+    assert not thumbs_match(thumb, dhash(str(p1))[3])
+
+
+@pytest.fixture()
+def remote_config(remote_config):
+    class PhashTestingConfig(remote_config):
+        OCR_PHASH = True
+    return PhashTestingConfig
+
+
+def test_near_duplicates_skip_the_ocr(remote_app, worker_auth, queue_page, monkeypatch):
+    monkeypatch.setattr(app.routes, "dhash", lambda path: (PHASH, 100, 200, THUMB))
+    jobs = remote_app.extensions[OCR_JOBS]
+    cache = remote_app.extensions[OCR_CACHE]
+    h1, h2 = (md5(p.read_bytes()).hexdigest() for p in (p1, p2))
+    result = {"version": "0.1.8", "img_width": 50, "img_height": 100, "blocks": []}
+    cache.set(h1, result)
+    remote_app.extensions[OCR_PHASH].add(h1, PHASH, 50, 100, THUMB)
+    queue_page(jobs, p2)
+
+    res = remote_app.test_client().post("/v1/worker/lease", json={"worker": "w"}, headers=worker_auth)
+    assert res.status_code == 204
+    assert jobs.get(h2)["state"] == DONE
+    assert cache.get(h2) == {**result, "img_width": 100, "img_height": 200}
+
+
+def test_pages_are_indexed_once_cached(remote_app, worker_auth, queue_page, monkeypatch):
+    monkeypatch.setattr(app.routes, "dhash", lambda path: (PHASH, 100, 200, THUMB))
+    jobs = remote_app.extensions[OCR_JOBS]
+    index = remote_app.extensions[OCR_PHASH]
+    client = remote_app.test_client()
+    h1, h2 = (md5(p.read_bytes()).hexdigest() for p in (p1, p2))
+    queue_page(jobs, p1)
+    assert client.post("/v1/worker/lease", json={"worker": "w"}, headers=worker_auth).json["key"] == h1
+    assert index.stats() == {"pages": 0}
+
+    # a near-duplicate of a page still being OCR'd keeps it in the index
+    index.add(h1, PHASH, 100, 200, THUMB)
+    queue_page(jobs, p2)
+    assert client.post("/v1/worker/lease", json={"worker": "w"}, headers=worker_auth).json["key"] == h2
+    assert index.similar(PHASH, 100, 200) == [h1]
+
+    client.post(f"/v1/worker/jobs/{h2}", json={"worker": "w", "error": "broken"}, headers=worker_auth)
+    client.post(f"/v1/worker/jobs/{h1}", json={"worker": "w", "result": {"blocks": []}}, headers=worker_auth)
+    assert index.similar(PHASH, 100, 200) == [h1]
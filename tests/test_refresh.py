@@ -0,0 +1,91 @@
+from hashlib import md5
+from pathlib import Path
+import pytest
+from app import OCR_CACHE, OCR_JOBS, OCR_REFRESH
+from app.db import SqliteCache
+from app.jobs import DONE, JobStore
+from app.refresh import StaleRefresher, is_stale
+
+p1 = Path(__file__).parent / "res/page1.webp"
+p2 = Path(__file__).parent / "res/page2.jpg"
+
+
+@pytest.fixture()
+def remote_config(remote_config, tmp_path):
+    class RefreshTestingConfig(remote_config):
+        OCR_SOURCES_DIR = str(tmp_path / "sources")
+        OCR_REFRESH = True
+        OCR_REFRESH_VERSION = "0.2.0"
+    return RefreshTestingConfig
+
+
+@pytest.fixture()
+def refresh_app(remote_app):
+    remote_app.extensions[OCR_REFRESH].stop()
+    return remote_app
+
+
+@pytest.fixture()
+def ocr_page(refresh_app, worker_auth):
+    def ocr_page(path, version):
+        client = refresh_app.test_client()
+        key = md5(path.read_bytes()).hexdigest()
+        res = client.post("/v1/worker/lease", json={"worker": "w"}, headers=worker_auth)
+        assert res.json["key"] == key
+        res = client.post(f"/v1/worker/jobs/{key}", json={
+            "worker": "w", "result": {"version": version, "blocks": []}}, headers=worker_auth)
+        assert res.json["state"] == DONE
+    return ocr_page
+
+
+def test_is_stale():
+    assert is_stale({"version": "0.1.8"}, "0.2.0")
+    assert is_stale({"version": "0.1.8"}, "0.1.10")
+    assert is_stale({"blocks": []}, "0.2.0")
+    assert not is_stale({"version": "0.2.0"}, "0.2.0")
+    assert not is_stale({"version": "0.2.1"}, "0.2.0")
+
+
+def test_stale_results_are_refreshed_when_idle(refresh_app, queue_page, ocr_page):
+    client = refresh_app.test_client()
+    jobs = refresh_app.extensions[OCR_JOBS]
+    cache = refresh_app.extensions[OCR_CACHE]
+    refresher = refresh_app.extensions[OCR_REFRESH]
+    key = queue_page(jobs, p1)
+    ocr_page(p1, "0.1.8")
+    assert (jobs.sources_dir / key).read_bytes() == p1.read_bytes()
+
+    # someone's page is waiting
+    queue_page(jobs, p2)
+    refresher.step()
+    assert refresher.stats()["stale"] == 1 and refresher.stats()["remaining"] == 1
+    assert jobs.get(key)["state"] == DONE
+    ocr_page(p2, "0.2.0")
+
+    refresher.step()
+    assert refresher.stats()["submitted"] == 1 and refresher.stats()["remaining"] == 0
+    ocr_page(p1, "0.2.0")
+    assert cache.get(key) == {"version": "0.2.0", "blocks": []}
+    assert (jobs.sources_dir / key).is_file()
+
+    refresher.step()
+    stats = client.get("/v1/stats").json["ocr_refresh"]
+    assert stats["refreshed"] == 1 and stats["running"] == 0 and stats["version"] == "0.2.0"
+    assert stats["pages_per_minute"] > 0
+
+
+def test_scan_is_invisible_to_the_eviction(tmp_path):
+    cache = SqliteCache(str(tmp_path / "ocr_results.sqlite3"), max_size=10**9, use_json=True)
+    jobs = JobStore(None, tmp_path / "spool", sources_dir=tmp_path / "sources")
+    for key, version in (("a" * 32, "0.1.8"), ("b" * 32, "0.2.0")):
+        cache.set(key, {"version": version, "blocks": []})
+        (jobs.sources_dir / key).write_bytes(b"image")
+    # evicted from the cache since
+    (jobs.sources_dir / ("c" * 32)).write_bytes(b"image")
+
+    refresher = StaleRefresher(cache, jobs, lambda key: True, lambda: 0, "0.2.0")
+    assert refresher.scan() == 1
+    assert cache.flush_accesses() == 0
+    assert sorted(path.name for path in jobs.sources_dir.iterdir()) == ["a" * 32, "b" * 32]
+    jobs.close()
+    cache.close()
@@ -0,0 +1,42 @@
+import json
+from pathlib import Path
+from app import OCR_CACHE
+from flask import url_for
+
+tc = Path(__file__).parent / "res/test_chapter.json"
+
+
+def sh(n):
+    return f"{n:032}"
+
+
+def test_results_need_json(client, url_results):
+    response = client.post(url_results)
+    assert response.status_code != 200
+    assert "error" in response.json
+
+
+def test_results_some_found(client, url_results, cache):
+    cache.set(sh(1), {"blocks": []})
+    response = client.post(url_results, json=[sh(1), sh(2)])
+    assert response.status_code == 200
+    assert response.json == {"new": [sh(2)], "results": {sh(1): {"blocks": []}}}
+
+
+def test_results_raw_passthrough(sqlite_app):
+    chapter = json.load(open(tc, "r"))
+    sqlite_app.extensions[OCR_CACHE].set_many(chapter)
+    hashes = [*chapter, "f" * 32, *chapter]
+
+    client = sqlite_app.test_client()
+    for query in ("", "?stream=1"):
+        response = client.post(url_for("v1.results") + query, json=hashes)
+        assert response.status_code == 200
+        assert response.json == {"new": ["f" * 32], "results": chapter}
+
+
+def test_results_raw_keeps_hash_case(sqlite_app):
+    sqlite_app.extensions[OCR_CACHE].set("a" * 32, {"blocks": []})
+
+    response = sqlite_app.test_client().post(url_for("v1.results"), json=["A" * 32])
+    assert response.json == {"new": [], "results": {"A" * 32: {"blocks": []}}}
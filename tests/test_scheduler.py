@@ -0,0 +1,87 @@
+import threading
+import pytest
+from flask import url_for
+from app import OCR_SCHEDULER
+from app.scheduler import FairScheduler, BACKGROUND
+
+
+def blocked_scheduler():
+    # one worker, held by a job until the returned event is set
+    scheduler = FairScheduler(workers=1)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+    scheduler.submit("blocker", block)
+    started.wait()
+    return scheduler, release
+
+
+def run_order(scheduler, release, jobs):
+    order = []
+    futures = [
+        scheduler.submit(key, lambda key=key: order.append(key), client, priority)
+        for key, client, priority in jobs
+    ]
+    release.set()
+    for future in futures:
+        future.result()
+    return order
+
+
+def test_scheduler_takes_turns_between_clients():
+    scheduler, release = blocked_scheduler()
+    volume = [(f"volume-{i}", "reader-a", 0) for i in range(4)]
+    chapter = [(f"chapter-{i}", "reader-b", 0) for i in range(2)]
+    order = run_order(scheduler, release, volume + chapter)
+    assert order == ["volume-0", "chapter-0", "volume-1", "chapter-1", "volume-2", "volume-3"]
+
+
+def test_scheduler_runs_background_pages_last_unless_promoted():
+    scheduler, release = blocked_scheduler()
+    jobs = [("prefetch-0", "a", BACKGROUND), ("prefetch-1", "a", BACKGROUND), ("page", "b", 0)]
+    futures = []
+    order = []
+    for key, client, priority in jobs:
+        futures.append(scheduler.submit(
+            key, lambda key=key: order.append(key), client, priority))
+    assert scheduler.promote("prefetch-1")
+    assert scheduler.positions(["page", "prefetch-0", "prefetch-1", "blocker"]) == {
+        "blocker": {"position": 0, "eta": None},
+        "page": {"position": 1, "eta": None},
+        "prefetch-1": {"position": 2, "eta": None},
+        "prefetch-0": {"position": 3, "eta": None},
+    }
+    release.set()
+    for future in futures:
+        future.result()
+    assert order == ["page", "prefetch-1", "prefetch-0"]
+    assert scheduler.stats()["completed"] == 4
+    assert scheduler.positions(["page"]) == {}
+
+
+def test_scheduler_weights_must_be_positive():
+    with pytest.raises(ValueError):
+        FairScheduler(weights={"a": 0})
+    with pytest.raises(ValueError):
+        FairScheduler(weights={"a": -1})
+
+
+def test_scheduler_forgets_idle_clients():
+    scheduler, release = blocked_scheduler()
+    futures = [scheduler.submit(f"page{n}", lambda: None, client=f"client{n}") for n in range(10)]
+    release.set()
+    for future in futures:
+        future.result()
+    assert scheduler._client_tags == {}
+
+
+def test_queue_route(app, client):
+    scheduler, release = blocked_scheduler()
+    app.extensions[OCR_SCHEDULER] = scheduler
+    scheduler.submit(f"{1:032}", lambda: None)
+
+    res = client.post(url_for("v1.queue"), json=[f"{1:032}", f"{2:032}"])
+    release.set()
+    assert res.json == {"queue": {f"{1:032}": {"position": 1, "eta": None}}}
@@ -0,0 +1,89 @@
+import io
+import json
+import pytest
+from pathlib import Path
+from app import OCR_CACHE
+from app.db import SqliteCache
+from app.snapshot import SnapshotError, export_snapshot, import_snapshot
+
+tc = Path(__file__).parent / "res/test_chapter.json"
+
+
+def snapshot_of(cache, since=None):
+    f = io.BytesIO()
+    export_snapshot(cache, f, since)
+    f.seek(0)
+    return f
+
+
+def test_snapshot_round_trip(sqlite_cache, tmp_path):
+    chapter = json.load(open(tc, "r"))
+    sqlite_cache.set_many(chapter)
+    f = snapshot_of(sqlite_cache)
+
+    other = SqliteCache(str(tmp_path / "other.sqlite3"), use_json=True)
+    assert import_snapshot(other, f) == (len(chapter), len(chapter))
+    assert other.get_many(*chapter) == list(chapter.values())
+    other.close()
+
+
+def test_snapshot_since_and_merge_rules(sqlite_cache, tmp_path):
+    sqlite_cache.set("a", {"v": "old"})
+    with sqlite_cache.get_connection() as conn:
+        conn.execute("UPDATE entries SET updated = 100")
+    sqlite_cache.set("b", {"v": "new"})
+    recent = SqliteCache(str(tmp_path / "recent.sqlite3"), use_json=True)
+    import_snapshot(recent, snapshot_of(sqlite_cache, since=200))
+    assert recent.get_many("a", "b") == [None, {"v": "new"}]
+    recent.close()
+
+    other = SqliteCache(str(tmp_path / "other.sqlite3"), use_json=True)
+    other.set("a", {"v": "local"})
+    other.set("b", {"v": "local"})
+    with other.get_connection() as conn:
+        conn.execute("UPDATE entries SET updated = 150 WHERE key = 'b'")
+    import_snapshot(other, snapshot_of(sqlite_cache), merge="skip")
+    assert other.get_many("a", "b") == [{"v": "local"}, {"v": "local"}]
+    import_snapshot(other, snapshot_of(sqlite_cache), merge="newer")
+    assert other.get_many("a", "b") == [{"v": "local"}, {"v": "new"}]
+    import_snapshot(other, snapshot_of(sqlite_cache), merge="replace")
+    assert other.get_many("a", "b") == [{"v": "old"}, {"v": "new"}]
+    other.close()
+
+
+def test_snapshot_rejects_corrupted_files(sqlite_cache):
+    sqlite_cache.set("a", {"v": 1})
+    data = bytearray(snapshot_of(sqlite_cache).getvalue())
+    data[-35] ^= 0xFF  # the last byte of the value, before the end record
+    with pytest.raises(SnapshotError):
+        import_snapshot(sqlite_cache, io.BytesIO(bytes(data)))
+    with pytest.raises(SnapshotError):
+        import_snapshot(sqlite_cache, io.BytesIO(bytes(data[:-5])))
+
+
+def test_broken_snapshot_imports_nothing(sqlite_cache, tmp_path):
+    chapter = json.load(open(tc, "r"))
+    sqlite_cache.set_many(chapter)
+    data = snapshot_of(sqlite_cache).getvalue()
+    other = SqliteCache(str(tmp_path / "other.sqlite3"), use_json=True)
+    with pytest.raises(SnapshotError):
+        import_snapshot(other, io.BytesIO(data[:-5]), batch_size=1)
+    assert other.has_many(*chapter) == []
+    other.close()
+
+
+def test_cache_cli_export_and_import(sqlite_app, tmp_path):
+    chapter = json.load(open(tc, "r"))
+    cache = sqlite_app.extensions[OCR_CACHE]
+    cache.set_many(chapter)
+    runner = sqlite_app.test_cli_runner()
+    snapshot = str(tmp_path / "snapshot.bin")
+
+    result = runner.invoke(args=["cache", "export", snapshot])
+    assert result.exit_code == 0, result.output
+    cache.clear()
+
+    result = runner.invoke(args=["cache", "import", snapshot])
+    assert result.exit_code == 0, result.output
+    assert f"Imported {len(chapter)} of {len(chapter)} rows" in result.output
+    assert cache.get_many(*chapter) == list(chapter.values())
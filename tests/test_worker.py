@@ -0,0 +1,104 @@
+import threading
+import types
+import sys
+from hashlib import md5
+from pathlib import Path
+from werkzeug.serving import make_server
+from app import OCR_CACHE, OCR_JOBS
+from app.jobs import JobStore, RUNNING, DONE, FAILED
+from app.ocr import INVALID_IMAGE
+from app.worker import OcrWorker
+
+p1 = Path(__file__).parent / "res/page1.webp"
+p2 = Path(__file__).parent / "res/page2.jpg"
+
+
+def test_worker_api_needs_the_token(remote_app, worker_auth):
+    client = remote_app.test_client()
+    assert client.post("/v1/worker/lease", json={"worker": "w"}).status_code == 401
+    assert client.post("/v1/worker/lease", json={}, headers=worker_auth).status_code == 415
+    assert client.post("/v1/worker/lease", json={"worker": "w"}, headers=worker_auth).status_code == 204
+
+    remote_app.config["OCR_WORKER_TOKEN"] = None
+    assert client.post("/v1/worker/lease", json={"worker": "w"}, headers=worker_auth).status_code == 404
+
+
+def test_worker_api_leases_jobs(remote_app, worker_auth, queue_page):
+    client = remote_app.test_client()
+    jobs = remote_app.extensions[OCR_JOBS]
+    key = queue_page(jobs, p1)
+
+    res = client.post("/v1/worker/lease", json={"worker": "w1"}, headers=worker_auth)
+    assert res.json["key"] == key and res.json["name"] == p1.name
+    assert jobs.get(key)["state"] == RUNNING
+    assert client.post("/v1/worker/lease", json={"worker": "w2"}, headers=worker_auth).status_code == 204
+    assert client.get(f"/v1/worker/jobs/{key}/image", headers=worker_auth).data == p1.read_bytes()
+
+    assert client.post(f"/v1/worker/jobs/{key}/lease", json={"worker": "w2"}, headers=worker_auth).status_code == 409
+    assert client.post(f"/v1/worker/jobs/{key}/lease", json={"worker": "w1"}, headers=worker_auth).status_code == 200
+    res = client.post(f"/v1/worker/jobs/{key}", json={"worker": "w2", "result": {}}, headers=worker_auth)
+    assert res.status_code == 409
+    res = client.post(f"/v1/worker/jobs/{key}", json={"worker": "w1", "result": {"blocks": []}}, headers=worker_auth)
+    assert res.json == {"key": key, "state": DONE}
+    assert remote_app.extensions[OCR_CACHE].get(key) == {"blocks": []}
+
+
+def test_expired_leases_are_retried(tmp_path, queue_page):
+    jobs = JobStore(str(tmp_path / "jobs.sqlite3"), tmp_path / "spool", lease_seconds=0, max_attempts=2)
+    key = queue_page(jobs, p1)
+
+    assert jobs.lease("dead")["attempts"] == 1
+    retried = jobs.lease("alive")
+    assert (retried["key"], retried["owner"], retried["attempts"]) == (key, "alive", 2)
+    assert not jobs.renew(key, "dead")
+    # the workers died every time
+    assert jobs.lease("alive") is None
+    assert jobs.get(key)["state"] == FAILED
+    jobs.close()
+
+
+def test_workers_ocr_the_uploaded_pages(remote_app):
+    server = make_server("127.0.0.1", 0, remote_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.port}"
+    token = remote_app.config["OCR_WORKER_TOKEN"]
+
+    def fake_ocr(image):
+        return {"size": len(image), "blocks": []}
+
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=OcrWorker(url, token, fake_ocr, f"w{n}", poll_interval=0.05).run,
+                         args=(stop,), daemon=True)
+        for n in range(2)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        data = {md5(p.read_bytes()).hexdigest(): (p.open("rb"), p.name) for p in (p1, p2)}
+        res = remote_app.test_client().post("/v1/new_pages", data=data)
+        assert ["success", "Finished OCR of all 2 files"] in res.json
+    finally:
+        stop.set()
+        server.shutdown()
+
+    cache = remote_app.extensions[OCR_CACHE]
+    for p in (p1, p2):
+        key = md5(p.read_bytes()).hexdigest()
+        assert cache.get(key) == {"size": p.stat().st_size, "blocks": []}
+        assert remote_app.extensions[OCR_JOBS].get(key)["owner"] in ("w0", "w1")
+
+
+def test_workers_report_invalid_images(monkeypatch):
+    class InvalidImage(Exception):
+        pass
+
+    def fake_ocr(image):
+        raise InvalidImage()
+
+    monkeypatch.setitem(sys.modules, "mokuro.manga_page_ocr", types.SimpleNamespace(InvalidImage=InvalidImage))
+    worker = OcrWorker("http://127.0.0.1", "token", fake_ocr, "w")
+    sent = []
+    monkeypatch.setattr(worker, "_request", lambda path, body=None: sent.append((path, body)) or b"gif")
+    worker.run_job({"key": "a" * 32, "name": "page.gif", "lease_seconds": 60})
+    assert sent[-1] == (f"/jobs/{'a' * 32}", {"error": INVALID_IMAGE})